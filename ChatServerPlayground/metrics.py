@@ -0,0 +1,57 @@
+"""
+In-process metrics: counters, gauges (current values, Ex: memory used by a cache), and summaries of
+observed values (Ex: batch sizes, latencies).
+
+Every server process keeps its own metrics. GET /metrics/ (staff only) returns the ones of the process
+that served the request.
+"""
+import threading
+
+from django.http import JsonResponse, HttpResponseForbidden
+
+
+_lock = threading.Lock()
+_counters = {}
+_gauges = {}
+_summaries = {}
+
+
+def increment(name, value=1):
+	with _lock:
+		_counters[name] = _counters.get(name, 0) + value
+
+
+def gauge(name, value):
+	with _lock:
+		_gauges[name] = value
+
+
+def observe(name, value):
+	with _lock:
+		summary = _summaries.get(name)
+		if summary == None:
+			summary = {"count": 0, "total": 0, "min": value, "max": value, "last": value}
+			_summaries[name] = summary
+		summary["count"] += 1
+		summary["total"] += value
+		summary["min"] = min(summary["min"], value)
+		summary["max"] = max(summary["max"], value)
+		summary["last"] = value
+
+
+def get_metrics():
+	with _lock:
+		summaries = {}
+		for name, summary in _summaries.items():
+			summaries[name] = dict(summary, mean=summary["total"] / summary["count"])
+		return {
+			"counters": dict(_counters),
+			"gauges": dict(_gauges),
+			"summaries": summaries,
+		}
+
+
+def metrics_view(request):
+	if not request.user.is_staff:
+		return HttpResponseForbidden("You must be staff to view the metrics.")
+	return JsonResponse(get_metrics())
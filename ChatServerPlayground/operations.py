@@ -0,0 +1,113 @@
+"""
+Custom migration operations shared by the apps.
+
+Django 2.2 has no AddIndexConcurrently/RemoveIndexConcurrently (they were added to django.contrib.postgres in 3.0).
+Plain CREATE INDEX locks the table against writes until the index is built, which is not acceptable
+on large live tables like notification_notification or chat_roomchatmessage.
+"""
+from django.db.migrations.operations import AddIndex, RemoveIndex
+
+
+class ConcurrentIndexMixin:
+	"""
+	CREATE/DROP INDEX CONCURRENTLY for AddIndexConcurrently and RemoveIndexConcurrently (PostgreSQL only).
+	"""
+
+	def create_index_concurrently(self, schema_editor, model, index):
+		"""
+		A CREATE INDEX CONCURRENTLY that failed (Ex: the migration was interrupted) leaves an INVALID index behind:
+		it is kept up to date on writes but never used by queries. It is dropped and built again.
+		A valid index of the same name means an earlier run got that far: it is kept.
+		"""
+		self.ensure_not_in_transaction(schema_editor)
+		is_valid = self.get_index_validity(schema_editor, index.name)
+		if is_valid == True:
+			return
+		if is_valid == False:
+			self.drop_index_concurrently(schema_editor, index.name)
+		sql = str(index.create_sql(model, schema_editor))
+		schema_editor.execute(sql.replace("CREATE INDEX", "CREATE INDEX CONCURRENTLY", 1), params=None)
+
+	def get_index_validity(self, schema_editor, index_name):
+		"""
+		pg_index.indisvalid of the index in the current schema, or None if it does not exist.
+		"""
+		with schema_editor.connection.cursor() as cursor:
+			cursor.execute(
+				"SELECT i.indisvalid FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid "
+				"WHERE c.relname = %s AND c.relnamespace = current_schema()::regnamespace",
+				[index_name]
+			)
+			row = cursor.fetchone()
+		return row[0] if row != None else None
+
+	def drop_index_concurrently(self, schema_editor, index_name):
+		self.ensure_not_in_transaction(schema_editor)
+		schema_editor.execute("DROP INDEX CONCURRENTLY IF EXISTS %s" % schema_editor.quote_name(index_name), params=None)
+
+	def ensure_not_in_transaction(self, schema_editor):
+		if schema_editor.connection.in_atomic_block:
+			raise Exception(
+				"%s can't be executed inside a transaction. "
+				"Set `atomic = False` on the migration." % self.__class__.__name__
+			)
+
+
+class AddIndexConcurrently(ConcurrentIndexMixin, AddIndex):
+	"""
+	Same as AddIndex, but uses CREATE/DROP INDEX CONCURRENTLY on PostgreSQL.
+	Other databases (Ex: SQLite for local development) get a normal CREATE INDEX.
+	The migration using it must set `atomic = False`: PostgreSQL can't build an index concurrently inside a transaction.
+	"""
+	reduces_to_sql = False
+
+	def database_forwards(self, app_label, schema_editor, from_state, to_state):
+		model = to_state.apps.get_model(app_label, self.model_name)
+		if not self.allow_migrate_model(schema_editor.connection.alias, model):
+			return
+		if schema_editor.connection.vendor != "postgresql":
+			return super(AddIndexConcurrently, self).database_forwards(app_label, schema_editor, from_state, to_state)
+		self.create_index_concurrently(schema_editor, model, self.index)
+
+	def database_backwards(self, app_label, schema_editor, from_state, to_state):
+		model = from_state.apps.get_model(app_label, self.model_name)
+		if not self.allow_migrate_model(schema_editor.connection.alias, model):
+			return
+		if schema_editor.connection.vendor != "postgresql":
+			return super(AddIndexConcurrently, self).database_backwards(app_label, schema_editor, from_state, to_state)
+		self.drop_index_concurrently(schema_editor, self.index.name)
+
+	def describe(self):
+		return "Concurrently create index %s on field(s) %s of model %s" % (
+			self.index.name,
+			", ".join(self.index.fields),
+			self.model_name,
+		)
+
+
+class RemoveIndexConcurrently(ConcurrentIndexMixin, RemoveIndex):
+	"""
+	Same as RemoveIndex, but uses DROP/CREATE INDEX CONCURRENTLY on PostgreSQL.
+	The migration using it must set `atomic = False`.
+	"""
+	reduces_to_sql = False
+
+	def database_forwards(self, app_label, schema_editor, from_state, to_state):
+		model = from_state.apps.get_model(app_label, self.model_name)
+		if not self.allow_migrate_model(schema_editor.connection.alias, model):
+			return
+		if schema_editor.connection.vendor != "postgresql":
+			return super(RemoveIndexConcurrently, self).database_forwards(app_label, schema_editor, from_state, to_state)
+		self.drop_index_concurrently(schema_editor, self.name)
+
+	def database_backwards(self, app_label, schema_editor, from_state, to_state):
+		model = to_state.apps.get_model(app_label, self.model_name)
+		if not self.allow_migrate_model(schema_editor.connection.alias, model):
+			return
+		if schema_editor.connection.vendor != "postgresql":
+			return super(RemoveIndexConcurrently, self).database_backwards(app_label, schema_editor, from_state, to_state)
+		index = to_state.models[app_label, self.model_name_lower].get_index_by_name(self.name)
+		self.create_index_concurrently(schema_editor, model, index)
+
+	def describe(self):
+		return "Concurrently remove index %s from %s" % (self.name, self.model_name)
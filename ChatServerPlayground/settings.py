@@ -164,7 +164,60 @@ TEMP = os.path.join(BASE_DIR, 'media_cdn/temp')
 
 BASE_URL = "http://127.0.0.1:8000"
 
+# How chat messages are stored: "immediate", "group_commit" or "write_behind". See chat/write_behind.py
+CHAT_MESSAGE_PERSISTENCE = "immediate"
+CHAT_MESSAGE_BATCH_SIZE = 100
+CHAT_MESSAGE_BATCH_DELAY = 0.05 # seconds
+
+# Who is connected to each chat room. See chat/presence.py
+# With more than one server process use 'chat.presence.RedisPresenceBackend'
+# and 'CONFIG': {"address": "redis://127.0.0.1:6379"}
+PRESENCE = {
+    'BACKEND': 'chat.presence.InMemoryPresenceBackend',
+    'TTL': 60,
+    'HEARTBEAT_INTERVAL': 20,
+}
 
+# Batching of the frames sent to chat sockets that ask for it (?coalesce_ms=...).
+# See chat/base_consumer.py
+CHAT_FRAME_COALESCING = {
+    'ENABLED': True,
+    'MAX_DELAY': 0.05, # seconds
+    'MAX_BATCH_SIZE': 50,
+}
 
+# Bounded send queues of the sockets that ask for flow control (?flow_control=1).
+# A client that falls HIGH_WATER frames behind is disconnected. See chat/base_consumer.py
+WEBSOCKET_FLOW_CONTROL = {
+    'ENABLED': True,
+    'WINDOW': 50, # frames sent ahead of the client's acks
+    'HIGH_WATER': 200, # frames waiting
+    'POLICIES': ["collapse", "drop_oldest"],
+}
 
+# Token-bucket limits on the messages sent to chat rooms. See chat/rate_limit.py
+# With more than one server process use 'chat.rate_limit.RedisRateLimitBackend'
+# and 'CONFIG': {"address": "redis://127.0.0.1:6379"}
+CHAT_RATE_LIMIT = {
+    'BACKEND': 'chat.rate_limit.InMemoryRateLimitBackend',
+    'CONNECTION': {'RATE': 1, 'BURST': 5}, # messages per second, messages
+    'USER': {'RATE': 2, 'BURST': 10},
+    'ROOM': {'RATE': 20, 'BURST': 50},
+}
 
+# Older pages of chat history. See chat/history_cache.py
+CHAT_HISTORY_CACHE = {
+    'MAX_BYTES': 10 * 1024 * 1024,
+    'SHARED_CACHE': None, # Ex: "default" (an alias of CACHES)
+    'TIMEOUT': 60 * 60 * 24, # seconds
+    'MIN_AGE': 60, # seconds
+}
+
+# Friend ids of each user, cached for friend checks. See friend/graph.py
+FRIEND_GRAPH = {
+    'MAX_USERS': 10000,
+    'LOCAL_TIMEOUT': 10, # seconds
+    'SHARED_CACHE': None, # Ex: "default" (an alias of CACHES)
+    'TIMEOUT': 60 * 60, # seconds
+    'SUGGESTIONS_MAX_FRIENDS': 200,
+}
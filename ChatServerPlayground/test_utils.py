@@ -0,0 +1,21 @@
+"""
+Helpers shared by the tests of the apps.
+"""
+from django.db import connection
+
+from account.models import Account
+
+
+def create_account(username):
+	return Account.objects.create_user(f"{username}@example.com", username, "password")
+
+
+def explain(queryset):
+	"""
+	The query plan of a queryset. PostgreSQL is told to avoid sequential scans because
+	the test tables are tiny and a seq scan would always win.
+	"""
+	if connection.vendor == "postgresql":
+		with connection.cursor() as cursor:
+			cursor.execute("SET LOCAL enable_seqscan = off")
+	return queryset.explain()
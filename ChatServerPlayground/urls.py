@@ -24,6 +24,8 @@ from personal.views import (
 	home_screen_view
 )
 
+from ChatServerPlayground.metrics import metrics_view
+
 from account.views import (
     register_view,
     login_view,
@@ -40,6 +42,7 @@ urlpatterns = [
     path('friend/', include('friend.urls', namespace='friend')),
     path('login/', login_view, name="login"),
     path('logout/', logout_view, name="logout"),
+    path('metrics/', metrics_view, name="metrics"),
     path('register/', register_view, name="register"),
     path('search/', account_search_view, name="search"),
 
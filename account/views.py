@@ -18,6 +18,8 @@ from account.models import Account
 from friend.utils import get_friend_request_or_false
 from friend.friend_request_status import FriendRequestStatus
 from friend.models import FriendList, FriendRequest
+from friend.graph import friend_graph
+from friend.constants import NUM_FRIEND_SUGGESTIONS
 
 
 TEMP_PROFILE_IMAGE_NAME = "temp_profile_image.png"
@@ -34,10 +36,11 @@ def account_search_view(request, *args, **kwargs):
 			user = request.user
 			accounts = [] # [(account1, True), (account2, False), ...]
 			if user.is_authenticated:
-				# get the authenticated users friend list
-				auth_user_friend_list = FriendList.objects.get(user=user)
+				# the search results that are friends of the authenticated user
+				search_results = list(search_results)
+				friend_ids = friend_graph.filter_friends(user.id, [account.id for account in search_results])
 				for account in search_results:
-					accounts.append((account, auth_user_friend_list.is_mutual_friend(account)))
+					accounts.append((account, account.id in friend_ids))
 				context['accounts'] = accounts
 			else:
 				for account in search_results:
@@ -148,8 +151,7 @@ def account_view(request, *args, **kwargs):
 		except FriendList.DoesNotExist:
 			friend_list = FriendList(user=account)
 			friend_list.save()
-		friends = friend_list.friends.all()
-		context['friends'] = friends
+		context['num_friends'] = len(friend_graph.get_friend_ids(account.id))
 	
 		# Define template variables
 		is_self = True
@@ -159,7 +161,8 @@ def account_view(request, *args, **kwargs):
 		user = request.user
 		if user.is_authenticated and user != account:
 			is_self = False
-			if friends.filter(pk=user.id):
+			context['num_mutual_friends'] = friend_graph.count_mutual_friends(user.id, [account.id])[account.id]
+			if friend_graph.is_friend(account.id, user.id):
 				is_friend = True
 			else:
 				is_friend = False
@@ -181,6 +184,7 @@ def account_view(request, *args, **kwargs):
 				friend_requests = FriendRequest.objects.filter(receiver=user, is_active=True)
 			except:
 				pass
+			context['friend_suggestions'] = get_friend_suggestions(user)
 			
 		# Set the template variables to the values
 		context['is_self'] = is_self
@@ -191,6 +195,14 @@ def account_view(request, *args, **kwargs):
 		return render(request, "account/account.html", context)
 
 
+def get_friend_suggestions(user):
+	"""
+	People you may know: [(account1, number of mutual friends), ...]
+	"""
+	suggestions = friend_graph.suggest_friends(user.id, NUM_FRIEND_SUGGESTIONS)
+	accounts = Account.objects.in_bulk([account_id for account_id, num_mutual_friends in suggestions])
+	return [(accounts[account_id], num_mutual_friends) for account_id, num_mutual_friends in suggestions if account_id in accounts]
+
 
 def save_temp_profile_image_from_base64String(imageString, user):
 	INCORRECT_PADDING_EXCEPTION = "Incorrect padding"
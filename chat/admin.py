@@ -6,7 +6,7 @@ from django.core.cache import cache
 from chat.models import PrivateChatRoom, RoomChatMessage, UnreadChatRoomMessages
 
 class PrivateChatRoomAdmin(admin.ModelAdmin):
-	list_display = ['id','user1', 'user2', ]
+	list_display = ['id','user1', 'user2', 'is_active', 'last_message_at', ]
 	search_fields = ['id', 'user1__username', 'user2__username','user1__email', 'user2__email', ]
 	readonly_fields = ['id',]
 
@@ -54,7 +54,7 @@ admin.site.register(RoomChatMessage, RoomChatMessageAdmin)
 
 
 class UnreadChatRoomMessagesAdmin(admin.ModelAdmin):
-    list_display = ['room','user', 'count' ]
+    list_display = ['room','user', 'last_read_timestamp', 'get_unread_count' ]
     search_fields = ['room__user1__username', 'room__user2__username', ]
     readonly_fields = ['id',]
 
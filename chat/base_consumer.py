@@ -0,0 +1,332 @@
+import asyncio
+import json
+import time
+from collections import deque
+from urllib.parse import parse_qs
+
+from django.conf import settings
+from channels.generic.websocket import AsyncJsonWebsocketConsumer
+
+from ChatServerPlayground import metrics
+from chat.presence import get_presence, get_presence_heartbeat_interval
+from chat.rate_limit import TokenBucket, get_rate_limiter, get_rate_limit
+from chat.exceptions import RateLimitError
+from chat.constants import *
+
+# orjson is several times faster than the json module. It is optional: without it the json module is used.
+try:
+	import orjson
+except ImportError:
+	orjson = None
+
+
+def encode_frame(content):
+	"""
+	Encode the content of a websocket text frame.
+	Database helpers return frames encoded with this so the consumer can send them as they are (see send_frame).
+	"""
+	if orjson != None:
+		# orjson returns bytes. Websocket text frames are str.
+		return orjson.dumps(content).decode("utf-8")
+	return json.dumps(content)
+
+
+def decode_frame(text_data):
+	if orjson != None:
+		return orjson.loads(text_data)
+	return json.loads(text_data)
+
+
+class BaseJsonConsumer(AsyncJsonWebsocketConsumer):
+	"""
+	Base class of ChatConsumer, PublicChatConsumer and NotificationConsumer.
+		1. send_json/receive_json use the fast encoder.
+		2. send_frame sends a frame that was already encoded (Ex: a page of messages built in a database helper)
+			without decoding and encoding it again.
+		3. enter_presence/leave_presence track the room the user of this connection is in (see chat.presence).
+		4. send_event: optional batching of the frames sent to busy rooms (see negotiate_coalescing).
+		5. Optional bounded send queue for clients that read slowly (see negotiate_flow_control).
+		6. check_send_rate limits the messages sent to rooms (see chat.rate_limit).
+	"""
+
+	# Seconds an event waits for others to be sent with it. 0: coalescing is off.
+	coalescing_delay = 0
+	# Frames waiting for the client to acknowledge the previous ones. None: flow control is off.
+	send_queue = None
+
+	@classmethod
+	async def decode_json(cls, text_data):
+		return decode_frame(text_data)
+
+	@classmethod
+	async def encode_json(cls, content):
+		return encode_frame(content)
+
+	async def send_frame(self, frame):
+		"""
+		Send a frame returned by encode_frame.
+		"""
+		await self.flush_coalesced()
+		await self.send(text_data=frame)
+
+	async def send_json(self, content, close=False):
+		# Events buffered before this one are sent first
+		await self.flush_coalesced()
+		# Not super().send_json: it bypasses send (and the send queue)
+		await self.send(text_data=await self.encode_json(content), close=close)
+
+	async def send(self, text_data=None, bytes_data=None, close=False):
+		await self.write_frame(text_data=text_data, bytes_data=bytes_data, close=close)
+
+	async def receive(self, text_data=None, bytes_data=None, **kwargs):
+		if self.send_queue != None and text_data:
+			content = await self.decode_json(text_data)
+			if isinstance(content, dict) and content.get("command") == "ack":
+				await self.receive_ack(content.get("seq"))
+				return
+			await self.receive_json(content, **kwargs)
+			return
+		await super().receive(text_data=text_data, bytes_data=bytes_data, **kwargs)
+
+	def get_query_parameter(self, name, default):
+		query = parse_qs(self.scope.get("query_string", b"").decode("utf-8"))
+		return query.get(name, [default])[0]
+
+	def negotiate_coalescing(self):
+		"""
+		Called before accepting the socket. A client opts in to coalescing by connecting with
+		"?coalesce_ms=<milliseconds>": events for it are then buffered up to that long (at most
+		CHAT_FRAME_COALESCING['MAX_DELAY'] seconds) and sent as one array frame of up to
+		CHAT_FRAME_COALESCING['MAX_BATCH_SIZE'] events.
+		The client must handle array frames: each element is a frame that would have been sent on its own.
+		"""
+		config = getattr(settings, "CHAT_FRAME_COALESCING", {})
+		if not config.get("ENABLED", True):
+			return
+		try:
+			requested_delay = int(self.get_query_parameter("coalesce_ms", "0")) / 1000
+		except ValueError:
+			return
+		if requested_delay > 0:
+			self.coalescing_delay = min(requested_delay, config.get("MAX_DELAY", DEFAULT_COALESCING_MAX_DELAY))
+			self.coalescing_batch_size = config.get("MAX_BATCH_SIZE", DEFAULT_COALESCING_MAX_BATCH_SIZE)
+			self.coalesced = []
+			self.coalescing_handle = None
+
+	async def send_event(self, content, collapse_key=None, droppable=False):
+		"""
+		Send an event (Ex: a chat message) that can wait a few milliseconds.
+		collapse_key: a waiting event with the same key is replaced instead of sent (Ex: only the latest
+			number of connected users matters).
+		droppable: the event can be dropped if the client doesn't keep up (Ex: "<user> connected.").
+		"""
+		if self.coalescing_delay == 0:
+			await self.flush_coalesced()
+			return await self.write_frame(text_data=encode_frame(content), collapse_key=collapse_key, droppable=droppable)
+		if collapse_key != None:
+			self.coalesced = [event for event in self.coalesced if event[0] != collapse_key]
+		self.coalesced.append((collapse_key, droppable, content))
+		if len(self.coalesced) >= self.coalescing_batch_size:
+			await self.flush_coalesced()
+		elif self.coalescing_handle == None:
+			loop = asyncio.get_event_loop()
+			self.coalescing_handle = loop.call_later(self.coalescing_delay, lambda: asyncio.ensure_future(self.flush_coalesced()))
+
+	async def flush_coalesced(self):
+		if self.coalescing_delay == 0:
+			return
+		if self.coalescing_handle != None:
+			self.coalescing_handle.cancel()
+			self.coalescing_handle = None
+		if len(self.coalesced) == 0:
+			return
+		batch = self.coalesced
+		self.coalesced = []
+		metrics.observe("chat.coalesced_frames.batch_size", len(batch))
+		await self.write_frame(
+			text_data=encode_frame([content for collapse_key, droppable, content in batch]),
+			collapse_key=batch[0][0] if len(batch) == 1 else None,
+			droppable=all([droppable for collapse_key, droppable, content in batch]),
+		)
+
+	def negotiate_flow_control(self):
+		"""
+		Called before accepting the socket. A client opts in to flow control by connecting with "?flow_control=1".
+
+		The server can't tell how fast a client reads: frames are handed to the websocket server, which buffers them
+		for as long as it takes. So the client acknowledges what it received by sending
+		{"command": "ack", "seq": <number of frames received so far>}, and at most WEBSOCKET_FLOW_CONTROL['WINDOW']
+		frames are sent ahead of its acks. The other frames wait in the send queue of the connection.
+		When more than WEBSOCKET_FLOW_CONTROL['HIGH_WATER'] frames are waiting, the POLICIES are applied:
+			"collapse": a waiting frame is replaced by a newer frame with the same collapse_key (Ex: counts).
+			"drop_oldest": the oldest droppable frames are dropped (Ex: "<user> connected.").
+		If that is not enough, the client is too slow: it gets a SLOW_CONSUMER error with what it needs to
+		resume (see get_resume_hint) and the socket is closed.
+		"""
+		config = getattr(settings, "WEBSOCKET_FLOW_CONTROL", {})
+		if not config.get("ENABLED", True) or self.get_query_parameter("flow_control", "0") != "1":
+			return
+		self.send_window = config.get("WINDOW", DEFAULT_FLOW_CONTROL_WINDOW)
+		self.send_queue_high_water = config.get("HIGH_WATER", DEFAULT_FLOW_CONTROL_HIGH_WATER)
+		self.send_queue_policies = config.get("POLICIES", DEFAULT_FLOW_CONTROL_POLICIES)
+		# Waiting frames, oldest first. Collapsed and dropped frames stay in it (not "alive") until they are reached.
+		self.send_queue = deque()
+		self.send_queue_length = 0
+		# collapse_key -> the waiting frame with that key
+		self.collapsible_frames = {}
+		self.sent_seq = 0
+		self.acked_seq = 0
+		self.sending = False
+		self.slow_consumer = False
+
+	def get_resume_hint(self):
+		"""
+		Sent with the SLOW_CONSUMER error. What the client needs to catch up after reconnecting.
+		"""
+		return {}
+
+	async def write_frame(self, text_data=None, bytes_data=None, close=False, collapse_key=None, droppable=False):
+		"""
+		Send a frame, through the send queue if the client asked for flow control (see negotiate_flow_control).
+		"""
+		if self.send_queue == None:
+			return await super().send(text_data=text_data, bytes_data=bytes_data, close=close)
+		if self.slow_consumer:
+			return
+		frame = {
+			"text_data": text_data,
+			"bytes_data": bytes_data,
+			"close": close,
+			"collapse_key": collapse_key,
+			"droppable": droppable,
+			"alive": True,
+		}
+		if collapse_key != None and "collapse" in self.send_queue_policies:
+			if collapse_key in self.collapsible_frames:
+				self.remove_queued_frame(self.collapsible_frames[collapse_key])
+				metrics.increment("websocket.send_queue.collapsed")
+			self.collapsible_frames[collapse_key] = frame
+		self.send_queue.append(frame)
+		self.send_queue_length += 1
+
+		if self.send_queue_length > self.send_queue_high_water and "drop_oldest" in self.send_queue_policies:
+			for queued in self.send_queue:
+				if self.send_queue_length <= self.send_queue_high_water:
+					break
+				if queued["alive"] and queued["droppable"]:
+					self.remove_queued_frame(queued)
+					metrics.increment("websocket.send_queue.dropped")
+		if self.send_queue_length > self.send_queue_high_water:
+			return await self.disconnect_slow_consumer()
+		if len(self.send_queue) > 2 * self.send_queue_high_water:
+			self.send_queue = deque([queued for queued in self.send_queue if queued["alive"]])
+		await self.send_queued_frames()
+
+	def remove_queued_frame(self, frame):
+		frame["alive"] = False
+		self.send_queue_length -= 1
+		if frame["collapse_key"] != None and self.collapsible_frames.get(frame["collapse_key"]) is frame:
+			del self.collapsible_frames[frame["collapse_key"]]
+
+	async def send_queued_frames(self):
+		# Frames written while a frame is being sent are sent by the same loop, in order
+		if self.sending:
+			return
+		self.sending = True
+		try:
+			while len(self.send_queue) > 0 and self.sent_seq - self.acked_seq < self.send_window and not self.slow_consumer:
+				frame = self.send_queue.popleft()
+				if not frame["alive"]:
+					continue
+				self.remove_queued_frame(frame)
+				self.sent_seq += 1
+				await super().send(text_data=frame["text_data"], bytes_data=frame["bytes_data"], close=frame["close"])
+		finally:
+			self.sending = False
+		metrics.observe("websocket.send_queue.depth", self.send_queue_length)
+
+	async def receive_ack(self, seq):
+		if not isinstance(seq, int):
+			return
+		# A client can't acknowledge frames it was not sent
+		self.acked_seq = max(self.acked_seq, min(seq, self.sent_seq))
+		await self.send_queued_frames()
+
+	async def disconnect_slow_consumer(self):
+		print("BaseJsonConsumer: disconnect_slow_consumer: " + str(self.scope["user"]))
+		metrics.increment("websocket.send_queue.disconnected")
+		self.slow_consumer = True
+		self.send_queue.clear()
+		self.send_queue_length = 0
+		self.collapsible_frames = {}
+		await super().send(text_data=encode_frame({
+			"error": "SLOW_CONSUMER",
+			"message": "Too many messages are waiting to be sent. Reconnect to catch up.",
+			"resume": self.get_resume_hint(),
+		}))
+		await self.close(code=SLOW_CONSUMER_CLOSE_CODE)
+
+	async def websocket_disconnect(self, message):
+		if self.coalescing_delay != 0 and self.coalescing_handle != None:
+			self.coalescing_handle.cancel()
+			self.coalescing_handle = None
+		await super().websocket_disconnect(message)
+
+	async def check_send_rate(self, room_key):
+		"""
+		Raises RateLimitError if the user of this connection can't send a message to the room right now.
+		Must be called before the message is stored.
+		"""
+		now = time.time()
+		connection_limit = get_rate_limit("CONNECTION")
+		if connection_limit != None:
+			if getattr(self, "send_rate_bucket", None) == None:
+				self.send_rate_bucket = TokenBucket(*connection_limit)
+			wait = self.send_rate_bucket.get_wait(now)
+			if wait > 0:
+				metrics.increment("chat.rate_limited.connection")
+				raise RateLimitError(wait)
+
+		limits = []
+		user_limit = get_rate_limit("USER")
+		if user_limit != None:
+			limits.append(("user:" + str(self.scope["user"].id),) + user_limit)
+		room_limit = get_rate_limit("ROOM")
+		if room_limit != None:
+			limits.append(("room:" + room_key,) + room_limit)
+		if len(limits) > 0:
+			wait = await get_rate_limiter().acquire(limits)
+			if wait > 0:
+				metrics.increment("chat.rate_limited.user_or_room")
+				raise RateLimitError(wait)
+
+		if connection_limit != None:
+			self.send_rate_bucket.take()
+
+	async def enter_presence(self, room_key):
+		"""
+		The user of this connection is present in the room until leave_presence is called (or the heartbeats stop).
+		"""
+		await self.leave_presence()
+		await get_presence().join(room_key, self.scope["user"].id, self.channel_name)
+		self.presence_room_key = room_key
+		self.presence_heartbeat = asyncio.ensure_future(self.send_presence_heartbeats(room_key))
+
+	async def leave_presence(self):
+		"""
+		Safe to call more than once. Must be called when the socket disconnects.
+		"""
+		room_key = getattr(self, "presence_room_key", None)
+		if room_key == None:
+			return
+		self.presence_room_key = None
+		self.presence_heartbeat.cancel()
+		await get_presence().leave(room_key, self.scope["user"].id, self.channel_name)
+
+	async def send_presence_heartbeats(self, room_key):
+		while True:
+			await asyncio.sleep(get_presence_heartbeat_interval())
+			try:
+				await get_presence().heartbeat(room_key, self.scope["user"].id, self.channel_name)
+			except Exception as e:
+				print("EXCEPTION: send_presence_heartbeats: " + str(e))
@@ -2,4 +2,63 @@ DEFAULT_ROOM_CHAT_MESSAGE_PAGE_SIZE = 10
 
 MSG_TYPE_MESSAGE = 0 # For standard messages
 MSG_TYPE_ENTER = 1
-MSG_TYPE_LEAVE = 2
\ No newline at end of file
+MSG_TYPE_LEAVE = 2
+
+"""
+How chat messages are persisted (settings.CHAT_MESSAGE_PERSISTENCE). See chat.write_behind.
+"""
+MESSAGE_PERSISTENCE_IMMEDIATE = "immediate"
+MESSAGE_PERSISTENCE_GROUP_COMMIT = "group_commit"
+MESSAGE_PERSISTENCE_WRITE_BEHIND = "write_behind"
+
+DEFAULT_MESSAGE_BATCH_SIZE = 100
+DEFAULT_MESSAGE_BATCH_DELAY = 0.05 # seconds
+
+
+"""
+Presence of users in chat rooms (settings.PRESENCE). See chat.presence.
+"""
+DEFAULT_PRESENCE_TTL = 60 # seconds
+DEFAULT_PRESENCE_HEARTBEAT_INTERVAL = 20 # seconds
+
+
+"""
+Cache of older pages of chat history (settings.CHAT_HISTORY_CACHE). See chat.history_cache.
+"""
+DEFAULT_HISTORY_CACHE_MAX_BYTES = 10 * 1024 * 1024
+DEFAULT_HISTORY_CACHE_TIMEOUT = 60 * 60 * 24 # seconds
+DEFAULT_HISTORY_CACHE_MIN_AGE = 60 # seconds
+
+
+"""
+Batching of outbound frames (settings.CHAT_FRAME_COALESCING). See chat.base_consumer.BaseJsonConsumer.negotiate_coalescing.
+"""
+DEFAULT_COALESCING_MAX_DELAY = 0.05 # seconds
+DEFAULT_COALESCING_MAX_BATCH_SIZE = 50
+
+
+"""
+Bounded send queues of websocket connections (settings.WEBSOCKET_FLOW_CONTROL). See chat.base_consumer.BaseJsonConsumer.negotiate_flow_control.
+"""
+DEFAULT_FLOW_CONTROL_WINDOW = 50 # frames sent ahead of the client's acks
+DEFAULT_FLOW_CONTROL_HIGH_WATER = 200 # frames waiting
+DEFAULT_FLOW_CONTROL_POLICIES = ["collapse", "drop_oldest"]
+SLOW_CONSUMER_CLOSE_CODE = 4008
+
+
+"""
+Limits on the messages sent to chat rooms (settings.CHAT_RATE_LIMIT). See chat.rate_limit.
+"""
+DEFAULT_RATE_LIMITS = {
+	"CONNECTION": {"RATE": 1, "BURST": 5}, # messages per second, messages
+	"USER": {"RATE": 2, "BURST": 10},
+	"ROOM": {"RATE": 20, "BURST": 50},
+}
+RATE_LIMIT_CLEANUP_INTERVAL = 60 # seconds
+
+
+"""
+The inbox: the private chats of a user, most recent message first. See chat.views.get_recent_chatroom_messages.
+"""
+INBOX_MESSAGE_PREVIEW_LENGTH = 100 # characters of the last message kept on PrivateChatRoom
+DEFAULT_INBOX_PAGE_SIZE = 50
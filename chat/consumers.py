@@ -1,22 +1,23 @@
-from channels.generic.websocket import AsyncJsonWebsocketConsumer
 from channels.db import database_sync_to_async
 from django.core.serializers import serialize
 from django.utils import timezone
-from django.core.paginator import Paginator
 
-import json
 import asyncio
 
 from chat.models import RoomChatMessage, PrivateChatRoom, UnreadChatRoomMessages
-from friend.models import FriendList
+from friend.graph import friend_graph
 from account.utils import LazyAccountEncoder
-from chat.utils import calculate_timestamp, LazyRoomChatMessageEncoder
-from chat.exceptions import ClientError
+from chat.utils import calculate_timestamp, get_epoch_timestamp, LazyRoomChatMessageEncoder, notify_unread_message, mark_room_read, update_last_messages
+from chat.base_consumer import BaseJsonConsumer, encode_frame
+from chat.write_behind import MessageWriteBuffer
+from chat.history_cache import HistoryPageCache
+from chat.presence import get_presence
+from chat.exceptions import ClientError, RateLimitError
 from chat.constants import *
 from account.models import Account
 
 
-class ChatConsumer(AsyncJsonWebsocketConsumer):
+class ChatConsumer(BaseJsonConsumer):
 
 
 	async def connect(self):
@@ -25,12 +26,17 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
 		"""
 		print("ChatConsumer: connect: " + str(self.scope["user"]))
 
+		self.negotiate_coalescing()
+		self.negotiate_flow_control()
 		# let everyone connect. But limit read/write to authenticated users
 		await self.accept()
 
 		# the room_id will define what it means to be "connected". If it is not None, then the user is connected.
 		self.room_id = None
 
+		# The room that was joined. Permission is checked once, when joining (see get_joined_room).
+		self.room = None
+
 
 	async def receive_json(self, content):
 		"""
@@ -53,21 +59,23 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
 				await self.send_room(content["room"], content["message"])
 			elif command == "get_room_chat_messages":
 				await self.display_progress_bar(True)
-				room = await get_room_or_error(content['room_id'], self.scope["user"])
-				payload = await get_room_chat_messages(room, content['page_number'])
-				if payload != None:
-					payload = json.loads(payload)
-					await self.send_messages_payload(payload['messages'], payload['new_page_number'])
+				room = self.get_joined_room(content['room_id'])
+				if "page_number" in content and "before_msg_id" not in content:
+					# Clients loaded before the before_msg_id protocol
+					frame = await get_room_chat_messages_by_page_number(room, content['page_number'])
+				else:
+					frame = await get_room_chat_messages(room, content.get('before_msg_id', None))
+				if frame != None:
+					await self.send_frame(frame)
 				else:
 					raise ClientError(204,"Something went wrong retrieving the chatroom messages.")
 				await self.display_progress_bar(False)
 			elif command == "get_user_info":
 				await self.display_progress_bar(True)
-				room = await get_room_or_error(content['room_id'], self.scope["user"])
-				payload = get_user_info(room, self.scope["user"])
-				if payload != None:
-					payload = json.loads(payload)
-					await self.send_user_info_payload(payload['user_info'])
+				room = self.get_joined_room(content['room_id'])
+				frame = get_user_info(room, self.scope["user"])
+				if frame != None:
+					await self.send_frame(frame)
 				else:
 					raise ClientError(204, "Something went wrong retrieving the other users account details.")
 				await self.display_progress_bar(False)
@@ -87,6 +95,7 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
 		except Exception as e:
 			print("EXCEPTION: " + str(e))
 			pass
+		await self.leave_presence()
 
 
 	async def join_room(self, room_id):
@@ -100,13 +109,14 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
 		except ClientError as e:
 			return await self.handle_client_error(e)
 
-		# Add user to "users" list for room
-		await connect_user(room, self.scope["user"])
+		# The user is "in" the room: messages sent to them are not counted as unread
+		await self.enter_presence(room.group_name)
 
 		# Store that we're in the room
 		self.room_id = room.id
+		self.room = room
 
-		await on_user_connected(room, self.scope["user"])
+		await on_user_read_room(room, self.scope["user"])
 
 		# Add them to the group so they get room messages
 		await self.channel_layer.group_add(
@@ -139,10 +149,12 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
 		# The logged-in user is in our scope thanks to the authentication ASGI middleware
 		print("ChatConsumer: leave_room")
 
-		room = await get_room_or_error(room_id, self.scope["user"])
+		room = self.get_joined_room(room_id)
 
-		# Remove user from "connected_users" list
-		await disconnect_user(room, self.scope["user"])
+		# The user is not "in" the room anymore
+		await self.leave_presence()
+		# The messages they saw while in the room are read
+		await on_user_read_room(room, self.scope["user"])
 
 		# Notify the group that someone left
 		await self.channel_layer.group_send(
@@ -158,6 +170,7 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
 
 		# Remove that we're in the room
 		self.room_id = None
+		self.room = None
 
 		# Remove them from the group so they no longer get room messages
 		await self.channel_layer.group_discard(
@@ -176,27 +189,23 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
 		"""
 		print("ChatConsumer: send_room")
 		# Check they are in this room
-		if self.room_id != None:
-			if str(room_id) != str(self.room_id):
-				print("CLIENT ERRROR 1")
-				raise ClientError("ROOM_ACCESS_DENIED", "Room access denied")
-		else:
-			print("CLIENT ERRROR 2")
-			raise ClientError("ROOM_ACCESS_DENIED", "Room access denied")
-
-		# Get the room and send to the group about it
-		room = await get_room_or_error(room_id, self.scope["user"])
+		room = self.get_joined_room(room_id)
+		await self.check_send_rate(room.group_name)
 
-		# get list of connected_users
-		connected_users = room.connected_users.all()
+		# Messages sent to users who are not in the room are unread
+		absent_users = []
+		for user in [room.user1, room.user2]:
+			if not await get_presence().is_present(room.group_name, user.id):
+				absent_users.append(user)
 
 		# Execute these functions asychronously
-		await asyncio.gather(*[
-			append_unread_msg_if_not_connected(room, room.user1, connected_users, message), 
-			append_unread_msg_if_not_connected(room, room.user2, connected_users, message),
-			create_room_chat_message(room, self.scope["user"], message)
-		])
+		results = await asyncio.gather(*(
+			[append_unread_msg(room, user, message) for user in absent_users]
+			+ [create_room_chat_message(room, self.scope["user"], message)]
+		))
+		chat_message = results[-1]
 
+		# The timestamp is formatted once, not once per recipient
 		await self.channel_layer.group_send(
 			room.group_name,
 			{
@@ -205,10 +214,30 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
 				"username": self.scope["user"].username,
 				"user_id": self.scope["user"].id,
 				"message": message,
+				"msg_id": str(chat_message.id) if chat_message.id != None else None,
+				"timestamp": get_epoch_timestamp(chat_message.timestamp),
+				"natural_timestamp": calculate_timestamp(chat_message.timestamp),
 			}
 		)
 
 
+	def get_joined_room(self, room_id):
+		"""
+		The room this connection joined. Access was checked by join_room and is not checked again:
+		if the users stop being friends the socket is closed (see chat_revoke).
+		"""
+		if self.room == None or str(room_id) != str(self.room_id):
+			raise ClientError("ROOM_ACCESS_DENIED", "Room access denied")
+		return self.room
+
+
+	def get_resume_hint(self):
+		"""
+		The room to join again. Messages missed meanwhile are in the first page of the room.
+		"""
+		return {"room_id": self.room_id}
+
+
 	# These helper methods are named by the types we send - so chat.join becomes chat_join
 	async def chat_join(self, event):
 		"""
@@ -217,7 +246,7 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
 		# Send a message down to the client
 		print("ChatConsumer: chat_join: " + str(self.scope["user"].id))
 		if event["username"]:
-			await self.send_json(
+			await self.send_event(
 				{
 					"msg_type": MSG_TYPE_ENTER,
 					"room": event["room_id"],
@@ -226,6 +255,7 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
 					"user_id": event["user_id"],
 					"message": event["username"] + " connected.",
 				},
+				droppable=True,
 			)
 
 	async def chat_leave(self, event):
@@ -235,7 +265,7 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
 		# Send a message down to the client
 		print("ChatConsumer: chat_leave")
 		if event["username"]:
-			await self.send_json(
+			await self.send_event(
 			{
 				"msg_type": MSG_TYPE_LEAVE,
 				"room": event["room_id"],
@@ -244,6 +274,7 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
 				"user_id": event["user_id"],
 				"message": event["username"] + " disconnected.",
 			},
+			droppable=True,
 		)
 
 
@@ -254,43 +285,38 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
 		# Send a message down to the client
 		print("ChatConsumer: chat_message")
 
-		timestamp = calculate_timestamp(timezone.now())
-
-		await self.send_json(
+		await self.send_event(
 			{
 				"msg_type": MSG_TYPE_MESSAGE,
 				"username": event["username"],
 				"user_id": event["user_id"],
 				"profile_image": event["profile_image"],
 				"message": event["message"],
-				"natural_timestamp": timestamp,
+				"msg_id": event["msg_id"],
+				"natural_timestamp": event["natural_timestamp"],
+				"timestamp": event["timestamp"],
 			},
 		)
 
-	async def send_messages_payload(self, messages, new_page_number):
+	async def chat_revoke(self, event):
 		"""
-		Send a payload of messages to the ui
+		Called when the users of the room are no longer friends (see chat.utils.revoke_private_chat_access).
+		Leave the room and close the socket.
 		"""
-		print("ChatConsumer: send_messages_payload. ")
-
-		await self.send_json(
-			{
-				"messages_payload": "messages_payload",
-				"messages": messages,
-				"new_page_number": new_page_number,
-			},
-		)
+		print("ChatConsumer: chat_revoke")
+		if self.room == None or str(event["room_id"]) != str(self.room_id):
+			return
+		room = self.room
+		self.room_id = None
+		self.room = None
 
-	async def send_user_info_payload(self, user_info):
-		"""
-		Send a payload of user information to the ui
-		"""
-		print("ChatConsumer: send_user_info_payload. ")
-		await self.send_json(
-			{
-				"user_info": user_info,
-			},
+		await self.leave_presence()
+		await self.channel_layer.group_discard(
+			room.group_name,
+			self.channel_name,
 		)
+		await self.handle_client_error(ClientError("ROOM_ACCESS_DENIED", "You must be friends to chat."))
+		await self.close()
 
 	async def display_progress_bar(self, is_displayed):
 		"""
@@ -314,6 +340,8 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
 		"""
 		errorData = {}
 		errorData['error'] = e.code
+		if isinstance(e, RateLimitError):
+			errorData['retry_after'] = e.retry_after
 		if e.message:
 			errorData['message'] = e.message
 			await self.send_json(errorData)
@@ -324,21 +352,21 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
 def get_room_or_error(room_id, user):
 	"""
 	Tries to fetch a room for the user, checking permissions along the way.
+	Called once per connection, when joining the room.
 	"""
 	try:
-		room = PrivateChatRoom.objects.get(pk=room_id)
+		room = PrivateChatRoom.objects.select_related("user1", "user2").get(pk=room_id)
 	except PrivateChatRoom.DoesNotExist:
 		raise ClientError("ROOM_INVALID", "Invalid room.")
 
 	# Is this user allowed in the room? (must be user1 or user2)
-	if user != room.user1 and user != room.user2:
+	if user.id != room.user1_id and user.id != room.user2_id:
 		raise ClientError("ROOM_ACCESS_DENIED", "You do not have permission to join this room.")
 
 	# Are the users in this room friends?
-	friend_list = FriendList.objects.get(user=user).friends.all()
-	if not room.user1 in friend_list:
-		if not room.user2 in friend_list:
-			raise ClientError("ROOM_ACCESS_DENIED", "You must be friends to chat.")
+	other_user_id = room.user2_id if user.id == room.user1_id else room.user1_id
+	if not friend_graph.is_friend(user.id, other_user_id):
+		raise ClientError("ROOM_ACCESS_DENIED", "You must be friends to chat.")
 	return room
 
 
@@ -346,7 +374,8 @@ def get_room_or_error(room_id, user):
 # https://docs.djangoproject.com/en/3.1/ref/models/instances/#refreshing-objects-from-database
 def get_user_info(room, user):
 	"""
-	Retrieve the user info for the user you are chatting with
+	Retrieve the user info for the user you are chatting with.
+	Returns the encoded frame for the ui.
 	"""
 	try:
 		# Determine who is who
@@ -358,96 +387,99 @@ def get_user_info(room, user):
 		s = LazyAccountEncoder()
 		# convert to list for serializer and select first entry (there will be only 1)
 		payload['user_info'] = s.serialize([other_user])[0] 
-		return json.dumps(payload)
+		return encode_frame(payload)
 	except ClientError as e:
 		raise ClientError("DATA_ERROR", "Unable to get that users information.")
 	return None
 
 
+# Stores the messages according to settings.CHAT_MESSAGE_PERSISTENCE
+room_chat_message_buffer = MessageWriteBuffer(RoomChatMessage, "chat.messages", on_write=update_last_messages)
+
+
+async def create_room_chat_message(room, user, message):
+	chat_message = RoomChatMessage(user=user, room=room, content=message, timestamp=timezone.now())
+	try:
+		await room_chat_message_buffer.save(chat_message)
+	except Exception as e:
+		print("EXCEPTION: create_room_chat_message: " + str(e))
+		raise ClientError("MESSAGE_NOT_SAVED", "Your message could not be sent. Try again.")
+	return chat_message
+
+
+# Older pages of messages of the rooms
+room_history_cache = HistoryPageCache("chat.history")
+
+
 @database_sync_to_async
-def create_room_chat_message(room, user, message):
-	return RoomChatMessage.objects.create(user=user, room=room, content=message)
+def get_room_chat_messages(room, before_msg_id):
+	"""
+	Returns the encoded frame of the page of messages sent before the message `before_msg_id`
+	(the newest page if it is None) for the ui.
+	One range query: no COUNT(*), no OFFSET, and new messages don't shift the pages.
+	One extra row is fetched to find out if there is another page.
+	next_before_msg_id is None when there are no older messages to retrieve.
+	Older pages never change: they are cached (see chat.history_cache).
+	"""
+	try:
+		if before_msg_id != None:
+			before_msg_id = int(before_msg_id)
+	except ValueError:
+		raise ClientError("INVALID_CURSOR", "Unable to retrieve the messages. Try refreshing the browser.")
+	frame = room_history_cache.get(room.id, before_msg_id)
+	if frame != None:
+		return frame
+	try:
+		page = list(RoomChatMessage.objects.before(room, before_msg_id)[:DEFAULT_ROOM_CHAT_MESSAGE_PAGE_SIZE + 1])
+		has_next_page = len(page) > DEFAULT_ROOM_CHAT_MESSAGE_PAGE_SIZE
+		page = page[:DEFAULT_ROOM_CHAT_MESSAGE_PAGE_SIZE]
+
+		payload = {}
+		payload['messages_payload'] = "messages_payload"
+		s = LazyRoomChatMessageEncoder()
+		payload['messages'] = s.serialize(page)
+		payload['next_before_msg_id'] = str(page[-1].id) if has_next_page else None
+		frame = encode_frame(payload)
+		room_history_cache.set(room.id, before_msg_id, frame, page[0].timestamp if len(page) > 0 else None)
+		return frame
+	except Exception as e:
+		print("EXCEPTION: " + str(e))
+	return None
 
 
 @database_sync_to_async
-def get_room_chat_messages(room, page_number):
+def get_room_chat_messages_by_page_number(room, page_number):
+	"""
+	The page_number protocol, for clients loaded before before_msg_id existed. Same frame as before.
+	Pages shift when new messages arrive, so messages can be repeated. Does not COUNT(*) the room.
+	"""
 	try:
-		qs = RoomChatMessage.objects.by_room(room)
-		p = Paginator(qs, DEFAULT_ROOM_CHAT_MESSAGE_PAGE_SIZE)
+		new_page_number = int(page_number)
+		start = (new_page_number - 1) * DEFAULT_ROOM_CHAT_MESSAGE_PAGE_SIZE
+		page = list(RoomChatMessage.objects.before(room)[start:start + DEFAULT_ROOM_CHAT_MESSAGE_PAGE_SIZE])
 
 		payload = {}
-		messages_data = None
-		new_page_number = int(page_number)  
-		if new_page_number <= p.num_pages:
+		payload['messages_payload'] = "messages_payload"
+		if len(page) > 0:
 			new_page_number = new_page_number + 1
 			s = LazyRoomChatMessageEncoder()
-			payload['messages'] = s.serialize(p.page(page_number).object_list)
+			payload['messages'] = s.serialize(page)
 		else:
 			payload['messages'] = "None"
 		payload['new_page_number'] = new_page_number
-		return json.dumps(payload)
+		return encode_frame(payload)
 	except Exception as e:
 		print("EXCEPTION: " + str(e))
 	return None
 
 
 
+# The user is not in the room: make sure they have an unread "chat" notification
 @database_sync_to_async
-def connect_user(room, user):
-	# add user to connected_users list
-	account = Account.objects.get(pk=user.id)
-	return room.connect_user(account)
-
-
-@database_sync_to_async
-def disconnect_user(room, user):
-	# remove from connected_users list
-	account = Account.objects.get(pk=user.id)
-	return room.disconnect_user(account)
-
-
-# If the user is not connected to the chat, increment "unread messages" count
-@database_sync_to_async
-def append_unread_msg_if_not_connected(room, user, connected_users, message):
-	if not user in connected_users: 
-		try:
-			unread_msgs = UnreadChatRoomMessages.objects.get(room=room, user=user)
-			unread_msgs.most_recent_message = message
-			unread_msgs.count += 1
-			unread_msgs.save()
-		except UnreadChatRoomMessages.DoesNotExist:
-			UnreadChatRoomMessages(room=room, user=user, count=1).save()
-			pass
-	return
+def append_unread_msg(room, user, message):
+	notify_unread_message(room, user, message)
 
-# When a user connects, reset their unread message count
+# When a user joins or leaves the room, every message until now is read
 @database_sync_to_async
-def on_user_connected(room, user):
-	# confirm they are in the connected users list
-	connected_users = room.connected_users.all()
-	if user in connected_users:
-		try:
-			# reset count
-			unread_msgs = UnreadChatRoomMessages.objects.get(room=room, user=user)
-			unread_msgs.count = 0
-			unread_msgs.save()
-		except UnreadChatRoomMessages.DoesNotExist:
-			UnreadChatRoomMessages(room=room, user=user).save()
-			pass
-	return
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
+def on_user_read_room(room, user):
+	mark_room_read(room, user)
@@ -7,4 +7,13 @@ class ClientError(Exception):
         super().__init__(code)
         self.code = code
         if message:
-        	self.message = message
\ No newline at end of file
+        	self.message = message
+
+
+class RateLimitError(ClientError):
+    """
+    A message was rejected by chat.rate_limit. The client can send again in retry_after seconds.
+    """
+    def __init__(self, retry_after):
+        super().__init__("RATE_LIMITED", "You are sending messages too fast. Try again in a moment.")
+        self.retry_after = retry_after
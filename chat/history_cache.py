@@ -0,0 +1,121 @@
+"""
+Cache of encoded pages of chat history (RoomChatMessage and PublicRoomChatMessage).
+
+History is append-only: the page of messages sent before a given message (before_msg_id) never changes.
+Those pages are kept, encoded, in a size-bounded LRU of the process and, optionally, in a shared cache so the
+other processes don't query them either. Scrolling back through a room a second time does not touch the database.
+
+Pages that can still change are not cached:
+	1. The newest page (no before_msg_id).
+	2. Pages with a message younger than MIN_AGE: a message buffered by another process (see chat.write_behind)
+		may still be inserted in between.
+There is no invalidation: if deleting messages is ever added, the pages of the room must be dropped
+(Ex: put a per-room version in the key).
+
+settings.CHAT_HISTORY_CACHE
+	"MAX_BYTES": size of the LRU of each process (default 10MB)
+	"SHARED_CACHE": alias of a cache in settings.CACHES (Ex: "default") shared by the processes, or None (default)
+	"TIMEOUT": seconds a page is kept in the shared cache (default 1 day)
+	"MIN_AGE": seconds (default 60)
+
+Metrics (see ChatServerPlayground.metrics), <name> is the name of the cache:
+	<name>.hits, <name>.shared_hits, <name>.misses: counters
+	<name>.pages, <name>.bytes: gauges
+"""
+import threading
+from collections import OrderedDict
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import caches
+from django.utils import timezone
+
+from ChatServerPlayground import metrics
+from chat.constants import *
+
+
+def get_history_cache_setting(key, default):
+	return getattr(settings, "CHAT_HISTORY_CACHE", {}).get(key, default)
+
+
+class HistoryPageCache:
+
+	def __init__(self, name):
+		self.name = name
+		# key -> encoded frame, least recently used first
+		self.pages = OrderedDict()
+		self.num_bytes = 0
+		# Pages are read and written from the database threads (database_sync_to_async)
+		self.lock = threading.Lock()
+
+	@property
+	def shared_cache(self):
+		alias = get_history_cache_setting("SHARED_CACHE", None)
+		if alias == None:
+			return None
+		return caches[alias]
+
+	def get_key(self, room_id, before_msg_id):
+		# natural_timestamp ("today at...") depends on the day the page was encoded
+		return f"{self.name}:{room_id}:{before_msg_id}:{timezone.localdate().isoformat()}"
+
+	def get(self, room_id, before_msg_id):
+		"""
+		The encoded page, or None if it is not cached.
+		"""
+		if before_msg_id == None:
+			return None
+		key = self.get_key(room_id, before_msg_id)
+		with self.lock:
+			frame = self.pages.get(key)
+			if frame != None:
+				self.pages.move_to_end(key)
+		if frame != None:
+			metrics.increment(self.name + ".hits")
+			return frame
+
+		shared_cache = self.shared_cache
+		if shared_cache != None:
+			try:
+				frame = shared_cache.get(key)
+			except Exception as e:
+				# The database still has the page
+				print("EXCEPTION: " + self.name + ": shared cache: " + str(e))
+			if frame != None:
+				metrics.increment(self.name + ".shared_hits")
+				self.add(key, frame)
+				return frame
+		metrics.increment(self.name + ".misses")
+		return None
+
+	def set(self, room_id, before_msg_id, frame, newest_timestamp):
+		"""
+		Cache a page retrieved from the database, if it can't change anymore.
+		newest_timestamp: timestamp of the newest message of the page (None if the page is empty).
+		"""
+		if before_msg_id == None or newest_timestamp == None:
+			return
+		min_age = get_history_cache_setting("MIN_AGE", DEFAULT_HISTORY_CACHE_MIN_AGE)
+		if newest_timestamp > timezone.now() - timedelta(seconds=min_age):
+			return
+		key = self.get_key(room_id, before_msg_id)
+		self.add(key, frame)
+		shared_cache = self.shared_cache
+		if shared_cache != None:
+			try:
+				shared_cache.set(key, frame, get_history_cache_setting("TIMEOUT", DEFAULT_HISTORY_CACHE_TIMEOUT))
+			except Exception as e:
+				print("EXCEPTION: " + self.name + ": shared cache: " + str(e))
+
+	def add(self, key, frame):
+		max_bytes = get_history_cache_setting("MAX_BYTES", DEFAULT_HISTORY_CACHE_MAX_BYTES)
+		with self.lock:
+			if key in self.pages:
+				return
+			self.pages[key] = frame
+			self.num_bytes += len(frame)
+			while self.num_bytes > max_bytes:
+				key, frame = self.pages.popitem(last=False)
+				self.num_bytes -= len(frame)
+			metrics.gauge(self.name + ".pages", len(self.pages))
+			metrics.gauge(self.name + ".bytes", self.num_bytes)
@@ -0,0 +1,71 @@
+import json
+import timeit
+
+from django.core.management.base import BaseCommand
+
+from chat.base_consumer import encode_frame, orjson
+from chat.constants import *
+
+
+def get_history_frame(page_size):
+	"""
+	A frame like the one ChatConsumer sends for 'get_room_chat_messages' (see LazyRoomChatMessageEncoder).
+	"""
+	messages = []
+	for i in range(page_size):
+		messages.append({
+			'msg_type': MSG_TYPE_MESSAGE,
+			'msg_id': str(1000 + i),
+			'user_id': str(i % 2 + 1),
+			'username': "username" + str(i % 2 + 1),
+			'message': "Hey, did you see the message I sent you yesterday? " * 2,
+			'profile_image': "/media/profile_images/" + str(i % 2 + 1) + "/profile_image.png",
+			'natural_timestamp': "today at 10:56 AM",
+			'timestamp': 1602672960000 + i,
+		})
+	return {
+		"messages_payload": "messages_payload",
+		"messages": messages,
+		"next_before_msg_id": "1000",
+	}
+
+
+def encode_with_round_trip(frame):
+	"""
+	What the consumers used to do: json.dumps in the database helper, json.loads in the consumer, json.dumps in send_json.
+	"""
+	payload = json.loads(json.dumps({"messages": frame["messages"], "next_before_msg_id": frame["next_before_msg_id"]}))
+	return json.dumps({
+		"messages_payload": "messages_payload",
+		"messages": payload["messages"],
+		"next_before_msg_id": payload["next_before_msg_id"],
+	})
+
+
+class Command(BaseCommand):
+	help = "Time the encoding of one page of chat history: JSON round trip vs a single pre-encoded frame."
+
+	def add_arguments(self, parser):
+		parser.add_argument("--page-size", type=int, default=DEFAULT_ROOM_CHAT_MESSAGE_PAGE_SIZE)
+		parser.add_argument("--iterations", type=int, default=10000)
+
+	def handle(self, *args, **options):
+		frame = get_history_frame(options["page_size"])
+		iterations = options["iterations"]
+
+		results = [
+			("json round trip (before)", lambda: encode_with_round_trip(frame)),
+			("json, encoded once", lambda: json.dumps(frame)),
+		]
+		if orjson != None:
+			results.append(("orjson, encoded once (encode_frame)", lambda: encode_frame(frame)))
+		else:
+			self.stdout.write("orjson is not installed. encode_frame uses the json module.")
+
+		self.stdout.write(f"One page of {options['page_size']} messages ({len(encode_frame(frame))} bytes), {iterations} iterations:")
+		baseline = None
+		for name, function in results:
+			microseconds = timeit.timeit(function, number=iterations) / iterations * 1000000
+			if baseline == None:
+				baseline = microseconds
+			self.stdout.write(f"\t{name}: {microseconds:.1f} us per page ({baseline / microseconds:.1f}x)")
@@ -0,0 +1,26 @@
+# Generated by Django 2.2.15 on 2026-10-18 13:28
+
+from django.db import migrations, models
+
+from ChatServerPlayground.operations import AddIndexConcurrently
+
+
+class Migration(migrations.Migration):
+
+    # CREATE INDEX CONCURRENTLY can't run inside a transaction (PostgreSQL)
+    atomic = False
+
+    dependencies = [
+        ('chat', '0001_initial'),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name='roomchatmessage',
+            index=models.Index(fields=['room', '-timestamp'], name='chat_msg_room_ts_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='unreadchatroommessages',
+            index=models.Index(fields=['room', 'user'], name='chat_unread_room_user_idx'),
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 2.2.15 on 2026-10-18 16:02
+
+from django.db import migrations, models
+
+from ChatServerPlayground.operations import AddIndexConcurrently, RemoveIndexConcurrently
+
+
+class Migration(migrations.Migration):
+
+    # CREATE/DROP INDEX CONCURRENTLY can't run inside a transaction (PostgreSQL)
+    atomic = False
+
+    dependencies = [
+        ('chat', '0003_remove_connected_users'),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name='roomchatmessage',
+            index=models.Index(fields=['room', '-timestamp', '-id'], name='chat_msg_room_ts_id_idx'),
+        ),
+        RemoveIndexConcurrently(
+            model_name='roomchatmessage',
+            name='chat_msg_room_ts_idx',
+        ),
+    ]
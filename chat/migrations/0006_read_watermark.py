@@ -0,0 +1,28 @@
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+    """
+    UnreadChatRoomMessages becomes a read receipt: unread messages are counted from last_read_timestamp
+    instead of incrementing 'count' for every message.
+    """
+
+    dependencies = [
+        ('chat', '0005_message_timestamp_default'),
+    ]
+
+    operations = [
+        migrations.RenameField(
+            model_name='unreadchatroommessages',
+            old_name='reset_timestamp',
+            new_name='last_read_timestamp',
+        ),
+        migrations.RemoveField(
+            model_name='unreadchatroommessages',
+            name='count',
+        ),
+        migrations.RemoveField(
+            model_name='unreadchatroommessages',
+            name='most_recent_message',
+        ),
+    ]
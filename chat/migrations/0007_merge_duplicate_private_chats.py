@@ -0,0 +1,113 @@
+from django.conf import settings
+from django.core.cache import caches
+from django.db import migrations
+from django.db.models import F
+
+
+def merge_duplicate_private_chats(apps, schema_editor):
+    """
+    find_or_create_private_chat could create several rooms for the same two users (one per order of the users,
+    or two concurrent callers). Keep the oldest room of each pair and move everything of the others into it:
+        1. the messages
+        2. the "chat" notifications (the newest one per user is kept and now opens the kept room, the unread counters
+            and the 'sync' tombstones are updated for the others)
+        3. the read watermark: the oldest one, so no unread message is hidden
+    Then the user with the lowest id becomes user1 of every room (the canonical pair, see PrivateChatRoom.save).
+    If rooms were merged and CHAT_HISTORY_CACHE['SHARED_CACHE'] is set, that cache is cleared: cached pages of the
+    kept rooms miss the moved messages. (The per-process cache is empty since the servers restart after migrating.)
+    """
+    PrivateChatRoom = apps.get_model('chat', 'PrivateChatRoom')
+    RoomChatMessage = apps.get_model('chat', 'RoomChatMessage')
+    UnreadChatRoomMessages = apps.get_model('chat', 'UnreadChatRoomMessages')
+    Notification = apps.get_model('notification', 'Notification')
+    NotificationCounter = apps.get_model('notification', 'NotificationCounter')
+    RemovedNotification = apps.get_model('notification', 'RemovedNotification')
+    ContentType = apps.get_model('contenttypes', 'ContentType')
+    content_type = ContentType.objects.filter(app_label='chat', model='unreadchatroommessages').first()
+
+    # (low user id, high user id) -> rooms, oldest first
+    pairs = {}
+    for room in PrivateChatRoom.objects.order_by('id'):
+        pair = (min(room.user1_id, room.user2_id), max(room.user1_id, room.user2_id))
+        pairs.setdefault(pair, []).append(room)
+
+    merged = False
+    for rooms in pairs.values():
+        if len(rooms) == 1:
+            continue
+        merged = True
+        room, duplicates = rooms[0], rooms[1:]
+        duplicate_ids = [duplicate.id for duplicate in duplicates]
+        RoomChatMessage.objects.filter(room_id__in=duplicate_ids).update(room_id=room.id)
+        if any([duplicate.is_active for duplicate in duplicates]) and not room.is_active:
+            room.is_active = True
+            room.save(update_fields=['is_active'])
+
+        for user_id in set([room.user1_id, room.user2_id]):
+            unread_msgs = list(UnreadChatRoomMessages.objects.filter(room_id__in=[room.id] + duplicate_ids, user_id=user_id).order_by('id'))
+            if len(unread_msgs) == 0:
+                continue
+            kept = [unread for unread in unread_msgs if unread.room_id == room.id]
+            kept = kept[0] if len(kept) > 0 else unread_msgs[0]
+            kept.room_id = room.id
+            kept.last_read_timestamp = min([unread.last_read_timestamp for unread in unread_msgs])
+            kept.save(update_fields=['room', 'last_read_timestamp'])
+            others = [unread.id for unread in unread_msgs if unread.id != kept.id]
+
+            if content_type != None:
+                notifications = list(Notification.objects.filter(
+                    target_id=user_id, content_type_id=content_type.id, object_id__in=[kept.id] + others,
+                ).order_by('-timestamp', '-id'))
+                if len(notifications) > 0:
+                    newest, removed = notifications[0], notifications[1:]
+                    # Same URL as chat.utils.notify_unread_message
+                    redirect_url = f"{settings.BASE_URL}/chat/?room_id={room.id}"
+                    if newest.object_id != kept.id or newest.redirect_url != redirect_url:
+                        newest.object_id = kept.id
+                        newest.redirect_url = redirect_url
+                        update_fields = ['object_id', 'redirect_url']
+                        counter = NotificationCounter.objects.filter(user_id=user_id).first()
+                        if counter != None:
+                            # A new version: the 'sync' command sends the new URL to the open tabs
+                            counter.version += 1
+                            counter.save(update_fields=['version'])
+                            newest.version = counter.version
+                            update_fields.append('version')
+                        newest.save(update_fields=update_fields)
+                    for notification in removed:
+                        counter = NotificationCounter.objects.filter(user_id=user_id).first()
+                        if counter != None:
+                            counter.version += 1
+                            if not notification.read:
+                                counter.unread_chat_count = F('unread_chat_count') - 1
+                            counter.save(update_fields=['version', 'unread_chat_count'])
+                            RemovedNotification.objects.create(
+                                target_id=user_id,
+                                notification_id=notification.id,
+                                category='chat',
+                                version=counter.version,
+                            )
+                        notification.delete()
+            UnreadChatRoomMessages.objects.filter(id__in=others).delete()
+
+        PrivateChatRoom.objects.filter(id__in=duplicate_ids).delete()
+
+    if merged:
+        alias = getattr(settings, 'CHAT_HISTORY_CACHE', {}).get('SHARED_CACHE', None)
+        if alias != None:
+            caches[alias].clear()
+
+    PrivateChatRoom.objects.filter(user1_id__gt=F('user2_id')).update(user1_id=F('user2_id'), user2_id=F('user1_id'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('notification', '0004_sync_version'),
+        ('chat', '0006_read_watermark'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicate_private_chats, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 2.2.15 on 2026-10-18 14:10
+
+from django.db import migrations, models
+import django.db.models.expressions
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0007_merge_duplicate_private_chats'),
+    ]
+
+    operations = [
+        migrations.AddConstraint(
+            model_name='privatechatroom',
+            constraint=models.UniqueConstraint(fields=('user1', 'user2'), name='chat_room_user_pair_unique'),
+        ),
+        migrations.AddConstraint(
+            model_name='privatechatroom',
+            constraint=models.CheckConstraint(check=models.Q(user1__lte=django.db.models.expressions.F('user2')), name='chat_room_user_pair_ordered'),
+        ),
+    ]
@@ -0,0 +1,62 @@
+# Generated by Django 2.2.15 on 2026-10-18 14:12
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+from django.db.models import OuterRef, Subquery
+from django.db.models.functions import Substr
+
+from ChatServerPlayground.operations import AddIndexConcurrently
+
+
+def fill_last_message(apps, schema_editor):
+    """
+    One UPDATE: the newest message of every room.
+    """
+    PrivateChatRoom = apps.get_model('chat', 'PrivateChatRoom')
+    RoomChatMessage = apps.get_model('chat', 'RoomChatMessage')
+    newest = RoomChatMessage.objects.filter(room=OuterRef('pk')).order_by('-timestamp', '-id')
+    PrivateChatRoom.objects.filter(pk__in=RoomChatMessage.objects.values('room')).update(
+        last_message_at=Subquery(newest.values('timestamp')[:1]),
+        last_message_preview=Subquery(newest.annotate(preview=Substr('content', 1, 100)).values('preview')[:1]),
+        last_sender=Subquery(newest.values('user')[:1]),
+    )
+
+
+class Migration(migrations.Migration):
+
+    # CREATE INDEX CONCURRENTLY can't run inside a transaction (PostgreSQL)
+    atomic = False
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('chat', '0008_private_chat_pair_unique'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='privatechatroom',
+            name='last_message_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='privatechatroom',
+            name='last_message_preview',
+            field=models.CharField(blank=True, default='', max_length=100),
+        ),
+        migrations.AddField(
+            model_name='privatechatroom',
+            name='last_sender',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL),
+        ),
+        # Filled before the indexes are built: the UPDATE doesn't have to maintain them
+        migrations.RunPython(fill_last_message, migrations.RunPython.noop),
+        AddIndexConcurrently(
+            model_name='privatechatroom',
+            index=models.Index(condition=models.Q(is_active=True), fields=['user1', '-last_message_at', '-id'], name='chat_room_user1_inbox_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='privatechatroom',
+            index=models.Index(condition=models.Q(is_active=True), fields=['user2', '-last_message_at', '-id'], name='chat_room_user2_inbox_idx'),
+        ),
+    ]
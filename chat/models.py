@@ -1,46 +1,51 @@
 from django.conf import settings
 from django.db import models
+from django.db.models import F, Q, Subquery
 from django.utils import timezone
 from django.contrib.contenttypes.fields import GenericRelation
 from django.contrib.contenttypes.models import ContentType
-from django.db.models.signals import post_save, pre_save
+from django.db.models.signals import post_save
 from django.dispatch import receiver
 from django.utils import timezone
 
 from notification.models import Notification
+from chat.constants import INBOX_MESSAGE_PREVIEW_LENGTH
 
 class PrivateChatRoom(models.Model):
 	"""
 	A private room for people to chat in.
+	There is one room per pair of users: user1 is the user with the lowest id (see save and find_or_create_private_chat).
 	"""
 	user1               = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name="user1")
 	user2               = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name="user2")
 
-	# Users who are currently connected to the socket (Used to keep track of unread messages)
-	connected_users     = models.ManyToManyField(settings.AUTH_USER_MODEL, blank=True, related_name="connected_users")
+	# Users who are currently connected to the room are tracked by chat.presence (Used to keep track of unread messages)
 
 	is_active 			= models.BooleanField(default=False)
 
-	def connect_user(self, user):
-		"""
-		return true if user is added to the connected_users list
-		"""
-		is_user_added = False
-		if not user in self.connected_users.all():
-			self.connected_users.add(user)
-			is_user_added = True
-		return is_user_added 
-
+	# The newest stored message, for the inbox (see chat.views.get_recent_chatroom_messages).
+	# Updated when messages are stored (see chat.utils.update_last_messages). None if the room has no messages.
+	last_message_at		= models.DateTimeField(null=True, blank=True)
+	last_message_preview	= models.CharField(max_length=INBOX_MESSAGE_PREVIEW_LENGTH, blank=True, default="")
+	last_sender			= models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.SET_NULL, null=True, blank=True, related_name="+")
+
+	class Meta:
+		constraints = [
+			# Also the index of the lookup of a pair
+			models.UniqueConstraint(fields=['user1', 'user2'], name='chat_room_user_pair_unique'),
+			models.CheckConstraint(check=Q(user1__lte=F('user2')), name='chat_room_user_pair_ordered'),
+		]
+		indexes = [
+			# The inbox of a user: their active rooms, most recent message first
+			models.Index(fields=['user1', '-last_message_at', '-id'], name='chat_room_user1_inbox_idx', condition=Q(is_active=True)),
+			models.Index(fields=['user2', '-last_message_at', '-id'], name='chat_room_user2_inbox_idx', condition=Q(is_active=True)),
+		]
 
-	def disconnect_user(self, user):
-		"""
-		return true if user is removed from connected_users list
-		"""
-		is_user_removed = False
-		if user in self.connected_users.all():
-			self.connected_users.remove(user)
-			is_user_removed = True
-		return is_user_removed
+	def save(self, *args, **kwargs):
+		# Canonical pair: whatever order the users are given in
+		if self.user1_id > self.user2_id:
+			self.user1, self.user2 = self.user2, self.user1
+		return super(PrivateChatRoom, self).save(*args, **kwargs)
 
 	@property
 	def group_name(self):
@@ -53,7 +58,20 @@ class PrivateChatRoom(models.Model):
 
 class RoomChatMessageManager(models.Manager):
 	def by_room(self, room):
-		qs = RoomChatMessage.objects.filter(room=room).order_by("-timestamp")
+		qs = RoomChatMessage.objects.filter(room=room).order_by("-timestamp", "-id")
+		return qs
+
+	def before(self, room, before_msg_id=None):
+		"""
+		Messages of the room sent before the message `before_msg_id` (all of them if it is None), newest first.
+		Keyset pagination: slice it to get a page. (timestamp, id) is compared, so messages sent in the same
+		instant are not skipped.
+		"""
+		qs = self.by_room(room).select_related("user")
+		if before_msg_id != None:
+			cursor = Subquery(RoomChatMessage.objects.filter(room=room, pk=before_msg_id).values("timestamp")[:1])
+			# timestamp__lte bounds the index range scan, the Q picks the rows before the cursor in it
+			qs = qs.filter(timestamp__lte=cursor).filter(Q(timestamp__lt=cursor) | Q(id__lt=before_msg_id))
 		return qs
 
 class RoomChatMessage(models.Model):
@@ -62,11 +80,18 @@ class RoomChatMessage(models.Model):
 	"""
 	user                = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
 	room                = models.ForeignKey(PrivateChatRoom, on_delete=models.CASCADE)
-	timestamp           = models.DateTimeField(auto_now_add=True)
+	# Set when the message is sent (not when it is inserted, see chat.write_behind)
+	timestamp           = models.DateTimeField(default=timezone.now, editable=False)
 	content             = models.TextField(unique=False, blank=False,)
 
 	objects = RoomChatMessageManager()
 
+	class Meta:
+		indexes = [
+			# RoomChatMessage.objects.by_room(room) and .before(room, before_msg_id), the newest message of a room
+			models.Index(fields=['room', '-timestamp', '-id'], name='chat_msg_room_ts_id_idx'),
+		]
+
 	def __str__(self):
 		return self.content
 
@@ -74,31 +99,41 @@ class RoomChatMessage(models.Model):
 
 class UnreadChatRoomMessages(models.Model):
 	"""
-	Keep track of the number of unread messages by a specific user in a specific private chat.
-	When the user connects the chat room, the messages will be considered "read" and 'count' will be set to 0.
+	Read receipt of a specific user in a specific private chat: the messages sent after last_read_timestamp are unread.
+	Written once per read (when the user joins or leaves the room), never once per message: the number of unread
+	messages is counted from the messages themselves (see get_unread_count).
+	Always change it with chat.utils.notify_unread_message and chat.utils.mark_room_read:
+	they also keep the "chat" Notification of the user up to date.
 	"""
 	room                = models.ForeignKey(PrivateChatRoom, on_delete=models.CASCADE, related_name="room")
 
 	user                = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
 
-	count               = models.IntegerField(default=0)
-
-	most_recent_message = models.CharField(max_length=500, blank=True, null=True)
-
-	# last time msgs were read by the user
-	reset_timestamp     = models.DateTimeField()
+	# Last time msgs were read by the user (the timestamp of a message is when it was sent, see RoomChatMessage)
+	last_read_timestamp = models.DateTimeField()
 
 	notifications       = GenericRelation(Notification)
 
+	class Meta:
+		indexes = [
+			# Every message sent to an absent user looks up (room, user)
+			models.Index(fields=['room', 'user'], name='chat_unread_room_user_idx'),
+		]
 
 	def __str__(self):
 		return f"Messages that {str(self.user.username)} has not read yet."
 
 	def save(self, *args, **kwargs):
 		if not self.id: # if just created, add a timestamp. Otherwise do not automatically change it ever.
-			self.reset_timestamp = timezone.now()
+			self.last_read_timestamp = timezone.now()
 		return super(UnreadChatRoomMessages, self).save(*args, **kwargs)
 
+	def get_unread_count(self):
+		"""
+		Messages of the other user sent after the last read. One range scan of chat_msg_room_ts_id_idx.
+		"""
+		return RoomChatMessage.objects.filter(room_id=self.room_id, timestamp__gt=self.last_read_timestamp).exclude(user_id=self.user_id).count()
+
 	@property
 	def get_cname(self):
 		"""
@@ -120,73 +155,9 @@ class UnreadChatRoomMessages(models.Model):
 @receiver(post_save, sender=PrivateChatRoom)
 def create_unread_chatroom_messages_obj(sender, instance, created, **kwargs):
 	if created:
-		unread_msgs1 = UnreadChatRoomMessages(room=instance, user=instance.user1)
-		unread_msgs1.save()
-
-		unread_msgs2 = UnreadChatRoomMessages(room=instance, user=instance.user2)
-		unread_msgs2.save()
-
-
-
-@receiver(pre_save, sender=UnreadChatRoomMessages)
-def increment_unread_msg_count(sender, instance, **kwargs):
-	"""
-	When the unread message count increases, update the notification. 
-	If one does not exist, create one. (This should never happen)
-	"""
-	if instance.id is None: # new object will be created
-		pass # create_unread_chatroom_messages_obj will handle this scenario
-	else:
-		previous = UnreadChatRoomMessages.objects.get(id=instance.id)
-		if previous.count < instance.count: # if count is incremented
-			content_type = ContentType.objects.get_for_model(instance)
-			if instance.user == instance.room.user1:
-				other_user = instance.room.user2
-			else:
-				other_user = instance.room.user1
-			try:
-				notification = Notification.objects.get(target=instance.user, content_type=content_type, object_id=instance.id)
-				notification.verb = instance.most_recent_message
-				notification.timestamp = timezone.now()
-				notification.save()
-			except Notification.DoesNotExist:
-				instance.notifications.create(
-					target=instance.user,
-					from_user=other_user,
-					redirect_url=f"{settings.BASE_URL}/chat/?room_id={instance.room.id}", # we want to go to the chatroom
-					verb=instance.most_recent_message,
-					content_type=content_type,
-				)
-
-
-@receiver(pre_save, sender=UnreadChatRoomMessages)
-def remove_unread_msg_count_notification(sender, instance, **kwargs):
-	"""
-	If the unread messge count decreases, it means the user joined the chat. So delete the notification.
-	"""
-	if instance.id is None: # new object will be created
-		pass # create_unread_chatroom_messages_obj will handle this scenario
-	else:
-		previous = UnreadChatRoomMessages.objects.get(id=instance.id)
-		if previous.count > instance.count: # if count is decremented
-			content_type = ContentType.objects.get_for_model(instance)
-			try:
-				notification = Notification.objects.get(target=instance.user, content_type=content_type, object_id=instance.id)
-				notification.delete()
-			except Notification.DoesNotExist:
-				pass
-				# Do nothing
-
-
-
-
-
-
-
-
-
-
-
-
-
-
+		# One INSERT for both (bulk_create skips UnreadChatRoomMessages.save: set the timestamp here)
+		now = timezone.now()
+		UnreadChatRoomMessages.objects.bulk_create([
+			UnreadChatRoomMessages(room=instance, user_id=instance.user1_id, last_read_timestamp=now),
+			UnreadChatRoomMessages(room=instance, user_id=instance.user2_id, last_read_timestamp=now),
+		])
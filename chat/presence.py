@@ -0,0 +1,207 @@
+"""
+Who is connected to a chat room right now (PrivateChatRoom and PublicChatRoom).
+
+Presence is tracked per connection (socket), so a user with the room open in several tabs stays present until the
+last one leaves. Every connection sends a heartbeat (see BaseJsonConsumer.enter_presence). A connection that
+stops sending them (Ex: its worker crashed and 'disconnect' never ran) expires after PRESENCE['TTL'] seconds.
+
+settings.PRESENCE
+	"BACKEND":
+		"chat.presence.InMemoryPresenceBackend" (default): only correct when every socket is served by one process.
+		"chat.presence.RedisPresenceBackend": shared by every process. Requires aioredis.
+	"CONFIG": keyword arguments of the backend. Ex: {"address": "redis://127.0.0.1:6379"}
+	"TTL": seconds before a connection without heartbeat expires (default 60)
+	"HEARTBEAT_INTERVAL": seconds between heartbeats (default 20)
+
+is_present and count are O(1). Expired connections are removed before every read and when a connection joins or
+sends a heartbeat, so a crashed worker's users are not counted after TTL seconds even in a quiet room.
+"""
+import asyncio
+import time
+from collections import deque
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from chat.constants import *
+
+
+class InMemoryPresenceBackend:
+
+	def __init__(self, ttl):
+		self.ttl = ttl
+		# room_key -> {user_id: {connection_id: expires_at}}
+		self.rooms = {}
+		# room_key -> deque of (expires_at, user_id, connection_id), oldest first (the TTL is the same for everyone).
+		# A heartbeat appends a new entry: the old one no longer matches rooms and is skipped when it expires.
+		self.expiries = {}
+
+	async def join(self, room_key, user_id, connection_id):
+		self.remove_expired(room_key)
+		expires_at = time.time() + self.ttl
+		connections = self.rooms.setdefault(room_key, {}).setdefault(user_id, {})
+		connections[connection_id] = expires_at
+		self.expiries.setdefault(room_key, deque()).append((expires_at, user_id, connection_id))
+
+	async def heartbeat(self, room_key, user_id, connection_id):
+		await self.join(room_key, user_id, connection_id)
+
+	async def leave(self, room_key, user_id, connection_id):
+		users = self.rooms.get(room_key, {})
+		connections = users.get(user_id, {})
+		connections.pop(connection_id, None)
+		if len(connections) == 0:
+			users.pop(user_id, None)
+		if len(users) == 0:
+			self.rooms.pop(room_key, None)
+			self.expiries.pop(room_key, None)
+
+	async def is_present(self, room_key, user_id):
+		self.remove_expired(room_key)
+		return user_id in self.rooms.get(room_key, {})
+
+	async def count(self, room_key):
+		"""
+		Number of users (not connections) in the room.
+		"""
+		self.remove_expired(room_key)
+		return len(self.rooms.get(room_key, {}))
+
+	def remove_expired(self, room_key):
+		"""
+		Only looks at the oldest entries of the room: O(1) unless connections expired (each one is removed once).
+		"""
+		expiries = self.expiries.get(room_key)
+		if expiries == None:
+			return
+		now = time.time()
+		users = self.rooms.get(room_key, {})
+		while len(expiries) > 0 and expiries[0][0] < now:
+			expires_at, user_id, connection_id = expiries.popleft()
+			connections = users.get(user_id, {})
+			if connections.get(connection_id) != expires_at:
+				# Refreshed by a heartbeat since, or already gone
+				continue
+			del connections[connection_id]
+			if len(connections) == 0:
+				del users[user_id]
+		if len(users) == 0:
+			self.rooms.pop(room_key, None)
+			self.expiries.pop(room_key, None)
+
+
+"""
+Redis keys of a room:
+	presence:<room_key>:connections: sorted set of "<user_id>:<connection_id>" scored by expiry time
+	presence:<room_key>:users: hash of user_id -> number of connections
+Both expire if the room gets no heartbeat for TTL seconds.
+"""
+REMOVE_EXPIRED_SCRIPT = """
+local expired = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1])
+for _, member in ipairs(expired) do
+	redis.call('ZREM', KEYS[1], member)
+	local user_id = string.match(member, '^([^:]+):')
+	if redis.call('HINCRBY', KEYS[2], user_id, -1) <= 0 then
+		redis.call('HDEL', KEYS[2], user_id)
+	end
+end
+"""
+
+# KEYS: connections, users. ARGV: now, member, user_id, expires_at, ttl
+JOIN_SCRIPT = REMOVE_EXPIRED_SCRIPT + """
+if redis.call('ZADD', KEYS[1], ARGV[4], ARGV[2]) == 1 then
+	redis.call('HINCRBY', KEYS[2], ARGV[3], 1)
+end
+redis.call('EXPIRE', KEYS[1], ARGV[5])
+redis.call('EXPIRE', KEYS[2], ARGV[5])
+"""
+
+# KEYS: connections, users. ARGV: now, user_id
+IS_PRESENT_SCRIPT = REMOVE_EXPIRED_SCRIPT + """
+return redis.call('HEXISTS', KEYS[2], ARGV[2])
+"""
+
+# KEYS: connections, users. ARGV: now
+COUNT_SCRIPT = REMOVE_EXPIRED_SCRIPT + """
+return redis.call('HLEN', KEYS[2])
+"""
+
+# KEYS: connections, users. ARGV: member, user_id
+LEAVE_SCRIPT = """
+if redis.call('ZREM', KEYS[1], ARGV[1]) == 1 then
+	if redis.call('HINCRBY', KEYS[2], ARGV[2], -1) <= 0 then
+		redis.call('HDEL', KEYS[2], ARGV[2])
+	end
+end
+"""
+
+
+class RedisPresenceBackend:
+
+	def __init__(self, ttl, address="redis://127.0.0.1:6379", prefix="presence"):
+		self.ttl = ttl
+		self.address = address
+		self.prefix = prefix
+		# One connection pool per event loop (aioredis pools can't be shared between loops)
+		self.pools = {}
+
+	async def get_connection(self):
+		import aioredis
+		loop = asyncio.get_event_loop()
+		if loop not in self.pools:
+			self.pools[loop] = await aioredis.create_redis_pool(self.address)
+		return self.pools[loop]
+
+	def get_keys(self, room_key):
+		return [f"{self.prefix}:{room_key}:connections", f"{self.prefix}:{room_key}:users"]
+
+	async def join(self, room_key, user_id, connection_id):
+		redis = await self.get_connection()
+		now = time.time()
+		await redis.eval(
+			JOIN_SCRIPT,
+			keys=self.get_keys(room_key),
+			args=[now, f"{user_id}:{connection_id}", user_id, now + self.ttl, int(self.ttl)],
+		)
+
+	async def heartbeat(self, room_key, user_id, connection_id):
+		await self.join(room_key, user_id, connection_id)
+
+	async def leave(self, room_key, user_id, connection_id):
+		redis = await self.get_connection()
+		await redis.eval(
+			LEAVE_SCRIPT,
+			keys=self.get_keys(room_key),
+			args=[f"{user_id}:{connection_id}", user_id],
+		)
+
+	async def is_present(self, room_key, user_id):
+		redis = await self.get_connection()
+		return bool(await redis.eval(IS_PRESENT_SCRIPT, keys=self.get_keys(room_key), args=[time.time(), user_id]))
+
+	async def count(self, room_key):
+		redis = await self.get_connection()
+		return await redis.eval(COUNT_SCRIPT, keys=self.get_keys(room_key), args=[time.time()])
+
+
+_presence = None
+
+
+def get_presence():
+	"""
+	The presence backend configured by settings.PRESENCE. Created once per process.
+	"""
+	global _presence
+	if _presence == None:
+		config = getattr(settings, "PRESENCE", {})
+		backend = import_string(config.get("BACKEND", "chat.presence.InMemoryPresenceBackend"))
+		_presence = backend(ttl=get_presence_ttl(), **config.get("CONFIG", {}))
+	return _presence
+
+
+def get_presence_ttl():
+	return getattr(settings, "PRESENCE", {}).get("TTL", DEFAULT_PRESENCE_TTL)
+
+
+def get_presence_heartbeat_interval():
+	return getattr(settings, "PRESENCE", {}).get("HEARTBEAT_INTERVAL", DEFAULT_PRESENCE_HEARTBEAT_INTERVAL)
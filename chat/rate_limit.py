@@ -0,0 +1,173 @@
+"""
+Token-bucket limits on the messages sent to chat rooms (PrivateChatRoom and PublicChatRoom).
+
+A message is only sent if a token can be taken from each of these buckets:
+	1. the connection (socket) that sends it. Always kept in memory by the consumer.
+	2. the user that sends it, whatever the connection.
+	3. the room it is sent to, whoever sends it.
+A bucket holds up to BURST tokens and gets RATE tokens per second. Limits are checked before any database work.
+A rejected message takes no token: the client is told how many seconds to wait (see RateLimitError).
+
+settings.CHAT_RATE_LIMIT
+	"BACKEND": where the user and room buckets are kept
+		"chat.rate_limit.InMemoryRateLimitBackend" (default): per process. With N processes a user can send N times more.
+		"chat.rate_limit.RedisRateLimitBackend": shared by every process. Requires aioredis.
+	"CONFIG": keyword arguments of the backend. Ex: {"address": "redis://127.0.0.1:6379"}
+	"CONNECTION", "USER", "ROOM": {"RATE": tokens per second, "BURST": tokens}, or None for no limit.
+
+Metrics (see ChatServerPlayground.metrics):
+	chat.rate_limited.connection, chat.rate_limited.user_or_room: counters
+"""
+import asyncio
+import time
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from chat.constants import *
+
+
+class TokenBucket:
+
+	def __init__(self, rate, burst):
+		self.rate = rate
+		self.burst = burst
+		self.tokens = burst
+		self.updated_at = time.time()
+
+	def get_wait(self, now):
+		"""
+		Seconds before a token can be taken. 0 if one can be taken now.
+		"""
+		if now > self.updated_at:
+			self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+			self.updated_at = now
+		if self.tokens >= 1:
+			return 0
+		return (1 - self.tokens) / self.rate
+
+	def take(self):
+		self.tokens -= 1
+
+
+class InMemoryRateLimitBackend:
+
+	def __init__(self):
+		# key -> TokenBucket
+		self.buckets = {}
+		self.cleaned_at = time.time()
+
+	async def acquire(self, limits):
+		"""
+		limits: list of (key, rate, burst).
+		Takes a token from every bucket and returns 0, or takes none and returns the seconds to wait.
+		"""
+		now = time.time()
+		buckets = []
+		for key, rate, burst in limits:
+			bucket = self.buckets.get(key)
+			if bucket == None or bucket.rate != rate or bucket.burst != burst:
+				bucket = self.buckets[key] = TokenBucket(rate, burst)
+			buckets.append(bucket)
+		wait = max([bucket.get_wait(now) for bucket in buckets] + [0])
+		if wait == 0:
+			for bucket in buckets:
+				bucket.take()
+		self.remove_full_buckets(now)
+		return wait
+
+	def remove_full_buckets(self, now):
+		# A full bucket is the same as no bucket. Removing them once in a while keeps memory bounded.
+		if now - self.cleaned_at < RATE_LIMIT_CLEANUP_INTERVAL:
+			return
+		self.cleaned_at = now
+		for key, bucket in list(self.buckets.items()):
+			if bucket.tokens + (now - bucket.updated_at) * bucket.rate >= bucket.burst:
+				del self.buckets[key]
+
+
+"""
+Redis keys: <prefix>:<key> is a hash with the tokens of the bucket and when they were counted.
+It expires once the bucket would be full again.
+"""
+# KEYS: buckets. ARGV: now, then the rate and burst of each bucket
+ACQUIRE_SCRIPT = """
+local now = tonumber(ARGV[1])
+local wait = 0
+local tokens = {}
+for i, key in ipairs(KEYS) do
+	local rate = tonumber(ARGV[i * 2])
+	local burst = tonumber(ARGV[i * 2 + 1])
+	local bucket = redis.call('HMGET', key, 'tokens', 'updated_at')
+	local available = burst
+	if bucket[1] then
+		available = math.min(burst, tonumber(bucket[1]) + (now - tonumber(bucket[2])) * rate)
+	end
+	if available < 1 then
+		wait = math.max(wait, (1 - available) / rate)
+	end
+	tokens[i] = available
+end
+if wait == 0 then
+	for i, key in ipairs(KEYS) do
+		local rate = tonumber(ARGV[i * 2])
+		local burst = tonumber(ARGV[i * 2 + 1])
+		redis.call('HSET', key, 'tokens', tokens[i] - 1, 'updated_at', now)
+		redis.call('EXPIRE', key, math.ceil(burst / rate) + 1)
+	end
+end
+return tostring(wait)
+"""
+
+
+class RedisRateLimitBackend:
+
+	def __init__(self, address="redis://127.0.0.1:6379", prefix="rate_limit"):
+		self.address = address
+		self.prefix = prefix
+		# One connection pool per event loop (aioredis pools can't be shared between loops)
+		self.pools = {}
+
+	async def get_connection(self):
+		import aioredis
+		loop = asyncio.get_event_loop()
+		if loop not in self.pools:
+			self.pools[loop] = await aioredis.create_redis_pool(self.address)
+		return self.pools[loop]
+
+	async def acquire(self, limits):
+		redis = await self.get_connection()
+		args = [time.time()]
+		for key, rate, burst in limits:
+			args += [rate, burst]
+		wait = await redis.eval(
+			ACQUIRE_SCRIPT,
+			keys=[f"{self.prefix}:{key}" for key, rate, burst in limits],
+			args=args,
+		)
+		return float(wait)
+
+
+_rate_limiter = None
+
+
+def get_rate_limiter():
+	"""
+	The backend configured by settings.CHAT_RATE_LIMIT. Created once per process.
+	"""
+	global _rate_limiter
+	if _rate_limiter == None:
+		config = getattr(settings, "CHAT_RATE_LIMIT", {})
+		backend = import_string(config.get("BACKEND", "chat.rate_limit.InMemoryRateLimitBackend"))
+		_rate_limiter = backend(**config.get("CONFIG", {}))
+	return _rate_limiter
+
+
+def get_rate_limit(name):
+	"""
+	(rate, burst) of the "CONNECTION", "USER" or "ROOM" buckets, or None if they are not limited.
+	"""
+	limit = getattr(settings, "CHAT_RATE_LIMIT", {}).get(name, DEFAULT_RATE_LIMITS[name])
+	if limit == None:
+		return None
+	return (limit["RATE"], limit["BURST"])
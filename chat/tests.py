@@ -1,3 +1,881 @@
-from django.test import TestCase
+import asyncio
+import itertools
+import time
+from collections import deque
+from datetime import timedelta
+from unittest import mock, skipIf
 
-# Create your tests here.
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.db import IntegrityError, connection, transaction
+from django.db.migrations.executor import MigrationExecutor
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+
+from ChatServerPlayground import metrics
+from ChatServerPlayground.test_utils import create_account, explain
+from channels.db import database_sync_to_async
+from chat.base_consumer import BaseJsonConsumer, decode_frame
+from chat.constants import MSG_TYPE_MESSAGE, SLOW_CONSUMER_CLOSE_CODE
+from chat.presence import InMemoryPresenceBackend
+from chat.rate_limit import InMemoryRateLimitBackend
+from chat.history_cache import HistoryPageCache
+from chat.models import PrivateChatRoom, RoomChatMessage, UnreadChatRoomMessages
+from chat.utils import find_or_create_private_chat, notify_unread_message, mark_room_read, get_epoch_timestamp, from_epoch_timestamp, calculate_timestamp
+from chat.consumers import ChatConsumer, room_chat_message_buffer, get_room_chat_messages, get_room_chat_messages_by_page_number
+from chat.exceptions import ClientError
+from chat.write_behind import MessageWriteBuffer, buffers, flush_buffers_on_exit
+from chat.views import get_recent_chatroom_messages, get_inbox_branches, get_inbox_rooms
+from friend.graph import friend_graph
+from friend.models import FriendList
+from notification.models import Notification, NotificationCounter
+from notification.utils import get_chat_notification_content_type
+
+
+class ChatIndexTestCase(TestCase):
+	"""
+	The queries run by ChatConsumer must use the composite indexes on RoomChatMessage and UnreadChatRoomMessages.
+	"""
+
+	def setUp(self):
+		self.user1 = create_account("user1")
+		self.user2 = create_account("user2")
+		self.room = find_or_create_private_chat(self.user1, self.user2)
+
+	def test_room_chat_messages(self):
+		plan = explain(RoomChatMessage.objects.by_room(self.room)[:10])
+		self.assertIn("chat_msg_room_ts_id_idx", plan)
+
+	def test_room_chat_messages_before(self):
+		plan = explain(RoomChatMessage.objects.before(self.room, 100)[:11])
+		self.assertIn("chat_msg_room_ts_id_idx", plan)
+
+	def test_unread_chat_room_messages(self):
+		plan = explain(UnreadChatRoomMessages.objects.filter(room=self.room, user=self.user1))
+		self.assertIn("chat_unread_room_user_idx", plan)
+
+	def test_unread_count(self):
+		plan = explain(RoomChatMessage.objects.filter(room=self.room, timestamp__gt=timezone.now()).exclude(user=self.user1))
+		self.assertIn("chat_msg_room_ts_id_idx", plan)
+
+	def test_private_chat_of_pair(self):
+		plan = explain(PrivateChatRoom.objects.filter(user1=self.user1, user2=self.user2))
+		# SQLite gives the index of a unique constraint its own name
+		self.assertRegex(plan, "chat_room_user_pair_unique|sqlite_autoindex_chat_privatechatroom")
+
+
+class PrivateChatRoomPairTestCase(TestCase):
+	"""
+	There is a single room per pair of users, found with one query whatever the order of the users.
+	"""
+
+	def setUp(self):
+		self.user1 = create_account("user1")
+		self.user2 = create_account("user2")
+
+	def test_find_or_create_in_either_order(self):
+		room = find_or_create_private_chat(self.user2, self.user1)
+		self.assertEqual((room.user1_id, room.user2_id), (self.user1.id, self.user2.id))
+		with self.assertNumQueries(1):
+			self.assertEqual(find_or_create_private_chat(self.user1, self.user2), room)
+		with self.assertNumQueries(1):
+			self.assertEqual(find_or_create_private_chat(self.user2, self.user1), room)
+
+	def test_pair_is_unique(self):
+		PrivateChatRoom.objects.create(user1=self.user2, user2=self.user1)
+		with self.assertRaises(IntegrityError):
+			with transaction.atomic():
+				PrivateChatRoom.objects.create(user1=self.user1, user2=self.user2)
+		self.assertEqual(PrivateChatRoom.objects.count(), 1)
+
+
+class RoomChatMessagesKeysetTestCase(TestCase):
+	"""
+	Pages of RoomChatMessage.objects.before(room, before_msg_id) don't shift when new messages arrive.
+	"""
+
+	def setUp(self):
+		self.user1 = create_account("user1")
+		self.user2 = create_account("user2")
+		self.room = find_or_create_private_chat(self.user1, self.user2)
+		for i in range(25):
+			RoomChatMessage.objects.create(user=self.user1, room=self.room, content=f"message {i}")
+
+	def test_pages_do_not_repeat_messages(self):
+		seen = []
+		before_msg_id = None
+		while True:
+			page = list(RoomChatMessage.objects.before(self.room, before_msg_id)[:10])
+			seen += [message.content for message in page]
+			if len(page) < 10:
+				break
+			before_msg_id = page[-1].id
+			# Arrives while the user scrolls back
+			RoomChatMessage.objects.create(user=self.user2, room=self.room, content="new message")
+		self.assertEqual(seen, [f"message {i}" for i in reversed(range(25))])
+
+	def test_messages_sent_in_the_same_instant(self):
+		RoomChatMessage.objects.filter(room=self.room).update(timestamp=timezone.now())
+		page1 = list(RoomChatMessage.objects.before(self.room)[:10])
+		page2 = list(RoomChatMessage.objects.before(self.room, page1[-1].id)[:20])
+		self.assertEqual(len(set([message.id for message in page1 + page2])), 25)
+
+	def test_page_number_returns_the_same_pages(self):
+		# Clients loaded before the before_msg_id protocol ask for page numbers
+		before_msg_id = None
+		for page_number in [1, 2, 3]:
+			legacy_frame = decode_frame(get_room_chat_messages_by_page_number.func(self.room, page_number))
+			frame = decode_frame(get_room_chat_messages.func(self.room, before_msg_id))
+			self.assertEqual(legacy_frame["messages"], frame["messages"])
+			self.assertEqual(legacy_frame["new_page_number"], page_number + 1)
+			before_msg_id = frame["next_before_msg_id"]
+		self.assertIsNone(before_msg_id)
+		self.assertEqual(decode_frame(get_room_chat_messages_by_page_number.func(self.room, 4))["messages"], "None")
+
+	def test_page_is_one_query(self):
+		before_msg_id = RoomChatMessage.objects.last().id
+		with self.assertNumQueries(1):
+			page = RoomChatMessage.objects.before(self.room, before_msg_id)[:10]
+			[message.user.username for message in page]
+
+
+class UnreadMessagesTestCase(TestCase):
+	"""
+	notify_unread_message/mark_room_read keep UnreadChatRoomMessages, the "chat" Notification
+	and the NotificationCounter in sync.
+	"""
+
+	def setUp(self):
+		self.user1 = create_account("user1")
+		self.user2 = create_account("user2")
+		room = find_or_create_private_chat(self.user1, self.user2)
+		# Like ChatConsumer: the room is loaded once with both users
+		self.room = PrivateChatRoom.objects.select_related("user1", "user2").get(pk=room.pk)
+		get_chat_notification_content_type()
+
+	def get_notifications(self):
+		return Notification.objects.filter(target=self.user1, content_type=get_chat_notification_content_type())
+
+	def send_message(self, content):
+		RoomChatMessage.objects.create(room=self.room, user=self.user2, content=content)
+		notify_unread_message(self.room, self.user1, content)
+
+	def test_unread_count_is_derived_from_the_messages(self):
+		self.send_message("first")
+		self.send_message("second")
+
+		unread_msgs = UnreadChatRoomMessages.objects.get(room=self.room, user=self.user1)
+		self.assertEqual(unread_msgs.get_unread_count(), 2)
+		# The notification shows the latest message
+		self.assertEqual([n.verb for n in self.get_notifications()], ["second"])
+		self.assertEqual(NotificationCounter.objects.get(user=self.user1).unread_chat_count, 1)
+
+	def test_unread_notification_shows_the_latest_message(self):
+		self.send_message("first")
+		version = NotificationCounter.objects.get(user=self.user1).version
+		for i in range(3):
+			self.send_message(f"message {i}")
+		notification = self.get_notifications().get()
+		self.assertEqual((notification.verb, notification.read), ("message 2", False))
+		counter = NotificationCounter.objects.get(user=self.user1)
+		# Counted once. Each message is a new version for the 'sync' command
+		self.assertEqual(counter.unread_chat_count, 1)
+		self.assertEqual(counter.version, version + 3)
+		self.assertEqual(notification.version, counter.version)
+
+	def test_read_keeps_the_notification(self):
+		self.send_message("first")
+		notification = self.get_notifications().get()
+		mark_room_read(self.room, self.user1)
+
+		self.assertEqual(UnreadChatRoomMessages.objects.get(room=self.room, user=self.user1).get_unread_count(), 0)
+		self.assertTrue(self.get_notifications().get().read)
+		self.assertEqual(NotificationCounter.objects.get(user=self.user1).unread_chat_count, 0)
+
+		# The next message flips the same notification back to unread
+		self.send_message("second")
+		self.assertEqual([(n.pk, n.verb, n.read) for n in self.get_notifications()], [(notification.pk, "second", False)])
+		self.assertEqual(NotificationCounter.objects.get(user=self.user1).unread_chat_count, 1)
+
+
+class InboxTestCase(TestCase):
+	"""
+	The inbox is one query on the denormalized last message of the rooms, kept up to date when messages are stored.
+	"""
+
+	def setUp(self):
+		self.user = create_account("user")
+		self.friends = [create_account(f"friend{i}") for i in range(4)]
+		self.rooms = [find_or_create_private_chat(self.user, friend) for friend in self.friends]
+		PrivateChatRoom.objects.update(is_active=True)
+		# Read before any of the messages below were sent
+		UnreadChatRoomMessages.objects.update(last_read_timestamp=timezone.now() - timedelta(minutes=1))
+
+	def send_messages(self, *messages):
+		"""
+		(room, user, content, seconds ago): stored in one batch, like chat.write_behind does.
+		"""
+		room_chat_message_buffer.write([
+			RoomChatMessage(room=room, user=user, content=content, timestamp=timezone.now() - timedelta(seconds=seconds_ago))
+			for room, user, content, seconds_ago in messages
+		])
+
+	def test_most_recent_first(self):
+		self.send_messages(
+			(self.rooms[0], self.friends[0], "old", 30),
+			(self.rooms[1], self.user, "mine", 10),
+			(self.rooms[2], self.friends[2], "new", 5),
+		)
+		with self.assertNumQueries(1):
+			m_and_f, next_cursor = get_recent_chatroom_messages(self.user)
+		self.assertEqual(
+			[(x['friend'], x['message'], x['is_unread']) for x in m_and_f],
+			[(self.friends[2], "new", True), (self.friends[1], "mine", False), (self.friends[0], "old", True), (self.friends[3], "", False)],
+		)
+		self.assertIsNone(next_cursor)
+
+		mark_room_read(self.rooms[2], self.user)
+		m_and_f, next_cursor = get_recent_chatroom_messages(self.user)
+		self.assertFalse(m_and_f[0]['is_unread'])
+
+	def test_late_batch_does_not_move_the_last_message_back(self):
+		self.send_messages((self.rooms[0], self.friends[0], "newest", 5))
+		self.send_messages((self.rooms[0], self.user, "written late", 10))
+		room = PrivateChatRoom.objects.get(pk=self.rooms[0].pk)
+		self.assertEqual((room.last_message_preview, room.last_sender_id), ("newest", self.friends[0].id))
+
+	def test_pages(self):
+		self.friends.append(create_account("friend4"))
+		self.rooms.append(find_or_create_private_chat(self.friends[4], self.user))
+		PrivateChatRoom.objects.update(is_active=True)
+		# Two rooms sent their last message in the same instant, two have no messages
+		self.send_messages((self.rooms[0], self.friends[0], "message 0", 10), (self.rooms[1], self.friends[1], "message 1", 5))
+		PrivateChatRoom.objects.filter(pk=self.rooms[2].pk).update(last_message_at=PrivateChatRoom.objects.get(pk=self.rooms[1].pk).last_message_at, last_message_preview="message 2")
+		expected = [self.friends[2], self.friends[1], self.friends[0], self.friends[4], self.friends[3]]
+		for page_size in [1, 2, 3]:
+			friends = []
+			cursor = None
+			with mock.patch("chat.views.DEFAULT_INBOX_PAGE_SIZE", page_size):
+				while True:
+					with self.assertNumQueries(1):
+						page, cursor = get_recent_chatroom_messages(self.user, cursor)
+					friends += [x['friend'] for x in page]
+					if cursor == None:
+						break
+			self.assertEqual(friends, expected)
+
+	def test_invalid_cursor(self):
+		with self.assertRaises(ValueError):
+			get_recent_chatroom_messages(self.user, "not a cursor")
+
+	def test_rooms_are_read_from_the_inbox_indexes(self):
+		self.send_messages((self.rooms[0], self.friends[0], "hello", 10))
+		room = PrivateChatRoom.objects.get(pk=self.rooms[0].pk)
+		# First page, after a room with messages, after a room without messages
+		for after_cursor, last_message_at, last_id in [(False, None, None), (True, room.last_message_at, room.id), (True, None, room.id)]:
+			for branch in get_inbox_branches(self.user, after_cursor, last_message_at, last_id):
+				plan = explain(branch[:51])
+				self.assertIn("chat_room_user1_inbox_idx" if '"user1_id" = ' in str(branch.query) else "chat_room_user2_inbox_idx", plan)
+				self.assertNotIn("TEMP B-TREE", plan)
+			if connection.features.supports_slicing_ordering_in_compound:
+				# The UNION ALL of the branches reads both indexes
+				plan = explain(get_inbox_rooms(self.user, get_inbox_branches(self.user, after_cursor, last_message_at, last_id), 51))
+				self.assertIn("chat_room_user1_inbox_idx", plan)
+				self.assertIn("chat_room_user2_inbox_idx", plan)
+
+	def test_inactive_rooms_are_left_out(self):
+		PrivateChatRoom.objects.filter(pk=self.rooms[0].pk).update(is_active=False)
+		m_and_f, next_cursor = get_recent_chatroom_messages(self.user)
+		self.assertNotIn(self.friends[0], [x['friend'] for x in m_and_f])
+
+
+def call_synchronously(function):
+	"""
+	Stands in for database_sync_to_async: the buffer writes in the test's thread, inside its transaction.
+	"""
+	async def wrapper(*args, **kwargs):
+		return function(*args, **kwargs)
+	return wrapper
+
+
+@mock.patch("chat.write_behind.database_sync_to_async", call_synchronously)
+class MessageWriteBufferTestCase(TestCase):
+	"""
+	The three CHAT_MESSAGE_PERSISTENCE modes of chat.write_behind.MessageWriteBuffer.
+	"""
+
+	def setUp(self):
+		self.user1 = create_account("user1")
+		self.user2 = create_account("user2")
+		self.room = find_or_create_private_chat(self.user1, self.user2)
+		self.on_write = mock.Mock()
+		self.buffer = MessageWriteBuffer(RoomChatMessage, "test.messages", on_write=self.on_write)
+		self.loop = asyncio.new_event_loop()
+		# Batching needs ids before the insert: reserve them on every database, like PostgreSQL does
+		ids = itertools.count((RoomChatMessage.objects.order_by("-id").values_list("id", flat=True).first() or 0) + 1000)
+		patches = [
+			mock.patch("chat.write_behind.can_reserve_ids", lambda: True),
+			mock.patch("chat.write_behind.reserve_ids", lambda model, count: [next(ids) for i in range(count)]),
+		]
+		for patch in patches:
+			patch.start()
+			self.addCleanup(patch.stop)
+
+	def tearDown(self):
+		buffers.remove(self.buffer)
+		self.loop.close()
+
+	def run_async(self, coroutine):
+		return self.loop.run_until_complete(coroutine)
+
+	def message(self, content):
+		return RoomChatMessage(room=self.room, user=self.user1, content=content)
+
+	def stored(self):
+		return list(RoomChatMessage.objects.filter(room=self.room).order_by("id").values_list("content", flat=True))
+
+	def get_metric(self, kind, name):
+		return metrics.get_metrics()[kind].get("test.messages." + name)
+
+	@override_settings(CHAT_MESSAGE_PERSISTENCE="immediate")
+	def test_immediate(self):
+		stored = self.get_metric("counters", "messages_stored") or 0
+		count = (self.get_metric("summaries", "batch_size") or {"count": 0})["count"]
+		self.run_async(self.buffer.save(self.message("hello")))
+		self.assertEqual(self.stored(), ["hello"])
+		self.on_write.assert_called_once()
+		# Recorded like a batch of one
+		self.assertEqual(self.get_metric("counters", "messages_stored"), stored + 1)
+		self.assertEqual(self.get_metric("summaries", "batch_size")["count"], count + 1)
+		self.assertEqual(self.get_metric("summaries", "batch_size")["last"], 1)
+		self.assertEqual(self.get_metric("summaries", "flush_seconds")["count"], count + 1)
+
+	@override_settings(CHAT_MESSAGE_PERSISTENCE="group_commit", CHAT_MESSAGE_BATCH_SIZE=2, CHAT_MESSAGE_BATCH_DELAY=60)
+	def test_group_commit_flushes_a_full_batch(self):
+		async def send():
+			first = asyncio.ensure_future(self.buffer.save(self.message("one")))
+			await asyncio.sleep(0)
+			# Waits for its batch to be stored
+			self.assertFalse(first.done())
+			self.assertEqual(self.stored(), [])
+			await self.buffer.save(self.message("two"))
+			await first
+		self.run_async(send())
+		self.assertEqual(self.stored(), ["one", "two"])
+		self.assertEqual(self.get_metric("summaries", "batch_size")["last"], 2)
+		self.assertEqual(len(self.on_write.call_args[0][0]), 2)
+
+	@override_settings(CHAT_MESSAGE_PERSISTENCE="write_behind", CHAT_MESSAGE_BATCH_SIZE=100, CHAT_MESSAGE_BATCH_DELAY=0.01)
+	def test_write_behind_flushes_after_the_delay(self):
+		async def send():
+			# Returns before the message is stored
+			await self.buffer.save(self.message("hello"))
+			self.assertEqual(self.stored(), [])
+			await asyncio.sleep(0.05)
+		self.run_async(send())
+		self.assertEqual(self.stored(), ["hello"])
+		self.on_write.assert_called_once()
+
+	@override_settings(CHAT_MESSAGE_PERSISTENCE="group_commit", CHAT_MESSAGE_BATCH_SIZE=2, CHAT_MESSAGE_BATCH_DELAY=60)
+	def test_bad_message_does_not_lose_the_batch(self):
+		dropped = self.get_metric("counters", "messages_dropped") or 0
+		async def send():
+			return await asyncio.gather(
+				self.buffer.save(self.message("good")),
+				self.buffer.save(self.message(None)), # content is NOT NULL
+				return_exceptions=True,
+			)
+		good, bad = self.run_async(send())
+		self.assertIsNone(good)
+		self.assertIsInstance(bad, IntegrityError)
+		self.assertEqual(self.stored(), ["good"])
+		self.assertEqual(self.get_metric("counters", "messages_dropped"), dropped + 1)
+		self.assertEqual([message.content for message in self.on_write.call_args[0][0]], ["good"])
+
+	@override_settings(CHAT_MESSAGE_PERSISTENCE="write_behind", CHAT_MESSAGE_BATCH_SIZE=100, CHAT_MESSAGE_BATCH_DELAY=60)
+	def test_immediate_when_ids_cannot_be_reserved(self):
+		with mock.patch("chat.write_behind.can_reserve_ids", lambda: False):
+			message = self.message("hello")
+			self.run_async(self.buffer.save(message))
+		# Stored before it is broadcast, with its id
+		self.assertEqual(self.stored(), ["hello"])
+		self.assertEqual(RoomChatMessage.objects.get(content="hello").id, message.id)
+		self.assertEqual(self.buffer.pending, [])
+
+	@override_settings(CHAT_MESSAGE_PERSISTENCE="write_behind", CHAT_MESSAGE_BATCH_SIZE=100, CHAT_MESSAGE_BATCH_DELAY=60)
+	def test_pending_messages_are_flushed_on_exit(self):
+		self.run_async(self.buffer.save(self.message("one")))
+		self.run_async(self.buffer.save(self.message("two")))
+		self.assertEqual(self.stored(), [])
+		flush_buffers_on_exit()
+		self.assertEqual(self.stored(), ["one", "two"])
+		self.assertEqual(self.buffer.pending, [])
+		self.buffer.flush_now()
+		self.assertEqual(self.stored(), ["one", "two"])
+
+
+class InMemoryPresenceTestCase(SimpleTestCase):
+	"""
+	A user is present while at least one of their connections is in the room and sending heartbeats.
+	"""
+
+	def setUp(self):
+		self.presence = InMemoryPresenceBackend(ttl=60)
+		self.now = 1000.0
+		patcher = mock.patch("chat.presence.time.time", lambda: self.now)
+		patcher.start()
+		self.addCleanup(patcher.stop)
+
+	def run_async(self, coroutine):
+		return asyncio.get_event_loop().run_until_complete(coroutine)
+
+	def test_user_is_present_until_last_connection_leaves(self):
+		self.run_async(self.presence.join("room", 1, "tab1"))
+		self.run_async(self.presence.join("room", 1, "tab2"))
+		self.run_async(self.presence.join("room", 2, "tab1"))
+		self.assertEqual(self.run_async(self.presence.count("room")), 2)
+
+		self.run_async(self.presence.leave("room", 1, "tab1"))
+		self.assertTrue(self.run_async(self.presence.is_present("room", 1)))
+
+		self.run_async(self.presence.leave("room", 1, "tab2"))
+		self.assertFalse(self.run_async(self.presence.is_present("room", 1)))
+		self.assertEqual(self.run_async(self.presence.count("room")), 1)
+
+	def test_connection_without_heartbeat_expires(self):
+		self.run_async(self.presence.join("room", 1, "crashed"))
+		self.run_async(self.presence.join("room", 2, "alive"))
+		self.now += 40
+		self.run_async(self.presence.heartbeat("room", 2, "alive"))
+		self.now += 40
+		self.assertFalse(self.run_async(self.presence.is_present("room", 1)))
+		self.assertTrue(self.run_async(self.presence.is_present("room", 2)))
+
+	def test_expired_connections_are_not_read(self):
+		# No other connection joins or sends a heartbeat: the read itself drops the expired connection
+		self.run_async(self.presence.join("room", 1, "crashed"))
+		self.now += 61
+		self.assertEqual(self.run_async(self.presence.count("room")), 0)
+		self.assertFalse(self.run_async(self.presence.is_present("room", 1)))
+		self.assertNotIn("room", self.presence.rooms)
+
+	def test_reads_do_not_depend_on_room_size(self):
+		class NoScanDict(dict):
+			def scan(self, *args):
+				raise AssertionError("The users of the room were scanned")
+			items = keys = values = __iter__ = scan
+
+		class NoExpiryDeque(deque):
+			def popleft(self):
+				raise AssertionError("An entry was expired")
+
+		for user_id in range(1000):
+			self.run_async(self.presence.join("room", user_id, "tab"))
+		self.now += 30
+		self.presence.rooms["room"] = NoScanDict(self.presence.rooms["room"])
+		self.presence.expiries["room"] = NoExpiryDeque(self.presence.expiries["room"])
+		for i in range(100):
+			self.assertEqual(self.run_async(self.presence.count("room")), 1000)
+			self.assertTrue(self.run_async(self.presence.is_present("room", i)))
+
+
+class InMemoryRateLimitTestCase(SimpleTestCase):
+	"""
+	A message takes a token from every bucket, or from none of them.
+	"""
+
+	def setUp(self):
+		self.rate_limiter = InMemoryRateLimitBackend()
+
+	def run_async(self, coroutine):
+		return asyncio.get_event_loop().run_until_complete(coroutine)
+
+	def test_burst_then_wait(self):
+		for i in range(3):
+			self.assertEqual(self.run_async(self.rate_limiter.acquire([("user:1", 1, 3)])), 0)
+		wait = self.run_async(self.rate_limiter.acquire([("user:1", 1, 3)]))
+		self.assertGreater(wait, 0)
+		self.assertLessEqual(wait, 1)
+
+		# Tokens come back at RATE per second
+		self.rate_limiter.buckets["user:1"].updated_at -= 1
+		self.assertEqual(self.run_async(self.rate_limiter.acquire([("user:1", 1, 3)])), 0)
+
+	def test_rejected_message_takes_no_token(self):
+		self.assertEqual(self.run_async(self.rate_limiter.acquire([("room:1", 1, 1)])), 0)
+		self.assertGreater(self.run_async(self.rate_limiter.acquire([("user:1", 1, 5), ("room:1", 1, 1)])), 0)
+		self.assertEqual(self.rate_limiter.buckets["user:1"].tokens, 5)
+
+
+@override_settings(CHAT_HISTORY_CACHE={
+	"MAX_BYTES": 100,
+	"SHARED_CACHE": "history",
+	"MIN_AGE": 60,
+}, CACHES={
+	"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"},
+	"history": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache", "LOCATION": "history"},
+})
+class HistoryPageCacheTestCase(SimpleTestCase):
+	"""
+	Only pages that can't change anymore are cached.
+	"""
+
+	def setUp(self):
+		self.cache = HistoryPageCache("test.history")
+		self.old = timezone.now() - timedelta(minutes=5)
+
+	def tearDown(self):
+		self.cache.shared_cache.clear()
+
+	def test_older_page_is_cached(self):
+		self.cache.set(1, 50, "page", self.old)
+		self.assertEqual(self.cache.get(1, 50), "page")
+		self.assertEqual(self.cache.get(2, 50), None)
+
+	def test_pages_that_can_change_are_not_cached(self):
+		# The newest page
+		self.cache.set(1, None, "page", self.old)
+		self.assertEqual(self.cache.get(1, None), None)
+		# A message could still be inserted in it
+		self.cache.set(1, 50, "page", timezone.now())
+		self.assertEqual(self.cache.get(1, 50), None)
+
+	def test_size_is_bounded(self):
+		for before_msg_id in range(10):
+			self.cache.set(1, before_msg_id, "x" * 30, self.old)
+		self.assertLessEqual(self.cache.num_bytes, 100)
+		self.assertEqual(len(self.cache.pages), 3)
+
+	def test_shared_cache(self):
+		self.cache.set(1, 50, "page", self.old)
+		other_process = HistoryPageCache("test.history")
+		self.assertEqual(other_process.get(1, 50), "page")
+
+
+@override_settings(WEBSOCKET_FLOW_CONTROL={
+	"WINDOW": 2,
+	"HIGH_WATER": 4,
+	"POLICIES": ["collapse", "drop_oldest"],
+})
+class FlowControlTestCase(SimpleTestCase):
+	"""
+	A client that asked for flow control is sent at most WINDOW frames ahead of its acks,
+	and no more than HIGH_WATER frames wait for it.
+	"""
+
+	def setUp(self):
+		self.consumer = BaseJsonConsumer({"type": "websocket", "query_string": b"flow_control=1", "user": None})
+		self.messages = []
+		async def base_send(message):
+			self.messages.append(message)
+		self.consumer.base_send = base_send
+		self.consumer.negotiate_flow_control()
+
+	def run_async(self, coroutine):
+		return asyncio.get_event_loop().run_until_complete(coroutine)
+
+	def sent(self):
+		return [decode_frame(message["text"]) for message in self.messages if message["type"] == "websocket.send"]
+
+	def test_frames_wait_for_acks(self):
+		for i in range(3):
+			self.run_async(self.consumer.send_json({"i": i}))
+		self.assertEqual(self.sent(), [{"i": 0}, {"i": 1}])
+		self.run_async(self.consumer.receive(text_data='{"command": "ack", "seq": 1}'))
+		self.assertEqual(self.sent(), [{"i": 0}, {"i": 1}, {"i": 2}])
+
+	def test_only_latest_count_is_sent(self):
+		self.run_async(self.consumer.send_json({"window": 1}))
+		self.run_async(self.consumer.send_json({"window": 2}))
+		for count in range(5):
+			self.run_async(self.consumer.send_event({"count": count}, collapse_key="count"))
+		self.run_async(self.consumer.receive(text_data='{"command": "ack", "seq": 2}'))
+		self.assertEqual(self.sent()[2:], [{"count": 4}])
+
+	def test_droppable_frames_are_dropped_first(self):
+		self.run_async(self.consumer.send_json({"window": 1}))
+		self.run_async(self.consumer.send_json({"window": 2}))
+		for i in range(4):
+			self.run_async(self.consumer.send_event({"joined": i}, droppable=True))
+		self.run_async(self.consumer.send_json({"message": 1}))
+		self.run_async(self.consumer.receive(text_data='{"command": "ack", "seq": 2}'))
+		self.run_async(self.consumer.receive(text_data='{"command": "ack", "seq": 4}'))
+		self.assertEqual(self.sent()[2:], [{"joined": 1}, {"joined": 2}, {"joined": 3}, {"message": 1}])
+
+	def test_slow_consumer_is_disconnected(self):
+		for i in range(7):
+			self.run_async(self.consumer.send_json({"message": i}))
+		self.assertEqual(self.sent()[-1]["error"], "SLOW_CONSUMER")
+		self.assertEqual(self.messages[-1], {"type": "websocket.close", "code": SLOW_CONSUMER_CLOSE_CODE})
+		# Nothing is sent after that
+		self.run_async(self.consumer.send_json({"message": 7}))
+		self.assertEqual(self.messages[-1]["type"], "websocket.close")
+
+
+class EventsConsumer(BaseJsonConsumer):
+	"""
+	Sends the events of the frames it receives with send_event.
+	"""
+
+	async def connect(self):
+		self.negotiate_coalescing()
+		await self.accept()
+
+	async def receive_json(self, content):
+		for event in content["events"]:
+			await self.send_event(event)
+
+
+@override_settings(CHAT_FRAME_COALESCING={"ENABLED": True, "MAX_DELAY": 0.2, "MAX_BATCH_SIZE": 50})
+class CoalescingTestCase(SimpleTestCase):
+	"""
+	A client that connects with "?coalesce_ms=<milliseconds>" gets the events sent within that window as one array frame.
+	"""
+
+	def run_async(self, coroutine):
+		return asyncio.get_event_loop().run_until_complete(coroutine)
+
+	async def connect(self, path):
+		communicator = WebsocketCommunicator(EventsConsumer, path)
+		communicator.scope["user"] = None
+		connected, subprotocol = await communicator.connect()
+		self.assertTrue(connected)
+		return communicator
+
+	def test_events_in_the_window_are_one_frame(self):
+		async def run():
+			communicator = await self.connect("/?coalesce_ms=100")
+			await communicator.send_json_to({"events": [{"i": 0}, {"i": 1}, {"i": 2}]})
+			frame = await communicator.receive_json_from(timeout=1)
+			nothing = await communicator.receive_nothing(timeout=0.2)
+			await communicator.disconnect()
+			return frame, nothing
+		frame, nothing = self.run_async(run())
+		self.assertEqual(frame, [{"i": 0}, {"i": 1}, {"i": 2}])
+		self.assertTrue(nothing)
+
+	def test_events_are_not_batched_without_the_parameter(self):
+		async def run():
+			communicator = await self.connect("/")
+			await communicator.send_json_to({"events": [{"i": 0}, {"i": 1}]})
+			frames = [await communicator.receive_json_from(timeout=1), await communicator.receive_json_from(timeout=1)]
+			await communicator.disconnect()
+			return frames
+		self.assertEqual(self.run_async(run()), [{"i": 0}, {"i": 1}])
+
+	def test_pending_events_are_dropped_on_disconnect(self):
+		async def run():
+			communicator = await self.connect("/?coalesce_ms=100")
+			await communicator.send_json_to({"events": [{"i": 0}]})
+			# Let the consumer buffer the event before the socket closes
+			await communicator.receive_nothing(timeout=0.01)
+			await communicator.disconnect()
+			# Past the window: the flush was cancelled
+			return await communicator.receive_nothing(timeout=0.3)
+		self.assertTrue(self.run_async(run()))
+
+
+class ChatRevokeTestCase(TransactionTestCase):
+	"""
+	When two users stop being friends, the sockets in their private chat are told to leave and closed.
+	TransactionTestCase: the revoke is sent once the transaction commits.
+	"""
+
+	def setUp(self):
+		friend_graph.friends.clear()
+		self.user1 = create_account("user1")
+		self.user2 = create_account("user2")
+		FriendList.objects.get(user=self.user1).add_friend(self.user2)
+		FriendList.objects.get(user=self.user2).add_friend(self.user1)
+		self.room = find_or_create_private_chat(self.user1, self.user2)
+
+	def run_async(self, coroutine):
+		return asyncio.get_event_loop().run_until_complete(coroutine)
+
+	def test_unfriend_closes_the_private_chat(self):
+		consumers = []
+		class RecordedChatConsumer(ChatConsumer):
+			def __init__(self, scope):
+				super().__init__(scope)
+				consumers.append(self)
+
+		async def run():
+			communicator = WebsocketCommunicator(RecordedChatConsumer, "/")
+			communicator.scope["user"] = self.user1
+			connected, subprotocol = await communicator.connect()
+			self.assertTrue(connected)
+			await communicator.send_json_to({"command": "join", "room": self.room.id})
+			while (await communicator.receive_json_from(timeout=2)) != {"join": str(self.room.id)}:
+				pass
+			consumer = consumers[0]
+			self.assertEqual(consumer.get_joined_room(self.room.id), self.room)
+
+			await database_sync_to_async(FriendList.objects.get(user=self.user1).unfriend)(self.user2)
+			frames = []
+			while True:
+				output = await communicator.receive_output(timeout=2)
+				if output["type"] == "websocket.close":
+					break
+				frames.append(decode_frame(output["text"]))
+			await communicator.wait()
+			return consumer, frames
+		consumer, frames = self.run_async(run())
+
+		self.assertEqual(frames[-1], {"error": "ROOM_ACCESS_DENIED", "message": "You must be friends to chat."})
+		with self.assertRaises(ClientError):
+			consumer.get_joined_room(self.room.id)
+
+
+class ChatConsumerTestCase(TransactionTestCase):
+	"""
+	Base class of the ChatConsumer tests: two friends and their private chat.
+	"""
+
+	def setUp(self):
+		friend_graph.friends.clear()
+		self.user1 = create_account("user1")
+		self.user2 = create_account("user2")
+		FriendList.objects.get(user=self.user1).add_friend(self.user2)
+		FriendList.objects.get(user=self.user2).add_friend(self.user1)
+		self.room = find_or_create_private_chat(self.user1, self.user2)
+
+	def run_async(self, coroutine):
+		return asyncio.get_event_loop().run_until_complete(coroutine)
+
+	async def join(self, user):
+		communicator = WebsocketCommunicator(ChatConsumer, "/")
+		communicator.scope["user"] = user
+		connected, subprotocol = await communicator.connect()
+		self.assertTrue(connected)
+		await communicator.send_json_to({"command": "join", "room": self.room.id})
+		while (await communicator.receive_json_from(timeout=2)) != {"join": str(self.room.id)}:
+			pass
+		return communicator
+
+	async def send(self, communicator, message):
+		"""
+		Returns the chat.message event the sender receives.
+		"""
+		await communicator.send_json_to({"command": "send", "room": self.room.id, "message": message})
+		while True:
+			event = await communicator.receive_json_from(timeout=2)
+			if event.get("msg_type") == MSG_TYPE_MESSAGE and event["message"] == message:
+				return event
+
+
+class ChatConsumerMessageTestCase(ChatConsumerTestCase):
+	"""
+	Messages sent through ChatConsumer while both users are in the room.
+	"""
+
+	def test_event_has_the_stored_timestamp(self):
+		async def run():
+			communicator1 = await self.join(self.user1)
+			communicator2 = await self.join(self.user2)
+			event = await self.send(communicator1, "hello")
+			await communicator1.send_json_to({"command": "get_room_chat_messages", "room_id": self.room.id})
+			while True:
+				frame = await communicator1.receive_json_from(timeout=2)
+				if "messages" in frame:
+					break
+			await communicator1.disconnect()
+			await communicator2.disconnect()
+			return event, frame["messages"]
+		event, history = self.run_async(run())
+
+		message = RoomChatMessage.objects.get(pk=event["msg_id"])
+		self.assertEqual(event["timestamp"], get_epoch_timestamp(message.timestamp))
+		self.assertEqual(event["natural_timestamp"], calculate_timestamp(message.timestamp))
+		# The epoch is the stored timestamp, to the millisecond
+		self.assertEqual(from_epoch_timestamp(event["timestamp"]), message.timestamp.replace(microsecond=message.timestamp.microsecond // 1000 * 1000))
+		# The history sends the same values
+		self.assertEqual([(m["msg_id"], m["timestamp"], m["natural_timestamp"]) for m in history], [(event["msg_id"], event["timestamp"], event["natural_timestamp"])])
+
+
+# send_room stores the message and the notification from two threads at once: SQLite only allows one writer
+@skipIf(connection.vendor == "sqlite", "SQLite locks the database when two threads write at once")
+class ChatConsumerUnreadTestCase(ChatConsumerTestCase):
+	"""
+	Messages sent through ChatConsumer to a user who is not in the room are unread until they join it.
+	"""
+
+	def get_unread_count(self):
+		return UnreadChatRoomMessages.objects.get(room=self.room, user=self.user1).get_unread_count()
+
+	def test_messages_to_an_absent_user_are_unread(self):
+		async def send_messages():
+			communicator = await self.join(self.user2)
+			await self.send(communicator, "first")
+			await self.send(communicator, "second")
+			await communicator.disconnect()
+		self.run_async(send_messages())
+
+		self.assertEqual(self.get_unread_count(), 2)
+		notification = Notification.objects.get(target=self.user1, content_type=get_chat_notification_content_type())
+		self.assertEqual((notification.verb, notification.read), ("second", False))
+		self.assertEqual(NotificationCounter.objects.get(user=self.user1).unread_chat_count, 1)
+
+		async def read_messages():
+			communicator = await self.join(self.user1)
+			await communicator.disconnect()
+		self.run_async(read_messages())
+
+		self.assertEqual(self.get_unread_count(), 0)
+		self.assertEqual(NotificationCounter.objects.get(user=self.user1).unread_chat_count, 0)
+
+
+class MergeDuplicatePrivateChatsMigrationTestCase(TransactionTestCase):
+	"""
+	chat/migrations/0007: the duplicate rooms of a pair are merged into the oldest one.
+	"""
+	migrate_from = [("chat", "0006_read_watermark"), ("notification", "0004_sync_version"), ("contenttypes", "0002_remove_content_type_name")]
+	migrate_to = [("chat", "0007_merge_duplicate_private_chats")]
+
+	def setUp(self):
+		executor = MigrationExecutor(connection)
+		executor.migrate(self.migrate_from)
+		self.apps = executor.loader.project_state(self.migrate_from).apps
+
+	def tearDown(self):
+		executor = MigrationExecutor(connection)
+		executor.migrate(executor.loader.graph.leaf_nodes())
+
+	def migrate(self):
+		executor = MigrationExecutor(connection)
+		executor.migrate(self.migrate_to)
+		return executor.loader.project_state(self.migrate_to).apps
+
+	def test_notification_opens_the_kept_room(self):
+		PrivateChatRoom = self.apps.get_model("chat", "PrivateChatRoom")
+		UnreadChatRoomMessages = self.apps.get_model("chat", "UnreadChatRoomMessages")
+		Notification = self.apps.get_model("notification", "Notification")
+		NotificationCounter = self.apps.get_model("notification", "NotificationCounter")
+		ContentType = self.apps.get_model("contenttypes", "ContentType")
+		content_type, created = ContentType.objects.get_or_create(app_label="chat", model="unreadchatroommessages")
+		user1 = create_account("user1")
+		user2 = create_account("user2")
+		NotificationCounter.objects.get_or_create(user_id=user1.id)
+
+		room = PrivateChatRoom.objects.create(user1_id=user1.id, user2_id=user2.id)
+		duplicate = PrivateChatRoom.objects.create(user1_id=user2.id, user2_id=user1.id)
+		unread = UnreadChatRoomMessages.objects.create(room_id=duplicate.id, user_id=user1.id, last_read_timestamp=timezone.now())
+		notification = Notification.objects.create(
+			target_id=user1.id,
+			from_user_id=user2.id,
+			redirect_url=f"{settings.BASE_URL}/chat/?room_id={duplicate.id}",
+			verb="Hello",
+			content_type_id=content_type.id,
+			object_id=unread.id,
+			version=0,
+		)
+
+		apps = self.migrate()
+
+		self.assertEqual(list(apps.get_model("chat", "PrivateChatRoom").objects.values_list("id", flat=True)), [room.id])
+		self.assertEqual(apps.get_model("chat", "UnreadChatRoomMessages").objects.get(pk=unread.pk).room_id, room.id)
+		notification = apps.get_model("notification", "Notification").objects.get(pk=notification.pk)
+		self.assertEqual(notification.redirect_url, f"{settings.BASE_URL}/chat/?room_id={room.id}")
+		# The open tabs are sent the new URL
+		counter = apps.get_model("notification", "NotificationCounter").objects.get(user_id=user1.id)
+		self.assertEqual(notification.version, counter.version)
+		self.assertGreater(counter.version, 0)
@@ -1,23 +1,188 @@
-from datetime import datetime
+import base64
+from datetime import datetime, timedelta
 from django.contrib.humanize.templatetags.humanize import naturalday
 from django.core.serializers.python import Serializer
+from django.db import IntegrityError, transaction
+from django.db.models import Q
+from django.utils import timezone
+from django.conf import settings
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
 
-from chat.models import PrivateChatRoom
+from chat.models import PrivateChatRoom, UnreadChatRoomMessages
+from notification.models import Notification
+from notification.utils import get_chat_notification_content_type
 from chat.constants import *
 
 
 def find_or_create_private_chat(user1, user2):
-	try:
-		chat = PrivateChatRoom.objects.get(user1=user1, user2=user2)
-	except PrivateChatRoom.DoesNotExist:
-		try:
-			chat = PrivateChatRoom.objects.get(user1=user2, user2=user1)
-		except PrivateChatRoom.DoesNotExist:
-			chat = PrivateChatRoom(user1=user1, user2=user2)
-			chat.save()
+	"""
+	The room of two users, in either order. One query (on chat_room_user_pair_unique) when it exists.
+	If two callers create it at the same time, the unique constraint makes one of them fetch the other's room.
+	"""
+	if user1.id > user2.id:
+		user1, user2 = user2, user1
+	chat, created = PrivateChatRoom.objects.get_or_create(user1=user1, user2=user2)
 	return chat
 
 
+def activate_private_chat(user1, user2):
+	"""
+	user1 and user2 became friends: activate their private chat, or create it. One UPDATE for an existing room.
+	"""
+	if user1.id > user2.id:
+		user1, user2 = user2, user1
+	rooms = PrivateChatRoom.objects.filter(user1=user1, user2=user2)
+	if rooms.update(is_active=True) == 0:
+		try:
+			with transaction.atomic():
+				PrivateChatRoom(user1=user1, user2=user2, is_active=True).save()
+		except IntegrityError:
+			# Created meanwhile by find_or_create_private_chat
+			rooms.update(is_active=True)
+
+
+def update_last_messages(messages):
+	"""
+	Stored RoomChatMessages: move the last message of their rooms (PrivateChatRoom.last_message_at...), one UPDATE per room.
+	A message older than the last message of its room doesn't move it back (Ex: a batch that another process
+	wrote late, see chat.write_behind).
+	"""
+	newest = {}
+	for message in messages:
+		if message.room_id not in newest or message.timestamp >= newest[message.room_id].timestamp:
+			newest[message.room_id] = message
+	for room_id, message in newest.items():
+		PrivateChatRoom.objects.filter(pk=room_id).filter(Q(last_message_at=None) | Q(last_message_at__lte=message.timestamp)).update(
+			last_message_at=message.timestamp,
+			last_message_preview=message.content[:INBOX_MESSAGE_PREVIEW_LENGTH],
+			last_sender_id=message.user_id,
+		)
+
+
+def notify_unread_message(room, user, message):
+	"""
+	`user` was sent `message` while not connected to the room.
+	The unread messages are counted from the read watermark (see UnreadChatRoomMessages), so nothing is counted here:
+	the "chat" Notification of the user only shows the latest message (it is created, or marked as unread again,
+	by the first message after a read).
+		1. SELECT ... FOR UPDATE the UnreadChatRoomMessages row, then SELECT the notification: two messages
+			sent at the same time (two server processes) are applied one after the other, so they can't both
+			create a notification. mark_room_read UPDATEs the same row, so it waits for it too.
+		2. Notification.save: lock the NotificationCounter, UPDATE the notification, UPDATE the counter (only if
+			the notification was read)
+		3. the push to the user's sockets: the unread count and the UnreadChatRoomMessages of the notification
+	"""
+	other_user = room.user2 if user.id == room.user1_id else room.user1
+	content_type = get_chat_notification_content_type()
+	unread_msgs = UnreadChatRoomMessages.objects.filter(room=room, user=user)
+	with transaction.atomic():
+		object_id = unread_msgs.select_for_update().order_by("id").values_list("id", flat=True).first()
+		if object_id == None:
+			# Should never happen: they are created with the room (see create_unread_chatroom_messages_obj)
+			unread = UnreadChatRoomMessages(room=room, user=user)
+			unread.save()
+			object_id = unread.id
+		notification = Notification.objects.filter(target=user, content_type=content_type, object_id__in=unread_msgs.values("id")).first()
+		if notification != None:
+			notification.read = False
+			notification.verb = message
+			notification.timestamp = timezone.now()
+			# Already loaded: saves a query when the notification is pushed
+			notification.from_user = other_user
+			notification.save(update_fields=["read", "verb", "timestamp"])
+		else:
+			Notification(
+				target=user,
+				from_user=other_user,
+				redirect_url=f"{settings.BASE_URL}/chat/?room_id={room.id}", # we want to go to the chatroom
+				verb=message,
+				content_type=content_type,
+				object_id=object_id,
+			).save()
+
+
+def mark_room_read(room, user):
+	"""
+	`user` joined or left the room: every message sent until now is read.
+	Moves the read watermark and marks the "chat" Notification of the user as read (it is kept, not deleted:
+	the next unread message only has to flip it back).
+	"""
+	content_type = get_chat_notification_content_type()
+	unread_msgs = UnreadChatRoomMessages.objects.filter(room=room, user=user)
+	with transaction.atomic():
+		updated = unread_msgs.update(last_read_timestamp=timezone.now())
+		if updated == 0:
+			UnreadChatRoomMessages(room=room, user=user).save()
+		notification = Notification.objects.filter(target=user, content_type=content_type, object_id__in=unread_msgs.values("id"), read=False).first()
+		if notification != None:
+			notification.read = True
+			notification.save(update_fields=["read"])
+
+
+def revoke_private_chat_access(room):
+	"""
+	The users of this room are no longer friends. Close every socket that joined the room (see ChatConsumer.chat_revoke).
+	Sent once the transaction commits.
+	"""
+	group_name = room.group_name
+	event = {
+		"type": "chat.revoke",
+		"room_id": room.id,
+	}
+	def send():
+		channel_layer = get_channel_layer()
+		if channel_layer is None:
+			return
+		try:
+			async_to_sync(channel_layer.group_send)(group_name, event)
+		except Exception as e:
+			# A missing/unavailable channel layer must never break unfriending.
+			print("EXCEPTION: revoke_private_chat_access: " + str(e))
+	transaction.on_commit(send)
+
+
+def get_epoch_timestamp(timestamp):
+	"""
+	Milliseconds since the epoch. Sent with every message (next to natural_timestamp) so clients
+	don't have to parse the display string.
+	"""
+	return int(timestamp.timestamp() * 1000)
+
+
+def from_epoch_timestamp(epoch_timestamp):
+	return datetime.fromtimestamp(epoch_timestamp / 1000, tz=timezone.utc)
+
+
+INBOX_CURSOR_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def encode_inbox_cursor(room):
+	"""
+	Position of a room in the inbox: (last_message_at, id). last_message_at is empty for a room without messages.
+	"""
+	microseconds = ""
+	if room.last_message_at != None:
+		microseconds = (room.last_message_at - INBOX_CURSOR_EPOCH) // timedelta(microseconds=1)
+	raw = f"{microseconds}:{room.pk}"
+	return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_inbox_cursor(cursor):
+	"""
+	Returns (last_message_at, id). Raises ValueError if the cursor was not made by encode_inbox_cursor.
+	"""
+	try:
+		raw = base64.urlsafe_b64decode(str(cursor).encode()).decode()
+		microseconds, pk = raw.split(":")
+		last_message_at = None
+		if microseconds != "":
+			last_message_at = INBOX_CURSOR_EPOCH + timedelta(microseconds=int(microseconds))
+		return last_message_at, int(pk)
+	except Exception:
+		raise ValueError(f"Invalid inbox cursor: {cursor}")
+
+
 def calculate_timestamp(timestamp):
 	"""
 	1. Today or yesterday:
@@ -51,6 +216,7 @@ class LazyRoomChatMessageEncoder(Serializer):
         dump_object.update({'message': str(obj.content)})
         dump_object.update({'profile_image': str(obj.user.profile_image.url)})
         dump_object.update({'natural_timestamp': calculate_timestamp(obj.timestamp)})
+        dump_object.update({'timestamp': get_epoch_timestamp(obj.timestamp)})
         return dump_object
 
 
@@ -2,19 +2,20 @@ from django.shortcuts import render, redirect
 from django.urls import reverse
 from django.conf import settings
 from django.core.paginator import Paginator
+from django.db import connection
+from django.db.models import F, Q, OuterRef, Subquery
 from django.http import HttpResponse
 from django.utils import timezone
+from functools import reduce
 from urllib.parse import urlencode
 import json
-from itertools import chain
-from datetime import datetime
-import pytz
+import operator
 
 
-from friend.models import FriendList
 from account.models import Account
-from chat.models import PrivateChatRoom, RoomChatMessage
-from chat.utils import find_or_create_private_chat
+from chat.models import PrivateChatRoom, UnreadChatRoomMessages
+from chat.utils import find_or_create_private_chat, encode_inbox_cursor, decode_inbox_cursor
+from chat.constants import DEFAULT_INBOX_PAGE_SIZE
 
 
 DEBUG = False
@@ -31,7 +32,13 @@ def private_chat_room_view(request, *args, **kwargs):
 
 	context = {}
 
-	context['m_and_f'] = get_recent_chatroom_messages(user)
+	inbox_cursor = request.GET.get("inbox_cursor")
+	try:
+		context['m_and_f'], context['next_inbox_cursor'] = get_recent_chatroom_messages(user, inbox_cursor)
+	except ValueError:
+		inbox_cursor = None
+		context['m_and_f'], context['next_inbox_cursor'] = get_recent_chatroom_messages(user)
+	context['is_first_inbox_page'] = inbox_cursor == None
 
 	context["BASE_URL"] = settings.BASE_URL
 	if room_id:
@@ -41,59 +48,80 @@ def private_chat_room_view(request, *args, **kwargs):
 	return render(request, "chat/room.html", context)
 
 
-def get_recent_chatroom_messages(user):
+def get_recent_chatroom_messages(user, cursor=None):
 	"""
-	sort in terms of most recent chats (users that you most recently had conversations with)
+	The inbox: the active private chats of the user, most recent message first (chats without messages last).
+	Chats of users who are no longer friends are not active (see FriendList.remove_friend).
+	Keyset pagination on (last_message_at, id): a page costs the same whatever its position.
+	One query: the rooms of the page with both users and the read watermark of the user (see get_inbox_rooms).
+	cursor: the next_cursor of the previous page, None for the first page. Raises ValueError if it is invalid.
+	Returns ([{'message', 'friend', 'room_id', 'is_unread'}, ...], next_cursor). next_cursor is None on the last page.
 	"""
-	# 1. Find all the rooms this user is a part of 
-	rooms1 = PrivateChatRoom.objects.filter(user1=user, is_active=True)
-	rooms2 = PrivateChatRoom.objects.filter(user2=user, is_active=True)
+	page_size = DEFAULT_INBOX_PAGE_SIZE
+	last_message_at, last_id = decode_inbox_cursor(cursor) if cursor != None else (None, None)
+	# One extra row tells if there is another page (no COUNT)
+	rooms = list(get_inbox_rooms(user, get_inbox_branches(user, cursor != None, last_message_at, last_id), page_size + 1))
 
-	# 2. merge the lists
-	rooms = list(chain(rooms1, rooms2))
-
-	# 3. find the newest msg in each room
 	m_and_f = []
-	for room in rooms:
+	for room in rooms[:page_size]:
 		# Figure out which user is the "other user" (aka friend)
-		if room.user1 == user:
-			friend = room.user2
-		else:
-			friend = room.user1
-
-		# confirm you are even friends (in case chat is left active somehow)
-		friend_list = FriendList.objects.get(user=user)
-		if not friend_list.is_mutual_friend(friend):
-			chat = find_or_create_private_chat(user, friend)
-			chat.is_active = False
-			chat.save()
-		else:	
-			# find newest msg from that friend in the chat room
-			try:
-				message = RoomChatMessage.objects.filter(room=room, user=friend).latest("timestamp")
-			except RoomChatMessage.DoesNotExist:
-				# create a dummy message with dummy timestamp
-				today = datetime(
-					year=1950, 
-					month=1, 
-					day=1, 
-					hour=1,
-					minute=1,
-					second=1,
-					tzinfo=pytz.UTC
-				)
-				message = RoomChatMessage(
-					user=friend,
-					room=room,
-					timestamp=today,
-					content="",
+		friend = room.user2 if room.user1_id == user.id else room.user1
+		is_unread = room.last_message_at != None and room.last_sender_id != user.id and (
+			room.last_read_timestamp == None or room.last_message_at > room.last_read_timestamp
+		)
+		m_and_f.append({
+			'message': room.last_message_preview,
+			'friend': friend,
+			'room_id': room.id,
+			'is_unread': is_unread,
+		})
+	next_cursor = None
+	if len(rooms) > page_size:
+		next_cursor = encode_inbox_cursor(rooms[page_size - 1])
+	return m_and_f, next_cursor
+
+
+def get_inbox_branches(user, after_cursor, last_message_at, last_id):
+	"""
+	The inbox rooms after the cursor (last_message_at, last_id), for each side of the room (user1, user2):
+		1. the rooms with messages, older than the cursor, in (-last_message_at, -id) order
+		2. the rooms without messages (last_message_at is NULL), with a lower id than the cursor, in -id order
+	Each one is a range scan of chat_room_user1_inbox_idx or chat_room_user2_inbox_idx in index order.
+	A single "user1 OR user2" query ordered with NULLS LAST can use neither index for its order.
+	"""
+	branches = []
+	for user_field in ["user1", "user2"]:
+		rooms = PrivateChatRoom.objects.filter(is_active=True, **{user_field: user})
+		if not after_cursor or last_message_at != None:
+			with_message = rooms.filter(last_message_at__isnull=False)
+			if last_message_at != None:
+				with_message = with_message.filter(last_message_at__lte=last_message_at).exclude(
+					last_message_at=last_message_at, id__gte=last_id
 				)
-			m_and_f.append({
-				'message': message,
-				'friend': friend
-			})
+			branches.append(with_message.order_by("-last_message_at", "-id"))
+		without_message = rooms.filter(last_message_at__isnull=True)
+		if after_cursor and last_message_at == None:
+			without_message = without_message.filter(id__lt=last_id)
+		branches.append(without_message.order_by("-id"))
+	return branches
 
-	return sorted(m_and_f, key=lambda x: x['message'].timestamp, reverse=True)
+
+def get_inbox_rooms(user, branches, count):
+	"""
+	The first `count` rooms of the branches, in inbox order, with both users and the read watermark of the user.
+	One query:
+		PostgreSQL: UNION ALL of the first `count` rooms of each branch, so each branch is read from its index.
+		Databases that can't order and limit the parts of a UNION (SQLite): the branches ORed in one query.
+	"""
+	last_read_timestamp = UnreadChatRoomMessages.objects.filter(room=OuterRef("pk"), user=user).values("last_read_timestamp")[:1]
+	def with_page_fields(rooms):
+		return rooms.select_related("user1", "user2").annotate(last_read_timestamp=Subquery(last_read_timestamp))
+	if connection.features.supports_slicing_ordering_in_compound:
+		parts = [with_page_fields(branch)[:count] for branch in branches]
+		rooms = parts[0].union(*parts[1:], all=True)
+	else:
+		rooms = with_page_fields(reduce(operator.or_, [branch.order_by() for branch in branches]))
+	return rooms.order_by(F("last_message_at").desc(nulls_last=True), "-id")[:count]
 
 
 # Ajax call to return a private chatroom or create one if does not exist
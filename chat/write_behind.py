@@ -0,0 +1,215 @@
+"""
+Batched persistence of chat messages (RoomChatMessage and PublicRoomChatMessage).
+
+settings.CHAT_MESSAGE_PERSISTENCE
+	"immediate" (default):
+		Every message is inserted (one INSERT) before it is broadcast.
+	"group_commit":
+		Messages are inserted in batches with bulk_create. A message is broadcast once its batch is stored,
+		so nothing is broadcast that is not stored. Costs up to CHAT_MESSAGE_BATCH_DELAY of latency.
+	"write_behind":
+		Messages are broadcast right away and inserted in batches afterwards.
+		Messages still in the buffer when the process is killed are lost. They are flushed on a normal shutdown.
+settings.CHAT_MESSAGE_BATCH_SIZE
+	A batch is written as soon as it has this many messages...
+settings.CHAT_MESSAGE_BATCH_DELAY
+	...or once its first message has waited this many seconds.
+
+On PostgreSQL the ids are reserved from the table's sequence (a block at a time), so a message has its id
+before it is stored and can be broadcast with it. Other databases assign the id on insert (see can_reserve_ids):
+there the messages are stored one at a time, as in "immediate" mode, so none is broadcast without its id.
+
+on_write(messages), if given, is called with the messages once they are stored, whatever the mode
+(Ex: chat.utils.update_last_messages). Its errors are logged: the messages are stored anyway.
+
+Metrics (see ChatServerPlayground.metrics), <name> is the name of the buffer:
+	<name>.batch_size, <name>.flush_seconds: summaries
+	<name>.messages_stored, <name>.messages_dropped: counters
+"""
+import asyncio
+import atexit
+import logging
+import threading
+import time
+from collections import deque
+
+from django.conf import settings
+from django.db import connection, transaction
+from channels.db import database_sync_to_async
+
+from ChatServerPlayground import metrics
+from chat.constants import *
+
+
+logger = logging.getLogger(__name__)
+
+# Every buffer, so they can be flushed when the process exits
+buffers = []
+
+
+class MessageWriteBuffer:
+
+	def __init__(self, model, name, on_write=None):
+		self.model = model
+		self.name = name
+		self.on_write = on_write
+		# (message, future). future is None unless the sender waits for the message to be stored.
+		self.pending = []
+		self.flush_handle = None
+		self.lock = threading.Lock()
+		self.reserved_ids = deque()
+		buffers.append(self)
+
+	@property
+	def mode(self):
+		return getattr(settings, "CHAT_MESSAGE_PERSISTENCE", MESSAGE_PERSISTENCE_IMMEDIATE)
+
+	@property
+	def batch_size(self):
+		return getattr(settings, "CHAT_MESSAGE_BATCH_SIZE", DEFAULT_MESSAGE_BATCH_SIZE)
+
+	@property
+	def batch_delay(self):
+		return getattr(settings, "CHAT_MESSAGE_BATCH_DELAY", DEFAULT_MESSAGE_BATCH_DELAY)
+
+	async def save(self, message):
+		"""
+		Persist an unsaved message according to CHAT_MESSAGE_PERSISTENCE (right away if its id can't be reserved).
+		Returns once the message can be broadcast. Raises the database error if the message could not be stored
+		(never in "write_behind" mode, the message is already gone).
+		"""
+		if self.mode == MESSAGE_PERSISTENCE_IMMEDIATE or not can_reserve_ids():
+			await database_sync_to_async(self.write_one)(message)
+			return
+
+		await self.assign_id(message)
+		loop = asyncio.get_event_loop()
+		future = None
+		if self.mode == MESSAGE_PERSISTENCE_GROUP_COMMIT:
+			future = loop.create_future()
+		with self.lock:
+			self.pending.append((message, future))
+			is_full = len(self.pending) >= self.batch_size
+			if not is_full and self.flush_handle == None:
+				self.flush_handle = loop.call_later(self.batch_delay, lambda: asyncio.ensure_future(self.flush()))
+		if is_full:
+			await self.flush()
+		if future != None:
+			await future
+
+	async def assign_id(self, message):
+		if len(self.reserved_ids) == 0:
+			ids = await database_sync_to_async(reserve_ids)(self.model, self.batch_size)
+			self.reserved_ids.extend(ids)
+		message.id = self.reserved_ids.popleft()
+
+	async def flush(self):
+		"""
+		Write the pending messages. Called when the batch is full or CHAT_MESSAGE_BATCH_DELAY expired.
+		"""
+		with self.lock:
+			batch = self.pending
+			self.pending = []
+			if self.flush_handle != None:
+				self.flush_handle.cancel()
+				self.flush_handle = None
+		if len(batch) == 0:
+			return
+		errors = await database_sync_to_async(self.write)([message for message, future in batch])
+		for (message, future), error in zip(batch, errors):
+			if future != None and not future.done():
+				if error == None:
+					future.set_result(message)
+				else:
+					future.set_exception(error)
+
+	def write(self, messages):
+		"""
+		Insert a batch of messages with bulk_create.
+		Returns the error of each message (None if it was stored).
+		"""
+		start = time.monotonic()
+		errors = [None] * len(messages)
+		try:
+			# Savepoints: a failed insert must not break the caller's transaction, if there is one
+			with transaction.atomic():
+				self.model.objects.bulk_create(messages)
+		except Exception as e:
+			# One bad message (Ex: its room was deleted) must not lose the whole batch
+			logger.warning("%s: bulk_create failed, storing the messages one at a time: %s", self.name, e)
+			for i, message in enumerate(messages):
+				try:
+					with transaction.atomic():
+						message.save(force_insert=True)
+				except Exception as e:
+					logger.error("%s: dropped message: %s", self.name, e)
+					errors[i] = e
+		self.call_on_write([message for message, error in zip(messages, errors) if error == None])
+		self.record_write(len(messages), len([error for error in errors if error != None]), start)
+		return errors
+
+	def write_one(self, message):
+		"""
+		Insert a single message ("immediate" mode): a batch of one. Raises the database error.
+		"""
+		start = time.monotonic()
+		try:
+			message.save()
+		except Exception:
+			self.record_write(1, 1, start)
+			raise
+		self.call_on_write([message])
+		self.record_write(1, 0, start)
+
+	def record_write(self, size, dropped, start):
+		metrics.observe(self.name + ".batch_size", size)
+		metrics.observe(self.name + ".flush_seconds", time.monotonic() - start)
+		metrics.increment(self.name + ".messages_stored", size - dropped)
+		if dropped > 0:
+			metrics.increment(self.name + ".messages_dropped", dropped)
+
+	def call_on_write(self, messages):
+		if self.on_write == None or len(messages) == 0:
+			return
+		try:
+			self.on_write(messages)
+		except Exception as e:
+			logger.exception("%s: on_write", self.name)
+
+	def flush_now(self):
+		"""
+		Write the pending messages from the calling thread. Used when the process exits.
+		"""
+		with self.lock:
+			batch = self.pending
+			self.pending = []
+		if len(batch) > 0:
+			self.write([message for message, future in batch])
+
+
+def can_reserve_ids():
+	"""
+	Whether ids can be taken from the table's sequence before the insert (see reserve_ids).
+	"""
+	return connection.vendor == "postgresql"
+
+
+def reserve_ids(model, count):
+	"""
+	Take `count` ids from the id sequence of the model's table (PostgreSQL) in one query.
+	"""
+	with connection.cursor() as cursor:
+		cursor.execute(
+			"SELECT nextval(pg_get_serial_sequence(%s, 'id')) FROM generate_series(1, %s)",
+			[model._meta.db_table, count]
+		)
+		return [row[0] for row in cursor.fetchall()]
+
+
+@atexit.register
+def flush_buffers_on_exit():
+	for buffer in buffers:
+		try:
+			buffer.flush_now()
+		except Exception as e:
+			logger.exception("flush_buffers_on_exit: %s", buffer.name)
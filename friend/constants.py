@@ -0,0 +1,15 @@
+"""
+Cache of the friends of each user (settings.FRIEND_GRAPH). See friend.graph.
+"""
+DEFAULT_FRIEND_GRAPH_MAX_USERS = 10000
+DEFAULT_FRIEND_GRAPH_LOCAL_TIMEOUT = 10 # seconds
+DEFAULT_FRIEND_GRAPH_TIMEOUT = 60 * 60 # seconds
+DEFAULT_FRIEND_SUGGESTIONS_MAX_FRIENDS = 200
+NUM_FRIEND_SUGGESTIONS = 5 # shown on the account page
+DEFAULT_FRIEND_LIST_PAGE_SIZE = 50 # friends per page of friends_list_view
+
+# Upper bounds of the queries of FriendRequest.accept/decline/cancel, enforced by friend/tests.py.
+# Counted on SQLite: they include the savepoints of the transaction and reading back the ids of the new notifications.
+ACCEPT_FRIEND_REQUEST_MAX_QUERIES = 22
+DECLINE_FRIEND_REQUEST_MAX_QUERIES = 13
+CANCEL_FRIEND_REQUEST_MAX_QUERIES = 13
@@ -0,0 +1,200 @@
+"""
+Who is friends with whom, as sets of user ids.
+
+Friend checks used to load the whole friend list (`friend in friend_list.friends.all()`), once per check.
+The friend ids of a user are now loaded once, kept as a set and reused: a check is a set lookup and
+"which of these accounts are my friends" is a set intersection.
+
+Two tiers:
+	1. a size-bounded LRU of the process. Entries are only trusted for LOCAL_TIMEOUT seconds, because another
+		process may have changed the friends of the user meanwhile.
+	2. optionally, a shared cache so the other processes don't query them either.
+Both are invalidated when friends are added or removed (see the m2m_changed receiver in friend.models), once the
+transaction commits.
+
+Reads only: code that changes friendships must check the database (Ex: FriendList.add_friend).
+
+Mutual friends and suggestions ("people you may know") are set intersections over the same sets, so they cost at
+most one query whatever the number of friends.
+
+settings.FRIEND_GRAPH
+	"MAX_USERS": number of users kept in the LRU of each process (default 10000)
+	"LOCAL_TIMEOUT": seconds an entry of the LRU is trusted (default 10)
+	"SHARED_CACHE": alias of a cache in settings.CACHES (Ex: "default") shared by the processes, or None (default)
+	"TIMEOUT": seconds the friends of a user are kept in the shared cache (default 1 hour)
+	"SUGGESTIONS_MAX_FRIENDS": number of friends of the user whose friends are suggested (default 200)
+
+Metrics (see ChatServerPlayground.metrics):
+	friend.graph.hits, friend.graph.shared_hits, friend.graph.misses: counters
+	friend.graph.users: gauge
+"""
+import random
+import threading
+import time
+from collections import Counter, OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+
+from ChatServerPlayground import metrics
+from friend.constants import *
+
+
+def get_friend_graph_setting(key, default):
+	return getattr(settings, "FRIEND_GRAPH", {}).get(key, default)
+
+
+class FriendGraph:
+
+	def __init__(self):
+		# user_id -> (friend ids, time they were loaded), least recently used first
+		self.friends = OrderedDict()
+		# Friend checks run in request threads and database threads (database_sync_to_async)
+		self.lock = threading.Lock()
+
+	@property
+	def shared_cache(self):
+		alias = get_friend_graph_setting("SHARED_CACHE", None)
+		if alias == None:
+			return None
+		return caches[alias]
+
+	def get_key(self, user_id):
+		return f"friend.graph:{user_id}"
+
+	def is_friend(self, user_id, other_user_id):
+		return other_user_id in self.get_friend_ids(user_id)
+
+	def filter_friends(self, user_id, account_ids):
+		"""
+		The ids in account_ids of the friends of the user (Ex: which search results are friends).
+		"""
+		return self.get_friend_ids(user_id).intersection(account_ids)
+
+	def get_friend_ids(self, user_id):
+		"""
+		frozenset of the ids of the friends of the user.
+		"""
+		return self.get_friend_ids_many([user_id])[user_id]
+
+	def get_friend_ids_many(self, user_ids):
+		"""
+		{user_id: frozenset of friend ids} for several users. The users that are not cached are loaded with one query.
+		"""
+		result = {}
+		now = time.time()
+		local_timeout = get_friend_graph_setting("LOCAL_TIMEOUT", DEFAULT_FRIEND_GRAPH_LOCAL_TIMEOUT)
+		with self.lock:
+			for user_id in user_ids:
+				entry = self.friends.get(user_id)
+				if entry != None and entry[1] > now - local_timeout:
+					self.friends.move_to_end(user_id)
+					result[user_id] = entry[0]
+		if len(result) > 0:
+			metrics.increment("friend.graph.hits", len(result))
+		missing = [user_id for user_id in set(user_ids) if user_id not in result]
+		if len(missing) == 0:
+			return result
+
+		shared_cache = self.shared_cache
+		if shared_cache != None:
+			try:
+				cached = shared_cache.get_many([self.get_key(user_id) for user_id in missing])
+			except Exception as e:
+				# The database still has them
+				print("EXCEPTION: friend.graph: shared cache: " + str(e))
+				cached = {}
+			for user_id in missing:
+				friend_ids = cached.get(self.get_key(user_id))
+				if friend_ids != None:
+					result[user_id] = frozenset(friend_ids)
+					self.add(user_id, result[user_id], now)
+					metrics.increment("friend.graph.shared_hits")
+			missing = [user_id for user_id in missing if user_id not in result]
+			if len(missing) == 0:
+				return result
+
+		metrics.increment("friend.graph.misses", len(missing))
+		loaded = self.load(missing)
+		for user_id in missing:
+			result[user_id] = loaded[user_id]
+			self.add(user_id, loaded[user_id], now)
+		if shared_cache != None:
+			try:
+				shared_cache.set_many(
+					dict([(self.get_key(user_id), list(loaded[user_id])) for user_id in missing]),
+					get_friend_graph_setting("TIMEOUT", DEFAULT_FRIEND_GRAPH_TIMEOUT),
+				)
+			except Exception as e:
+				print("EXCEPTION: friend.graph: shared cache: " + str(e))
+		return result
+
+	def count_mutual_friends(self, user_id, other_user_ids):
+		"""
+		{other_user_id: number of friends they have in common with the user}.
+		"""
+		other_user_ids = list(other_user_ids)
+		friend_sets = self.get_friend_ids_many([user_id] + other_user_ids)
+		friend_ids = friend_sets[user_id]
+		return dict([(other_user_id, len(friend_ids & friend_sets[other_user_id])) for other_user_id in other_user_ids])
+
+	def suggest_friends(self, user_id, count):
+		"""
+		People you may know: the friends of the friends of the user that aren't friends with the user yet.
+		[(account_id, number of mutual friends), ...], most mutual friends first.
+		A user with more than SUGGESTIONS_MAX_FRIENDS friends gets the suggestions of a random sample of them,
+		so the work doesn't grow with the number of friends.
+		"""
+		friend_ids = self.get_friend_ids(user_id)
+		max_friends = get_friend_graph_setting("SUGGESTIONS_MAX_FRIENDS", DEFAULT_FRIEND_SUGGESTIONS_MAX_FRIENDS)
+		sources = list(friend_ids)
+		if len(sources) > max_friends:
+			sources = random.sample(sources, max_friends)
+		mutual_friends = Counter()
+		for friends_of_friend in self.get_friend_ids_many(sources).values():
+			mutual_friends.update(friends_of_friend - friend_ids)
+		mutual_friends.pop(user_id, None)
+		# Ties: the oldest accounts first
+		suggestions = sorted(mutual_friends.items(), key=lambda item: (-item[1], item[0]))
+		return suggestions[:count]
+
+	def load(self, user_ids):
+		from friend.models import FriendList
+		friends = dict([(user_id, set()) for user_id in user_ids])
+		rows = FriendList.friends.through.objects.filter(friendlist__user_id__in=user_ids).values_list("friendlist__user_id", "account_id")
+		for user_id, friend_id in rows:
+			friends[user_id].add(friend_id)
+		return dict([(user_id, frozenset(friend_ids)) for user_id, friend_ids in friends.items()])
+
+	def add(self, user_id, friend_ids, loaded_at):
+		max_users = get_friend_graph_setting("MAX_USERS", DEFAULT_FRIEND_GRAPH_MAX_USERS)
+		with self.lock:
+			self.friends[user_id] = (friend_ids, loaded_at)
+			self.friends.move_to_end(user_id)
+			while len(self.friends) > max_users:
+				self.friends.popitem(last=False)
+			metrics.gauge("friend.graph.users", len(self.friends))
+
+	def invalidate(self, user_ids):
+		"""
+		The friends of these users changed. Forgotten now and again once the transaction commits
+		(so a concurrent read can't cache what is about to change).
+		"""
+		user_ids = list(user_ids)
+		self.forget(user_ids)
+		transaction.on_commit(lambda: self.forget(user_ids))
+
+	def forget(self, user_ids):
+		with self.lock:
+			for user_id in user_ids:
+				self.friends.pop(user_id, None)
+		shared_cache = self.shared_cache
+		if shared_cache != None:
+			try:
+				shared_cache.delete_many([self.get_key(user_id) for user_id in user_ids])
+			except Exception as e:
+				print("EXCEPTION: friend.graph: shared cache: " + str(e))
+
+
+friend_graph = FriendGraph()
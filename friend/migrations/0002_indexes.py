@@ -0,0 +1,22 @@
+# Generated by Django 2.2.15 on 2026-10-18 13:28
+
+from django.db import migrations, models
+
+from ChatServerPlayground.operations import AddIndexConcurrently
+
+
+class Migration(migrations.Migration):
+
+    # CREATE INDEX CONCURRENTLY can't run inside a transaction (PostgreSQL)
+    atomic = False
+
+    dependencies = [
+        ('friend', '0001_initial'),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name='friendrequest',
+            index=models.Index(condition=models.Q(is_active=True), fields=['receiver', 'sender'], name='friend_request_active_idx'),
+        ),
+    ]
@@ -1,13 +1,16 @@
 from django.contrib.contenttypes.fields import GenericRelation
 from django.contrib.contenttypes.models import ContentType
-from django.db import models
+from django.db import models, transaction
+from django.db.models import Q
 from django.conf import settings
 from django.utils import timezone
-from django.db.models.signals import post_save
+from django.db.models.signals import post_save, m2m_changed
 from django.dispatch import receiver
 
-from chat.utils import find_or_create_private_chat
+from chat.utils import find_or_create_private_chat, activate_private_chat, revoke_private_chat_access
 from notification.models import Notification
+from notification.utils import save_notifications
+from friend.graph import friend_graph
 
 
 class FriendList(models.Model):
@@ -25,7 +28,8 @@ class FriendList(models.Model):
 		"""
 		Add a new friend.
 		"""
-		if not account in self.friends.all():
+		# Not friend_graph: it may be a few seconds behind, and this must not skip a change
+		if not self.friends.filter(pk=account.pk).exists():
 			self.friends.add(account)
 			self.save()
 
@@ -61,7 +65,7 @@ class FriendList(models.Model):
 		"""
 		Remove a friend.
 		"""
-		if account in self.friends.all():
+		if self.friends.filter(pk=account.pk).exists():
 			self.friends.remove(account)
 
 			# Deactivate the private chat between these two users
@@ -70,6 +74,9 @@ class FriendList(models.Model):
 				chat.is_active = False
 				chat.save()
 
+				# Drop the sockets that are in the chat right now
+				revoke_private_chat_access(chat)
+
 	def unfriend(self, removee):
 		"""
 		Initiate the action of unfriending someone.
@@ -114,9 +121,7 @@ class FriendList(models.Model):
 		"""
 		Is this a friend?
 		"""
-		if friend in self.friends.all():
-			return True
-		return False
+		return friend_graph.is_friend(self.user_id, friend.id)
 
 
 
@@ -138,6 +143,12 @@ class FriendRequest(models.Model):
 
 	notifications		= GenericRelation(Notification)
 
+	class Meta:
+		indexes = [
+			# Pending (active) requests between two users, and the pending requests a user received
+			models.Index(fields=['receiver', 'sender'], name='friend_request_active_idx', condition=models.Q(is_active=True)),
+		]
+
 	def __str__(self):
 		return self.sender.username
 
@@ -145,68 +156,83 @@ class FriendRequest(models.Model):
 		"""
 		Accept a friend request.
 		Update both SENDER and RECEIVER friend lists.
+		One transaction, so concurrent accepts (or an accept racing a cancel) can't half-apply:
+			1. the request is claimed with a conditional UPDATE: only one of them gets it
+			2. the friend lists of both users are locked
+			3. the friendships are inserted with one statement, the notifications are written in bulk (see save_notifications)
+		At most ACCEPT_FRIEND_REQUEST_MAX_QUERIES queries (enforced in friend/tests.py).
+		Returns the updated notification of the RECEIVER, or None if the request was not pending anymore.
 		"""
-		receiver_friend_list = FriendList.objects.get(user=self.receiver)
-		if receiver_friend_list:
-			content_type = ContentType.objects.get_for_model(self)
+		with transaction.atomic():
+			if not self.deactivate():
+				return None
+			sender_friend_list, receiver_friend_list = lock_friend_lists(self.sender, self.receiver)
+			added = add_friendship(sender_friend_list, receiver_friend_list)
 
 			# Update notification for RECEIVER
-			receiver_notification = Notification.objects.get(target=self.receiver, content_type=content_type, object_id=self.id)
+			receiver_notification = self.get_receiver_notification()
 			receiver_notification.is_active = False
 			receiver_notification.redirect_url = f"{settings.BASE_URL}/account/{self.sender.pk}/"
 			receiver_notification.verb = f"You accepted {self.sender.username}'s friend request."
 			receiver_notification.timestamp = timezone.now()
-			receiver_notification.save()
-
-			receiver_friend_list.add_friend(self.sender)
 
-			sender_friend_list = FriendList.objects.get(user=self.sender)
-			if sender_friend_list:
-
-				# Create notification for SENDER
-				self.notifications.create(
-					target=self.sender,
-					from_user=self.receiver,
-					redirect_url=f"{settings.BASE_URL}/account/{self.receiver.pk}/",
-					verb=f"{self.receiver.username} accepted your friend request.",
-					content_type=content_type,
-				)
-
-				sender_friend_list.add_friend(self.receiver)
-				# sender_friend_list.save()
-				self.is_active = False
-				self.save()
-			return receiver_notification # we will need this later to update the realtime notifications
+			# Create notification for SENDER
+			notifications = [Notification(
+				target=self.sender,
+				from_user=self.receiver,
+				redirect_url=f"{settings.BASE_URL}/account/{self.receiver.pk}/",
+				verb=f"{self.receiver.username} accepted your friend request.",
+				content_type=ContentType.objects.get_for_model(self),
+				object_id=self.id,
+			)]
+			# "You are now friends with..." for the users whose friend list changed
+			friend_list_content_type = ContentType.objects.get_for_model(FriendList)
+			for friend_list, friend in [(receiver_friend_list, self.sender), (sender_friend_list, self.receiver)]:
+				if friend_list.id in added:
+					notifications.append(Notification(
+						target=friend_list.user,
+						from_user=friend,
+						redirect_url=f"{settings.BASE_URL}/account/{friend.pk}/",
+						verb=f"You are now friends with {friend.username}.",
+						content_type=friend_list_content_type,
+						object_id=friend_list.id,
+					))
+			save_notifications(created=notifications, updated=[receiver_notification])
+
+			if len(added) > 0:
+				activate_private_chat(self.sender, self.receiver)
+		return receiver_notification # we will need this later to update the realtime notifications
 
 
 	def decline(self):
 		"""
 		Decline a friend request.
 		Is it "declined" by setting the `is_active` field to False
+		One transaction, at most DECLINE_FRIEND_REQUEST_MAX_QUERIES queries (see accept).
+		Returns the updated notification of the RECEIVER, or None if the request was not pending anymore.
 		"""
-		self.is_active = False
-		self.save()
-
-		content_type = ContentType.objects.get_for_model(self)
-
-		# Update notification for RECEIVER
-		notification = Notification.objects.get(target=self.receiver, content_type=content_type, object_id=self.id)
-		notification.is_active = False
-		notification.redirect_url = f"{settings.BASE_URL}/account/{self.sender.pk}/"
-		notification.verb = f"You declined {self.sender}'s friend request."
-		notification.from_user = self.sender
-		notification.timestamp = timezone.now()
-		notification.save()
-
-		# Create notification for SENDER
-		self.notifications.create(
-			target=self.sender,
-			verb=f"{self.receiver.username} declined your friend request.",
-			from_user=self.receiver,
-			redirect_url=f"{settings.BASE_URL}/account/{self.receiver.pk}/",
-			content_type=content_type,
-		)
+		with transaction.atomic():
+			if not self.deactivate():
+				return None
 
+			# Update notification for RECEIVER
+			notification = self.get_receiver_notification()
+			notification.is_active = False
+			notification.redirect_url = f"{settings.BASE_URL}/account/{self.sender.pk}/"
+			notification.verb = f"You declined {self.sender}'s friend request."
+			notification.from_user = self.sender
+			notification.timestamp = timezone.now()
+
+			# Create notification for SENDER
+			sender_notification = Notification(
+				target=self.sender,
+				verb=f"{self.receiver.username} declined your friend request.",
+				from_user=self.receiver,
+				redirect_url=f"{settings.BASE_URL}/account/{self.receiver.pk}/",
+				content_type=ContentType.objects.get_for_model(self),
+				object_id=self.id,
+			)
+			save_notifications(created=[sender_notification], updated=[notification])
 		return notification
 
 
@@ -215,26 +241,47 @@ class FriendRequest(models.Model):
 		Cancel a friend request.
 		Is it "cancelled" by setting the `is_active` field to False.
 		This is only different with respect to "declining" through the notification that is generated.
+		One transaction, at most CANCEL_FRIEND_REQUEST_MAX_QUERIES queries (see accept).
+		Returns False if the request was not pending anymore.
 		"""
-		self.is_active = False
-		self.save()
+		with transaction.atomic():
+			if not self.deactivate():
+				return False
+
+			# Create notification for SENDER
+			sender_notification = Notification(
+				target=self.sender,
+				verb=f"You cancelled the friend request to {self.receiver.username}.",
+				from_user=self.receiver,
+				redirect_url=f"{settings.BASE_URL}/account/{self.receiver.pk}/",
+				content_type=ContentType.objects.get_for_model(self),
+				object_id=self.id,
+			)
 
-		content_type = ContentType.objects.get_for_model(self)
+			notification = self.get_receiver_notification()
+			notification.verb = f"{self.sender.username} cancelled the friend request sent to you."
+			#notification.timestamp = timezone.now()
+			notification.read = False
+			save_notifications(created=[sender_notification], updated=[notification])
+		return True
 
-		# Create notification for SENDER
-		self.notifications.create(
-			target=self.sender,
-			verb=f"You cancelled the friend request to {self.receiver.username}.",
-			from_user=self.receiver,
-			redirect_url=f"{settings.BASE_URL}/account/{self.receiver.pk}/",
-			content_type=content_type,
-		)
+	def deactivate(self):
+		"""
+		Mark the request as no longer pending, if it still is. A conditional UPDATE: when two users act on the same
+		request at the same time (Ex: the receiver accepts while the sender cancels), only one of them gets True.
+		"""
+		updated = FriendRequest.objects.filter(pk=self.pk, is_active=True).update(is_active=False)
+		self.is_active = False
+		return updated == 1
 
-		notification = Notification.objects.get(target=self.receiver, content_type=content_type, object_id=self.id)
-		notification.verb = f"{self.sender.username} cancelled the friend request sent to you."
-		#notification.timestamp = timezone.now()
-		notification.read = False
-		notification.save()
+	def get_receiver_notification(self):
+		"""
+		The notification the RECEIVER got when the request was sent (see create_notification).
+		"""
+		notification = Notification.objects.get(target_id=self.receiver_id, content_type=ContentType.objects.get_for_model(self), object_id=self.id)
+		# Already loaded: saves a query when the notification is pushed
+		notification.from_user = self.sender
+		return notification
 
 	@property
 	def get_cname(self):
@@ -244,6 +291,41 @@ class FriendRequest(models.Model):
 		return "FriendRequest"
 
 
+def lock_friend_lists(*users):
+	"""
+	Lock the FriendLists of these users until the transaction ends, in user order so concurrent calls can't deadlock.
+	Returns them in the order of `users`.
+	"""
+	friend_lists = FriendList.objects.select_for_update().filter(user__in=users).order_by("user_id")
+	friend_lists = dict([(friend_list.user_id, friend_list) for friend_list in friend_lists])
+	for user in users:
+		if user.id not in friend_lists:
+			raise FriendList.DoesNotExist(f"Could not find a friends list for {user.username}")
+		# Already loaded: the notifications need it
+		friend_lists[user.id].user = user
+	return [friend_lists[user.id] for user in users]
+
+
+def add_friendship(friend_list1, friend_list2):
+	"""
+	Add each user to the friend list of the other with one INSERT (the friend lists must be locked, see lock_friend_lists).
+	Returns the ids of the friend lists that changed (empty if they were already friends).
+	"""
+	through = FriendList.friends.through
+	existing = set(through.objects.filter(
+		Q(friendlist_id=friend_list1.id, account_id=friend_list2.user_id) | Q(friendlist_id=friend_list2.id, account_id=friend_list1.user_id)
+	).values_list("friendlist_id", flat=True))
+	rows = []
+	for friend_list, friend in [(friend_list1, friend_list2.user_id), (friend_list2, friend_list1.user_id)]:
+		if friend_list.id not in existing:
+			rows.append(through(friendlist_id=friend_list.id, account_id=friend))
+	if len(rows) > 0:
+		through.objects.bulk_create(rows)
+		# bulk_create doesn't send m2m_changed (see invalidate_friend_graph)
+		friend_graph.invalidate([friend_list1.user_id, friend_list2.user_id])
+	return [row.friendlist_id for row in rows]
+
+
 @receiver(post_save, sender=FriendRequest)
 def create_notification(sender, instance, created, **kwargs):
 	if created:
@@ -256,15 +338,17 @@ def create_notification(sender, instance, created, **kwargs):
 		)
 
 
-
-
-
-
-
-
-
-
-
-
-
-
+@receiver(m2m_changed, sender=FriendList.friends.through)
+def invalidate_friend_graph(sender, instance, action, reverse, pk_set, **kwargs):
+	"""
+	Friends were added or removed (add_friend, remove_friend, the admin...): forget the cached friends.
+	"""
+	if not reverse and action in ["post_add", "post_remove", "post_clear"]:
+		# instance is a FriendList, pk_set are accounts
+		friend_graph.invalidate([instance.user_id])
+	elif reverse and action in ["post_add", "post_remove"]:
+		# instance is an Account, pk_set are FriendLists
+		friend_graph.invalidate(FriendList.objects.filter(pk__in=pk_set).values_list("user_id", flat=True))
+	elif reverse and action == "pre_clear":
+		# The FriendLists are unknown once cleared
+		friend_graph.invalidate(FriendList.objects.filter(friends=instance).values_list("user_id", flat=True))
@@ -1,3 +1,219 @@
+from unittest import mock
+
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+
+from ChatServerPlayground.test_utils import create_account, explain
+from friend.graph import friend_graph
+from friend.models import FriendList, FriendRequest
+from friend.constants import *
+from chat.models import PrivateChatRoom
+from notification.models import Notification, NotificationCounter
+from notification.utils import rebuild_notification_counters
+
+
+class FriendRequestIndexTestCase(TestCase):
+	"""
+	Lookups of pending friend requests must use the partial index on active requests.
+	"""
+
+	def setUp(self):
+		self.sender = create_account("sender")
+		self.receiver = create_account("receiver")
+
+	def test_pending_request_between_users(self):
+		plan = explain(FriendRequest.objects.filter(sender=self.sender, receiver=self.receiver, is_active=True))
+		self.assertIn("friend_request_active_idx", plan)
+
+	def test_pending_requests_received(self):
+		plan = explain(FriendRequest.objects.filter(receiver=self.receiver, is_active=True))
+		self.assertIn("friend_request_active_idx", plan)
+
+
+class FriendRequestActionsTestCase(TestCase):
+	"""
+	accept/decline/cancel are atomic, can only apply once, and stay within their query budget.
+	"""
+
+	def setUp(self):
+		friend_graph.friends.clear()
+		self.sender = create_account("sender")
+		self.receiver = create_account("receiver")
+		rebuild_notification_counters(user_ids=[self.sender.id, self.receiver.id])
+		self.friend_request = FriendRequest.objects.create(sender=self.sender, receiver=self.receiver)
+		# As the views get it
+		self.friend_request = FriendRequest.objects.get(pk=self.friend_request.pk)
+
+	def assertMaxQueries(self, max_queries, action):
+		with CaptureQueriesContext(connection) as context:
+			result = action()
+		self.assertLessEqual(len(context.captured_queries), max_queries, "\n".join([query["sql"] for query in context.captured_queries]))
+		return result
+
+	def get_unread_general_count(self, user):
+		return NotificationCounter.objects.get(user=user).unread_general_count
+
+	def test_accept(self):
+		notification = self.assertMaxQueries(ACCEPT_FRIEND_REQUEST_MAX_QUERIES, self.friend_request.accept)
+		self.assertEqual(notification.verb, "You accepted sender's friend request.")
+		self.assertFalse(FriendRequest.objects.get(pk=self.friend_request.pk).is_active)
+		self.assertTrue(friend_graph.is_friend(self.sender.id, self.receiver.id))
+		self.assertTrue(friend_graph.is_friend(self.receiver.id, self.sender.id))
+		self.assertTrue(PrivateChatRoom.objects.get(user1=self.sender, user2=self.receiver).is_active)
+		# "accepted your friend request" and "You are now friends with..."
+		self.assertEqual(Notification.objects.filter(target=self.sender).count(), 2)
+		self.assertEqual(self.get_unread_general_count(self.sender), 2)
+		# The request (updated) and "You are now friends with..."
+		self.assertEqual(Notification.objects.filter(target=self.receiver).count(), 2)
+		self.assertEqual(self.get_unread_general_count(self.receiver), 2)
+		# The counters match a recount
+		for counter in rebuild_notification_counters(user_ids=[self.sender.id, self.receiver.id]):
+			self.assertEqual(counter.unread_general_count, 2)
+
+	def test_accept_reactivates_private_chat(self):
+		room = PrivateChatRoom.objects.create(user1=self.receiver, user2=self.sender, is_active=False)
+		self.friend_request.accept()
+		room.refresh_from_db()
+		self.assertTrue(room.is_active)
+		self.assertEqual(PrivateChatRoom.objects.count(), 1)
+
+	def test_applies_once(self):
+		other = FriendRequest.objects.get(pk=self.friend_request.pk)
+		self.assertTrue(other.cancel())
+		self.assertEqual(self.friend_request.accept(), None)
+		self.assertEqual(self.friend_request.decline(), None)
+		self.assertFalse(other.cancel())
+		self.assertFalse(friend_graph.is_friend(self.sender.id, self.receiver.id))
+		# "You cancelled the friend request..." only
+		self.assertEqual(Notification.objects.filter(target=self.sender).count(), 1)
+
+	def test_decline(self):
+		notification = self.assertMaxQueries(DECLINE_FRIEND_REQUEST_MAX_QUERIES, self.friend_request.decline)
+		self.assertEqual(notification.verb, "You declined sender's friend request.")
+		self.assertFalse(FriendRequest.objects.get(pk=self.friend_request.pk).is_active)
+		self.assertFalse(friend_graph.is_friend(self.sender.id, self.receiver.id))
+		self.assertEqual(self.get_unread_general_count(self.sender), 1)
+		self.assertEqual(self.get_unread_general_count(self.receiver), 1)
+
+	def test_cancel(self):
+		self.assertTrue(self.assertMaxQueries(CANCEL_FRIEND_REQUEST_MAX_QUERIES, self.friend_request.cancel))
+		notification = Notification.objects.get(target=self.receiver)
+		self.assertEqual(notification.verb, "sender cancelled the friend request sent to you.")
+		self.assertEqual(self.get_unread_general_count(self.sender), 1)
+		self.assertEqual(self.get_unread_general_count(self.receiver), 1)
+
+
+class FriendGraphTestCase(TestCase):
+	"""
+	Friend checks are set lookups on friend ids loaded once, and see friends being added and removed right away.
+	"""
+
+	def setUp(self):
+		# Ids are reused between tests: forget what previous tests cached
+		friend_graph.friends.clear()
+		self.user = create_account("user")
+		self.friends = [create_account(f"friend{i}") for i in range(3)]
+		self.stranger = create_account("stranger")
+		for friend in self.friends:
+			FriendRequest.objects.create(sender=friend, receiver=self.user).accept()
+
+	def test_friend_checks_cost_one_query(self):
+		with self.assertNumQueries(1):
+			for account in self.friends + [self.stranger]:
+				friend_graph.is_friend(self.user.id, account.id)
+			friend_ids = friend_graph.filter_friends(self.user.id, [account.id for account in self.friends + [self.stranger]])
+		self.assertEqual(friend_ids, set([friend.id for friend in self.friends]))
+
+	def test_batch_of_users(self):
+		with self.assertNumQueries(1):
+			friend_ids = friend_graph.get_friend_ids_many([self.user.id, self.friends[0].id, self.stranger.id])
+		self.assertEqual(friend_ids[self.friends[0].id], frozenset([self.user.id]))
+		self.assertEqual(friend_ids[self.stranger.id], frozenset())
+
+	def test_invalidated_by_add_and_remove(self):
+		self.assertFalse(friend_graph.is_friend(self.user.id, self.stranger.id))
+		FriendRequest.objects.create(sender=self.stranger, receiver=self.user).accept()
+		self.assertTrue(friend_graph.is_friend(self.user.id, self.stranger.id))
+		self.assertTrue(friend_graph.is_friend(self.stranger.id, self.user.id))
+
+		FriendList.objects.get(user=self.user).unfriend(self.stranger)
+		self.assertFalse(friend_graph.is_friend(self.user.id, self.stranger.id))
+		self.assertFalse(friend_graph.is_friend(self.stranger.id, self.user.id))
+
+	def test_mutual_friends_and_suggestions(self):
+		# stranger is friends with friend0 and friend1, but not with user
+		for friend in self.friends[:2]:
+			FriendRequest.objects.create(sender=self.stranger, receiver=friend).accept()
+		other = create_account("other")
+		FriendRequest.objects.create(sender=other, receiver=self.friends[2]).accept()
+		friend_graph.friends.clear()
+		# The friends of the user, then the friends of their friends
+		with self.assertNumQueries(2):
+			num_mutual_friends = friend_graph.count_mutual_friends(self.user.id, [self.stranger.id, other.id])
+			suggestions = friend_graph.suggest_friends(self.user.id, 5)
+		self.assertEqual(num_mutual_friends, {self.stranger.id: 2, other.id: 1})
+		# Neither the user nor their friends are suggested
+		self.assertEqual(suggestions, [(self.stranger.id, 2), (other.id, 1)])
+		self.assertEqual(friend_graph.suggest_friends(self.user.id, 1), [(self.stranger.id, 2)])
+
+	def test_views_query_budget_does_not_grow_with_friends(self):
+		for i in range(20):
+			friend = create_account(f"more{i}")
+			FriendRequest.objects.create(sender=friend, receiver=self.user).accept()
+		FriendRequest.objects.create(sender=self.stranger, receiver=self.friends[0]).accept()
+		self.client.force_login(self.user)
+		friend_graph.friends.clear()
+		# account, friend list, session, user, friend graph (2 queries), suggested accounts, friend requests
+		with self.assertNumQueries(8):
+			response = self.client.get(f"/account/{self.user.id}/")
+		self.assertEqual(response.context['num_friends'], 23)
+		self.assertEqual(response.context['friend_suggestions'], [(self.stranger, 1)])
+		friend_graph.friends.clear()
+		# session, user, account, friend list, the page of friends with their mutual friend counts, friend graph (1 query)
+		with self.assertNumQueries(6):
+			response = self.client.get(f"/friend/list/{self.user.id}")
+		self.assertEqual(len(response.context['friends']), 23)
+
+
+class FriendListViewTestCase(TestCase):
+	"""
+	friends_list_view pages the friends and counts the mutual friends of the page in the database.
+	"""
+
+	def setUp(self):
+		friend_graph.friends.clear()
+		self.user = create_account("user")
+		self.friends = [create_account(f"friend{i}") for i in range(3)]
+		for friend in self.friends:
+			FriendRequest.objects.create(sender=friend, receiver=self.user).accept()
+		# Friends of friend0 that the user doesn't know: friends with 2 and 0 other friends of the user
+		self.other = create_account("other")
+		self.stranger = create_account("stranger")
+		for account in [self.other, self.stranger]:
+			FriendRequest.objects.create(sender=account, receiver=self.friends[0]).accept()
+		FriendRequest.objects.create(sender=self.other, receiver=self.friends[1]).accept()
+		self.client.force_login(self.user)
+
+	def get_page(self, after_id=None):
+		url = f"/friend/list/{self.friends[0].id}"
+		if after_id != None:
+			url += f"?after={after_id}"
+		response = self.client.get(url)
+		return [(friend.username, is_friend, num_mutual_friends) for friend, is_friend, num_mutual_friends in response.context['friends']], response.context['next_after_id']
+
+	def test_mutual_friends(self):
+		friends, next_after_id = self.get_page()
+		self.assertEqual(friends, [("user", False, 3), ("other", False, 2), ("stranger", False, 1)])
+		self.assertIsNone(next_after_id)
 
-# Create your tests here.
+	def test_pages(self):
+		friends = []
+		after_id = None
+		with mock.patch("friend.views.DEFAULT_FRIEND_LIST_PAGE_SIZE", 2):
+			while True:
+				page, after_id = self.get_page(after_id)
+				friends += page
+				if after_id == None:
+					break
+		self.assertEqual(friends, [("user", False, 3), ("other", False, 2), ("stranger", False, 1)])
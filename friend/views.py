@@ -1,9 +1,13 @@
 from django.shortcuts import render
 from django.http import HttpResponse
+from django.db.models import Count, IntegerField, OuterRef, Subquery
+from django.db.models.functions import Coalesce
 import json
 
 from account.models import Account
 from friend.models import FriendRequest, FriendList
+from friend.graph import friend_graph
+from friend.constants import DEFAULT_FRIEND_LIST_PAGE_SIZE
 
 
 def friends_list_view(request, *args, **kwargs):
@@ -24,19 +28,48 @@ def friends_list_view(request, *args, **kwargs):
 			
 			# Must be friends to view a friends list
 			if user != this_user:
-				if not user in friend_list.friends.all():
+				if not friend_graph.is_friend(this_user.id, user.id):
 					return HttpResponse("You must be friends to view their friends list.")
-			friends = [] # [(friend1, True), (friend2, False), ...]
-			# get the authenticated users friend list
-			auth_user_friend_list = FriendList.objects.get(user=user)
-			for friend in friend_list.friends.all():
-				friends.append((friend, auth_user_friend_list.is_mutual_friend(friend)))
-			context['friends'] = friends
+			after_id = request.GET.get("after")
+			try:
+				context['friends'], context['next_after_id'] = get_friend_list_page(friend_list, user, after_id)
+			except ValueError:
+				after_id = None
+				context['friends'], context['next_after_id'] = get_friend_list_page(friend_list, user)
+			context['is_first_page'] = after_id == None
 	else:		
 		return HttpResponse("You must be friends to view their friends list.")
 	return render(request, "friend/friend_list.html", context)
 
 
+def get_friend_list_page(friend_list, user, after_id=None):
+	"""
+	A page of the friends in `friend_list`, in id order, and the number of friends each of them has in common with `user`.
+	One query for the page and its counts: for each friend on the page, their friends are counted in the FriendList.friends
+	table, keeping only the friends of `user`. Nothing is counted for the friends on the other pages.
+	after_id: the last id of the previous page, None for the first page. Raises ValueError if it is invalid.
+	Returns ([(friend, is a friend of `user`, number of mutual friends), ...], next_after_id). next_after_id is None on the last page.
+	"""
+	page_size = DEFAULT_FRIEND_LIST_PAGE_SIZE
+	through = FriendList.friends.through
+	user_friend_ids = through.objects.filter(friendlist__user=user).values("account_id")
+	# COUNT(*) of the friends of one friend (OuterRef) that are also friends of the user. Run for the rows of the page only.
+	num_mutual_friends = through.objects.filter(friendlist__user=OuterRef("pk"), account_id__in=user_friend_ids).order_by().values(
+		"friendlist"
+	).annotate(count=Count("*")).values("count")
+	page = friend_list.friends.annotate(
+		num_mutual_friends=Coalesce(Subquery(num_mutual_friends, output_field=IntegerField()), 0)
+	).order_by("id")
+	if after_id != None:
+		page = page.filter(id__gt=int(after_id))
+	# One extra row tells if there is another page (no COUNT)
+	page = list(page[:page_size + 1])
+	auth_user_friend_ids = friend_graph.get_friend_ids(user.id)
+	friends = [(friend, friend.id in auth_user_friend_ids, friend.num_mutual_friends) for friend in page[:page_size]]
+	next_after_id = page[page_size - 1].id if len(page) > page_size else None
+	return friends, next_after_id
+
+
 def friend_requests(request, *args, **kwargs):
 	context = {}
 	user = request.user
@@ -101,7 +134,10 @@ def accept_friend_request(request, *args, **kwargs):
 				if friend_request: 
 					# found the request. Now accept it
 					updated_notification = friend_request.accept()
-					payload['response'] = "Friend request accepted."
+					if updated_notification != None:
+						payload['response'] = "Friend request accepted."
+					else:
+						payload['response'] = "That friend request is no longer pending."
 
 				else:
 					payload['response'] = "Something went wrong."
@@ -149,7 +185,10 @@ def decline_friend_request(request, *args, **kwargs):
 				if friend_request: 
 					# found the request. Now decline it
 					updated_notification = friend_request.decline()
-					payload['response'] = "Friend request declined."
+					if updated_notification != None:
+						payload['response'] = "Friend request declined."
+					else:
+						payload['response'] = "That friend request is no longer pending."
 				else:
 					payload['response'] = "Something went wrong."
 			else:
@@ -177,14 +216,14 @@ def cancel_friend_request(request, *args, **kwargs):
 				payload['response'] = "Nothing to cancel. Friend request does not exist."
 
 			# There should only ever be ONE active friend request at any given time. Cancel them all just in case.
-			if len(friend_requests) > 1:
-				for request in friend_requests:
-					request.cance()
+			cancelled = False
+			for friend_request in friend_requests:
+				if friend_request.cancel():
+					cancelled = True
+			if cancelled:
 				payload['response'] = "Friend request canceled."
 			else:
-				# found the request. Now cancel it
-				friend_requests.first().cancel()
-				payload['response'] = "Friend request canceled."
+				payload['response'] = "Nothing to cancel. Friend request does not exist."
 		else:
 			payload['response'] = "Unable to cancel that friend request."
 	else:
@@ -2,7 +2,7 @@ from django.contrib import admin
 
 from django.contrib import admin
 
-from notification.models import Notification
+from notification.models import Notification, NotificationCounter
 
 class NotificationAdmin(admin.ModelAdmin):
     list_filter = ['content_type',]
@@ -15,3 +15,15 @@ class NotificationAdmin(admin.ModelAdmin):
 
 
 admin.site.register(Notification, NotificationAdmin)
+
+
+class NotificationCounterAdmin(admin.ModelAdmin):
+    list_display = ['user', 'unread_general_count', 'unread_chat_count', 'version']
+    search_fields = ['user__username',]
+    readonly_fields = ['user',]
+
+    class Meta:
+        model = NotificationCounter
+
+
+admin.site.register(NotificationCounter, NotificationCounterAdmin)
@@ -11,6 +11,7 @@ GENERAL_MSG_TYPE_NOTIFICATIONS_REFRESH_PAYLOAD = 2  # Retrieved all 'general' no
 GENERAL_MSG_TYPE_GET_NEW_GENERAL_NOTIFICATIONS = 3  # Get any new notifications
 GENERAL_MSG_TYPE_GET_UNREAD_NOTIFICATIONS_COUNT = 4  # Send the number of unread "general" notifications to the template
 GENERAL_MSG_TYPE_UPDATED_NOTIFICATION = 5  # Update a notification that has been altered (Ex: Accept/decline a friend request)
+GENERAL_MSG_TYPE_REMOVED_NOTIFICATION = 6  # A 'general' notification was deleted and should be removed from the template
 
 
 """
@@ -21,5 +22,26 @@ CHAT_MSG_TYPE_NOTIFICATIONS_PAYLOAD = 10  # New 'chat' notifications data payloa
 CHAT_MSG_TYPE_PAGINATION_EXHAUSTED = 11  # No more 'chat' notifications to retrieve
 CHAT_MSG_TYPE_GET_NEW_NOTIFICATIONS = 13  # Get any new chat notifications
 CHAT_MSG_TYPE_GET_UNREAD_NOTIFICATIONS_COUNT = 14 # number of chat notifications
+CHAT_MSG_TYPE_REMOVED_NOTIFICATION = 15 # A 'chat' notification was deleted and should be removed from the template
 
 
+"""
+Events pushed to the per-user notification group (see notification.utils.push_notification_event).
+"""
+NOTIFICATION_CATEGORY_GENERAL = "general"
+NOTIFICATION_CATEGORY_CHAT = "chat"
+
+NOTIFICATION_ACTION_CREATED = "created"
+NOTIFICATION_ACTION_UPDATED = "updated"
+NOTIFICATION_ACTION_REMOVED = "removed"
+
+
+
+
+"""
+'sync' command: one delta of both categories since the version the client last synced.
+"""
+SYNC_MSG_TYPE_DELTA = 20  # Changes since the client's version (or "unchanged", or "reset")
+
+NOTIFICATION_SYNC_MAX_VERSIONS = 1000  # RemovedNotification tombstones kept per user. Clients further behind are reset.
+NOTIFICATION_SYNC_MAX_NOTIFICATIONS = 50  # More changed notifications than this and the client is reset instead
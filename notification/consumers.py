@@ -1,22 +1,34 @@
 from django.conf import settings
-from channels.generic.websocket import AsyncJsonWebsocketConsumer
-from django.core.paginator import Paginator
 from django.core.serializers import serialize
+from django.db import connection
 from channels.db import database_sync_to_async
 from django.contrib.contenttypes.models import ContentType
-
-import json
-from datetime import datetime
+from functools import reduce
+import operator
 
 from chat.models import UnreadChatRoomMessages
 from friend.models import FriendRequest, FriendList
 from notification.models import Notification
-from notification.utils import LazyNotificationEncoder
+from notification.utils import (
+	LazyNotificationEncoder,
+	get_notification_group_name,
+	get_general_notification_content_types,
+	get_chat_notification_content_type,
+	encode_notification_cursor,
+	older_than_cursor,
+	newer_than_cursor,
+	at_or_newer_than_cursor,
+	at_or_older_than_cursor,
+	get_unread_notification_counts,
+	get_notifications_delta,
+	mark_general_notifications_read,
+)
 from notification.constants import *
 from chat.exceptions import ClientError
+from chat.base_consumer import BaseJsonConsumer, encode_frame
 
 
-class NotificationConsumer(AsyncJsonWebsocketConsumer):
+class NotificationConsumer(BaseJsonConsumer):
 	"""
 	Passing data to and from header.html. Notifications are displayed as "drop-downs" in the nav bar.
 	There is two major categories of notifications:
@@ -32,14 +44,29 @@ class NotificationConsumer(AsyncJsonWebsocketConsumer):
 		Called when the websocket is handshaking as part of initial connection.
 		"""
 		print("NotificationConsumer: connect: " + str(self.scope["user"]) )
+		self.negotiate_flow_control()
 		await self.accept()
 
+		# Notifications are pushed to this group as they are created/updated (see notification.utils.push_notification_event)
+		self.notification_group_name = None
+		if self.scope["user"].is_authenticated:
+			self.notification_group_name = get_notification_group_name(self.scope["user"].id)
+			await self.channel_layer.group_add(
+				self.notification_group_name,
+				self.channel_name,
+			)
+
 
 	async def disconnect(self, code):
 		"""
 		Called when the WebSocket closes for any reason.
 		"""
 		print("NotificationConsumer: disconnect")
+		if getattr(self, "notification_group_name", None) != None:
+			await self.channel_layer.group_discard(
+				self.notification_group_name,
+				self.channel_name,
+			)
 
 
 	async def receive_json(self, content):
@@ -50,68 +77,62 @@ class NotificationConsumer(AsyncJsonWebsocketConsumer):
 		command = content.get("command", None)
 		print("NotificationConsumer: receive_json. Command: " + command)
 		try:
-			if command == "get_general_notifications":
-				payload = await get_general_notifications(self.scope["user"], content.get("page_number", None))
-				if payload == None:
+			if command == "sync":
+				frame = await sync_notifications(self.scope["user"], content.get("version", None))
+				await self.send_frame(frame)
+			elif command == "get_general_notifications":
+				frame = await get_general_notifications(self.scope["user"], content.get("cursor", None))
+				if frame == None:
 					await self.general_pagination_exhausted()
 				else:
-					payload = json.loads(payload)
-					await self.send_general_notifications_payload(payload['notifications'], payload['new_page_number'])
+					await self.send_frame(frame)
 			elif command == "get_new_general_notifications":
-				payload = await get_new_general_notifications(self.scope["user"], content.get("newest_timestamp", None))
-				if payload != None:
-					payload = json.loads(payload)
-					await self.send_new_general_notifications_payload(payload['notifications'])
+				frame = await get_new_general_notifications(self.scope["user"], content.get("newest_cursor", None))
+				if frame != None:
+					await self.send_frame(frame)
 			elif command == "accept_friend_request":
 				notification_id = content['notification_id']
-				payload = await accept_friend_request(self.scope['user'], notification_id)
-				if payload == None:
+				frame = await accept_friend_request(self.scope['user'], notification_id)
+				if frame == None:
 					raise ClientError("UNKNOWN_ERROR", "Something went wrong. Try refreshing the browser.")
 				else:
-					payload = json.loads(payload)
-					await self.send_updated_friend_request_notification(payload['notification'])
+					await self.send_frame(frame)
 			elif command == "decline_friend_request":
 				notification_id = content['notification_id']
-				payload = await decline_friend_request(self.scope['user'], notification_id)
-				if payload == None:
+				frame = await decline_friend_request(self.scope['user'], notification_id)
+				if frame == None:
 					raise ClientError("UNKNOWN_ERROR", "Something went wrong. Try refreshing the browser.")
 				else:
-					payload = json.loads(payload)
-					await self.send_updated_friend_request_notification(payload['notification'])
+					await self.send_frame(frame)
 			elif command == "refresh_general_notifications":
-				payload = await refresh_general_notifications(self.scope["user"], content['oldest_timestamp'], content['newest_timestamp'])
-				if payload == None:
+				frame = await refresh_general_notifications(self.scope["user"], content.get('oldest_cursor', None), content.get('newest_cursor', None))
+				if frame == None:
 					raise ClientError("UNKNOWN_ERROR", "Something went wrong. Try refreshing the browser.")
 				else:
-					payload = json.loads(payload)
-					await self.send_general_refreshed_notifications_payload(payload['notifications'])
+					await self.send_frame(frame)
 			elif command == "get_unread_general_notifications_count":
-				payload = await get_unread_general_notification_count(self.scope["user"])
-				if payload != None:
-					payload = json.loads(payload)
-					await self.send_unread_general_notification_count(payload['count'])
+				frame = await get_unread_general_notification_count(self.scope["user"])
+				if frame != None:
+					await self.send_frame(frame)
 			elif command == "mark_notifications_read":
-				await mark_notifications_read(self.scope["user"])
+				await mark_notifications_read(self.scope["user"], content.get("newest_cursor", None))
 
 			elif command == "get_chat_notifications":
-				payload = await get_chat_notifications(self.scope["user"], content.get("page_number", None))
-				if payload == None:
+				frame = await get_chat_notifications(self.scope["user"], content.get("cursor", None))
+				if frame == None:
 					await self.chat_pagination_exhausted()
 				else:
-					payload = json.loads(payload)
-					await self.send_chat_notifications_payload(payload['notifications'], payload['new_page_number'])
+					await self.send_frame(frame)
 		
 			elif command == "get_new_chat_notifications":
-				payload = await get_new_chat_notifications(self.scope["user"], content.get("newest_timestamp", None))
-				if payload != None:
-					payload = json.loads(payload)
-					await self.send_new_chat_notifications_payload(payload['notifications'])
+				frame = await get_new_chat_notifications(self.scope["user"], content.get("newest_cursor", None))
+				if frame != None:
+					await self.send_frame(frame)
 			elif command == "get_unread_chat_notifications_count":
 				try:
-					payload = await get_unread_chat_notification_count(self.scope["user"])
-					if payload != None:
-						payload = json.loads(payload)
-						await self.send_unread_chat_notification_count(payload['count'])
+					frame = await get_unread_chat_notification_count(self.scope["user"])
+					if frame != None:
+						await self.send_frame(frame)
 				except Exception as e:
 					print("UNREAD CHAT MESSAGE COUNT EXCEPTION: " + str(e))
 					pass
@@ -119,52 +140,41 @@ class NotificationConsumer(AsyncJsonWebsocketConsumer):
 			print("EXCEPTION: receive_json: " + str(e))
 			pass
 
-	async def display_progress_bar(self, shouldDisplay):
-		print("NotificationConsumer: display_progress_bar: " + str(shouldDisplay)) 
-		await self.send_json(
-			{
-				"progress_bar": shouldDisplay,
-			},
-		)
-
-	async def send_general_notifications_payload(self, notifications, new_page_number):
+	async def notification_push(self, event):
 		"""
-		Called by receive_json when ready to send a json array of the notifications
+		Called when a Notification for this user is created, updated or removed.
+		Pushed frames reuse the msg types the template already handles for polled results.
 		"""
-		#print("NotificationConsumer: send_general_notifications_payload")
-		await self.send_json(
-			{
-				"general_msg_type": GENERAL_MSG_TYPE_NOTIFICATIONS_PAYLOAD,
-				"notifications": notifications,
-				"new_page_number": new_page_number,
-			},
-		)
-
-	async def send_updated_friend_request_notification(self, notification):
+		notification_id = event["notification_id"]
+		if event["category"] == NOTIFICATION_CATEGORY_CHAT:
+			if event["action"] == NOTIFICATION_ACTION_REMOVED:
+				await self.send_removed_chat_notification(notification_id)
+			else:
+				await self.send_new_chat_notifications_payload([event["notification"]], event["cursor"])
+			if event["count"] != None:
+				await self.send_unread_chat_notification_count(event["count"])
+		else:
+			if event["action"] == NOTIFICATION_ACTION_REMOVED:
+				await self.send_removed_general_notification(notification_id)
+			else:
+				await self.send_new_general_notifications_payload([event["notification"]], event["cursor"])
+			if event["count"] != None:
+				await self.send_unread_general_notification_count(event["count"])
+
+	async def notification_count(self, event):
 		"""
-		After a friend request is accepted or declined, send the updated notification to template
-		payload contains 'notification' and 'response':
-		1. payload['notification']
-		2. payload['response']
+		Called when only the unread count of a category changed (Ex: notifications were marked as read in another tab).
 		"""
-		await self.send_json(
-			{
-				"general_msg_type": GENERAL_MSG_TYPE_UPDATED_NOTIFICATION,
-				"notification": notification,
-			},
-		)
+		if event["category"] == NOTIFICATION_CATEGORY_CHAT:
+			await self.send_unread_chat_notification_count(event["count"])
+		else:
+			await self.send_unread_general_notification_count(event["count"])
 
-	async def send_updated_friend_request_notification(self, notification):
-		"""
-		After a friend request is accepted or declined, send the updated notification to template
-		payload contains 'notification' and 'response':
-		1. payload['notification']
-		2. payload['response']
-		"""
+	async def display_progress_bar(self, shouldDisplay):
+		print("NotificationConsumer: display_progress_bar: " + str(shouldDisplay)) 
 		await self.send_json(
 			{
-				"general_msg_type": GENERAL_MSG_TYPE_UPDATED_NOTIFICATION,
-				"notification": notification,
+				"progress_bar": shouldDisplay,
 			},
 		)
 
@@ -179,26 +189,15 @@ class NotificationConsumer(AsyncJsonWebsocketConsumer):
 			},
 		)
 
-	async def send_general_refreshed_notifications_payload(self, notifications):
+	async def send_new_general_notifications_payload(self, notifications, newest_cursor):
 		"""
-		Called by receive_json when ready to send a json array of the notifications
-		"""
-		#print("NotificationConsumer: send_general_refreshed_notifications_payload: " + str(notifications))
-		await self.send_json(
-			{
-				"general_msg_type": GENERAL_MSG_TYPE_NOTIFICATIONS_REFRESH_PAYLOAD,
-				"notifications": notifications,
-			},
-		)
-
-	async def send_new_general_notifications_payload(self, notifications):
-		"""
-		Called by receive_json when ready to send a json array of the notifications
+		Called by receive_json (or notification_push) when ready to send a json array of the notifications
 		"""
 		await self.send_json(
 			{
 				"general_msg_type": GENERAL_MSG_TYPE_GET_NEW_GENERAL_NOTIFICATIONS,
 				"notifications": notifications,
+				"newest_cursor": newest_cursor,
 			},
 		)
 
@@ -206,34 +205,35 @@ class NotificationConsumer(AsyncJsonWebsocketConsumer):
 		"""
 		Send the number of unread "general" notifications to the template
 		"""
-		await self.send_json(
+		# Only the latest count matters
+		await self.send_event(
 			{
 				"general_msg_type": GENERAL_MSG_TYPE_GET_UNREAD_NOTIFICATIONS_COUNT,
 				"count": count,
 			},
+			collapse_key="general_count",
 		)
 
-	async def send_chat_notifications_payload(self, notifications, new_page_number):
+	async def send_removed_general_notification(self, notification_id):
 		"""
-		Called by receive_json when ready to send a json array of the chat notifications
+		A "general" notification was deleted. Remove it from the template.
 		"""
-		#print("NotificationConsumer: send_chat_notifications_payload")
 		await self.send_json(
 			{
-				"chat_msg_type": CHAT_MSG_TYPE_NOTIFICATIONS_PAYLOAD,
-				"notifications": notifications,
-				"new_page_number": new_page_number,
+				"general_msg_type": GENERAL_MSG_TYPE_REMOVED_NOTIFICATION,
+				"notification_id": notification_id,
 			},
 		)
 
-	async def send_new_chat_notifications_payload(self, notifications):
+	async def send_new_chat_notifications_payload(self, notifications, newest_cursor):
 		"""
-		Called by receive_json when ready to send a json array of the notifications
+		Called by receive_json (or notification_push) when ready to send a json array of the notifications
 		"""
 		await self.send_json(
 			{
 				"chat_msg_type": CHAT_MSG_TYPE_GET_NEW_NOTIFICATIONS,
 				"notifications": notifications,
+				"newest_cursor": newest_cursor,
 			},
 		)
 
@@ -248,21 +248,126 @@ class NotificationConsumer(AsyncJsonWebsocketConsumer):
 			},
 		)
 
+	async def send_removed_chat_notification(self, notification_id):
+		"""
+		A "chat" notification was deleted (Ex: the room was deleted). Remove it from the template.
+		"""
+		await self.send_json(
+			{
+				"chat_msg_type": CHAT_MSG_TYPE_REMOVED_NOTIFICATION,
+				"notification_id": notification_id,
+			},
+		)
+
 	async def send_unread_chat_notification_count(self, count):
 		"""
 		Send the number of unread "chat" notifications to the template
 		"""
-		await self.send_json(
+		# Only the latest count matters
+		await self.send_event(
 			{
 				"chat_msg_type": CHAT_MSG_TYPE_GET_UNREAD_NOTIFICATIONS_COUNT,
 				"count": count,
 			},
+			collapse_key="chat_count",
 		)
 
 
 
+def get_notifications_page(branches, cursor, msg_type_key, msg_type):
+	"""
+	Keyset pagination: the page of notifications older than `cursor` (the first page if cursor is None).
+	branches: the notifications, one queryset per content type (see get_notifications_page_queryset).
+	One extra row is fetched to find out if there is another page, so no COUNT(*) is needed.
+	Returns the encoded frame, or None if there are no more notifications.
+	"""
+	try:
+		if cursor != None:
+			branches = [branch.filter(older_than_cursor(cursor)) for branch in branches]
+	except ValueError:
+		raise ClientError("INVALID_CURSOR", "Unable to retrieve notifications. Try refreshing the browser.")
+	page = list(get_notifications_page_queryset(branches, DEFAULT_NOTIFICATION_PAGE_SIZE + 1))
+	if len(page) == 0:
+		return None
+
+	has_next_page = len(page) > DEFAULT_NOTIFICATION_PAGE_SIZE
+	page = page[:DEFAULT_NOTIFICATION_PAGE_SIZE]
+	payload = {}
+	payload[msg_type_key] = msg_type
+	s = LazyNotificationEncoder()
+	payload['notifications'] = s.serialize(page)
+	payload['oldest_cursor'] = encode_notification_cursor(page[-1])
+	payload['newest_cursor'] = encode_notification_cursor(page[0])
+	payload['next_cursor'] = payload['oldest_cursor'] if has_next_page else None
+	return encode_frame(payload)
+
+
+def get_notifications_page_queryset(branches, count):
+	"""
+	The first `count` notifications of the branches, newest first, in one query.
+	Each branch has a single content type, so it is read from notif_target_ct_ts_idx in (-timestamp, -id) order.
+	A single "content_type IN (...)" query has to sort every notification of the user.
+		PostgreSQL: UNION ALL of the first `count` notifications of each branch.
+		Databases that can't order and limit the parts of a UNION (SQLite): the branches ORed in one query.
+	"""
+	if len(branches) > 1 and connection.features.supports_slicing_ordering_in_compound:
+		parts = [branch.order_by('-timestamp', '-id')[:count] for branch in branches]
+		notifications = parts[0].union(*parts[1:], all=True)
+	else:
+		notifications = reduce(operator.or_, branches)
+	return notifications.order_by('-timestamp', '-id')[:count]
+
+
+def get_newer_notifications(notifications, newest_cursor, msg_type_key, msg_type):
+	"""
+	Notifications created (or updated) after `newest_cursor`, newest first.
+	If the client has nothing on screen yet (no cursor) this is just the first page.
+	Otherwise at most a page is sent: the oldest notifications after the cursor, so there is no gap on screen.
+	'next_cursor' is then the new 'newest_cursor' if there are more: send the command again with it.
+	Returns the encoded frame.
+	"""
+	has_next_page = False
+	try:
+		if newest_cursor != None:
+			# Read forwards from the cursor, one extra row tells if there is more
+			page = list(notifications.filter(newer_than_cursor(newest_cursor)).order_by('timestamp', 'id')[:DEFAULT_NOTIFICATION_PAGE_SIZE + 1])
+			has_next_page = len(page) > DEFAULT_NOTIFICATION_PAGE_SIZE
+			notifications = list(reversed(page[:DEFAULT_NOTIFICATION_PAGE_SIZE]))
+		else:
+			notifications = list(notifications.order_by('-timestamp', '-id')[:DEFAULT_NOTIFICATION_PAGE_SIZE])
+	except ValueError:
+		raise ClientError("INVALID_CURSOR", "Unable to retrieve notifications. Try refreshing the browser.")
+
+	payload = {}
+	payload[msg_type_key] = msg_type
+	s = LazyNotificationEncoder()
+	payload['notifications'] = s.serialize(notifications)
+	payload['newest_cursor'] = encode_notification_cursor(notifications[0]) if notifications else newest_cursor
+	payload['next_cursor'] = payload['newest_cursor'] if has_next_page else None
+	return encode_frame(payload)
+
+
 @database_sync_to_async
-def get_general_notifications(user, page_number):
+def sync_notifications(user, version):
+	"""
+	One round trip for both notification menus: what changed since `version` plus both unread counts.
+	version is None when the client has not synced yet.
+	"""
+	if user.is_authenticated:
+		try:
+			if version != None:
+				version = int(version)
+		except (TypeError, ValueError):
+			raise ClientError("INVALID_VERSION", "Unable to sync notifications. Try refreshing the browser.")
+		payload = get_notifications_delta(user.id, version)
+		payload['sync_msg_type'] = SYNC_MSG_TYPE_DELTA
+		return encode_frame(payload)
+	else:
+		raise ClientError("AUTH_ERROR", "User must be authenticated to get notifications.")
+
+
+@database_sync_to_async
+def get_general_notifications(user, cursor):
 	"""
 	Get General Notifications with Pagination (next page of results).
 	This is for appending to the bottom of the notifications list.
@@ -271,26 +376,11 @@ def get_general_notifications(user, page_number):
 	2. FriendList
 	"""
 	if user.is_authenticated:
-		friend_request_ct = ContentType.objects.get_for_model(FriendRequest)
-		friend_list_ct = ContentType.objects.get_for_model(FriendList)
-		notifications = Notification.objects.filter(target=user, content_type__in=[friend_request_ct, friend_list_ct]).order_by('-timestamp')
-		p = Paginator(notifications, DEFAULT_NOTIFICATION_PAGE_SIZE)
-
-		payload = {}
-		if len(notifications) > 0:
-			if int(page_number) <= p.num_pages:
-				s = LazyNotificationEncoder()
-				serialized_notifications = s.serialize(p.page(page_number).object_list)
-				payload['notifications'] = serialized_notifications
-				new_page_number = int(page_number) + 1
-				payload['new_page_number'] = new_page_number
-		else:
-			return None
+		branches = [Notification.objects.filter(target=user, content_type=content_type) for content_type in get_general_notification_content_types()]
+		return get_notifications_page(branches, cursor, "general_msg_type", GENERAL_MSG_TYPE_NOTIFICATIONS_PAYLOAD)
 	else:
 		raise ClientError("AUTH_ERROR", "User must be authenticated to get notifications.")
 
-	return json.dumps(payload)
-
 
 @database_sync_to_async
 def accept_friend_request(user, notification_id):
@@ -306,11 +396,14 @@ def accept_friend_request(user, notification_id):
             if friend_request.receiver == user:
                 # accept the request and get the updated notification
                 updated_notification = friend_request.accept()
+                if updated_notification == None:
+                    raise ClientError("INVALID_REQUEST", "That friend request is no longer pending.")
 
                 # return the notification associated with this FriendRequest
                 s = LazyNotificationEncoder()
+                payload['general_msg_type'] = GENERAL_MSG_TYPE_UPDATED_NOTIFICATION
                 payload['notification'] = s.serialize([updated_notification])[0]
-                return json.dumps(payload)
+                return encode_frame(payload)
         except Notification.DoesNotExist:
             raise ClientError("AUTH_ERROR", "An error occurred with that notification. Try refreshing the browser.")
     return None
@@ -330,11 +423,14 @@ def decline_friend_request(user, notification_id):
 			if friend_request.receiver == user:
 				# accept the request and get the updated notification
 				updated_notification = friend_request.decline()
+				if updated_notification == None:
+					raise ClientError("INVALID_REQUEST", "That friend request is no longer pending.")
 
 				# return the notification associated with this FriendRequest
 				s = LazyNotificationEncoder()
+				payload['general_msg_type'] = GENERAL_MSG_TYPE_UPDATED_NOTIFICATION
 				payload['notification'] = s.serialize([updated_notification])[0]
-				return json.dumps(payload)
+				return encode_frame(payload)
 		except Notification.DoesNotExist:
 			raise ClientError("AUTH_ERROR", "An error occurred with that notification. Try refreshing the browser.")
 	return None
@@ -342,65 +438,52 @@ def decline_friend_request(user, notification_id):
 
 
 @database_sync_to_async
-def refresh_general_notifications(user, oldest_timestamp, newest_timestamp):
+def refresh_general_notifications(user, oldest_cursor, newest_cursor):
 	"""
-	Retrieve the general notifications newer than the oldest one on the screen and younger than the newest one the screen.
+	Retrieve the general notifications between the oldest and the newest one on the screen (inclusive).
 	The result will be: Notifications currently visible will be updated
 	"""
 	payload = {}
 	if user.is_authenticated:
-		oldest_ts = oldest_timestamp[0:oldest_timestamp.find("+")] # remove timezone because who cares
-		oldest_ts = datetime.strptime(oldest_ts, '%Y-%m-%d %H:%M:%S.%f')
-		newest_ts = newest_timestamp[0:newest_timestamp.find("+")] # remove timezone because who cares
-		newest_ts = datetime.strptime(newest_ts, '%Y-%m-%d %H:%M:%S.%f')
-		friend_request_ct = ContentType.objects.get_for_model(FriendRequest)
-		friend_list_ct = ContentType.objects.get_for_model(FriendList)
-		notifications = Notification.objects.filter(target=user, content_type__in=[friend_request_ct, friend_list_ct], timestamp__gte=oldest_ts, timestamp__lte=newest_ts).order_by('-timestamp')
+		notifications = Notification.objects.filter(target=user, content_type__in=get_general_notification_content_types())
+		if oldest_cursor == None or newest_cursor == None:
+			# nothing on screen to refresh
+			notifications = notifications.none()
+		else:
+			try:
+				notifications = notifications.filter(at_or_newer_than_cursor(oldest_cursor)).filter(at_or_older_than_cursor(newest_cursor))
+			except ValueError:
+				raise ClientError("INVALID_CURSOR", "Unable to refresh notifications. Try refreshing the browser.")
 
 		s = LazyNotificationEncoder()
-		payload['notifications'] = s.serialize(notifications)
+		payload['general_msg_type'] = GENERAL_MSG_TYPE_NOTIFICATIONS_REFRESH_PAYLOAD
+		payload['notifications'] = s.serialize(notifications.order_by('-timestamp', '-id'))
 	else:
 		raise ClientError("AUTH_ERROR", "User must be authenticated to get notifications.")
 
-	return json.dumps(payload) 
+	return encode_frame(payload)
 
 
 @database_sync_to_async
-def get_new_general_notifications(user, newest_timestamp):
+def get_new_general_notifications(user, newest_cursor):
 	"""
-	Retrieve any notifications newer than the newest_timestatmp on the screen.
+	Retrieve any notifications newer than the newest_cursor on the screen.
 	"""
-	payload = {}
 	if user.is_authenticated:
-		timestamp = newest_timestamp[0:newest_timestamp.find("+")] # remove timezone because who cares
-		timestamp = datetime.strptime(timestamp, '%Y-%m-%d %H:%M:%S.%f')
-		friend_request_ct = ContentType.objects.get_for_model(FriendRequest)
-		friend_list_ct = ContentType.objects.get_for_model(FriendList)
-		notifications = Notification.objects.filter(target=user, content_type__in=[friend_request_ct, friend_list_ct], timestamp__gt=timestamp, read=False).order_by('-timestamp')
-		s = LazyNotificationEncoder()
-		payload['notifications'] = s.serialize(notifications)
+		notifications = Notification.objects.filter(target=user, content_type__in=get_general_notification_content_types(), read=False)
+		return get_newer_notifications(notifications, newest_cursor, "general_msg_type", GENERAL_MSG_TYPE_GET_NEW_GENERAL_NOTIFICATIONS)
 	else:
 		raise ClientError("AUTH_ERROR", "User must be authenticated to get notifications.")
 
-	return json.dumps(payload) 
-
 
 
 @database_sync_to_async
 def get_unread_general_notification_count(user):
 	payload = {}
 	if user.is_authenticated:
-		friend_request_ct = ContentType.objects.get_for_model(FriendRequest)
-		friend_list_ct = ContentType.objects.get_for_model(FriendList)
-		notifications = Notification.objects.filter(target=user, content_type__in=[friend_request_ct, friend_list_ct])
-
-		unread_count = 0
-		if notifications:
-			for notification in notifications.all():
-				if not notification.read:
-					unread_count = unread_count + 1
-		payload['count'] = unread_count
-		return json.dumps(payload)
+		payload['general_msg_type'] = GENERAL_MSG_TYPE_GET_UNREAD_NOTIFICATIONS_COUNT
+		payload['count'] = get_unread_notification_counts(user.id)[NOTIFICATION_CATEGORY_GENERAL]
+		return encode_frame(payload)
 	else:
 		raise ClientError("AUTH_ERROR", "User must be authenticated to get notifications.")
 	return None
@@ -408,98 +491,56 @@ def get_unread_general_notification_count(user):
 
 
 @database_sync_to_async
-def mark_notifications_read(user):
+def mark_notifications_read(user, newest_cursor):
 	"""
-	marks a notification as "read"
+	marks the "general" notifications up to (and including) newest_cursor as "read".
+	The new unread count is pushed to every socket the user has open.
 	"""
 	if user.is_authenticated:
-		notifications = Notification.objects.filter(target=user)
-		if notifications:
-			for notification in notifications.all():
-				notification.read = True
-				notification.save()
+		try:
+			mark_general_notifications_read(user.id, newest_cursor)
+		except ValueError:
+			raise ClientError("INVALID_CURSOR", "Unable to mark notifications as read. Try refreshing the browser.")
 	return
 
 
 
 @database_sync_to_async
-def get_chat_notifications(user, page_number):
+def get_chat_notifications(user, cursor):
 	"""
 	Get Chat Notifications with Pagination (next page of results).
 	This is for appending to the bottom of the notifications list.
 	Chat Notifications are:
 	1. UnreadChatRoomMessages
+	Only unread ones are listed: they are marked as read when the user opens the chat room.
 	"""
 	if user.is_authenticated:
-		chatmessage_ct = ContentType.objects.get_for_model(UnreadChatRoomMessages)
-		notifications = Notification.objects.filter(target=user, content_type=chatmessage_ct).order_by('-timestamp')
-		p = Paginator(notifications, DEFAULT_NOTIFICATION_PAGE_SIZE)
-
-		# sleep 1s for testing
-		# sleep(1)  
-		print("PAGES: " + str(p.num_pages))
-		payload = {}
-		if len(notifications) > 0:
-			if int(page_number) <= p.num_pages:
-				s = LazyNotificationEncoder()
-				serialized_notifications = s.serialize(p.page(page_number).object_list)
-				payload['notifications'] = serialized_notifications
-				new_page_number = int(page_number) + 1
-				payload['new_page_number'] = new_page_number
-				return json.dumps(payload)
-		else:
-			return None
+		branches = [Notification.objects.filter(target=user, content_type=get_chat_notification_content_type(), read=False)]
+		return get_notifications_page(branches, cursor, "chat_msg_type", CHAT_MSG_TYPE_NOTIFICATIONS_PAYLOAD)
 	else:
 		raise ClientError("AUTH_ERROR", "User must be authenticated to get notifications.")
-	return None
 	
 
 
 @database_sync_to_async
-def get_new_chat_notifications(user, newest_timestatmp):
+def get_new_chat_notifications(user, newest_cursor):
 	"""
-	Retrieve any notifications newer than the newest_timestatmp on the screen.
+	Retrieve any notifications newer than the newest_cursor on the screen.
 	"""
-	payload = {}
 	if user.is_authenticated:
-		timestamp = newest_timestatmp[0:newest_timestatmp.find("+")] # remove timezone because who cares
-		timestamp = datetime.strptime(timestamp, '%Y-%m-%d %H:%M:%S.%f')
-		chatmessage_ct = ContentType.objects.get_for_model(UnreadChatRoomMessages)
-		notifications = Notification.objects.filter(target=user, content_type__in=[chatmessage_ct], timestamp__gt=timestamp).order_by('-timestamp')
-		s = LazyNotificationEncoder()
-		payload['notifications'] = s.serialize(notifications)
-		return json.dumps(payload) 
+		notifications = Notification.objects.filter(target=user, content_type=get_chat_notification_content_type(), read=False)
+		return get_newer_notifications(notifications, newest_cursor, "chat_msg_type", CHAT_MSG_TYPE_GET_NEW_NOTIFICATIONS)
 	else:
 		raise ClientError("AUTH_ERROR", "User must be authenticated to get notifications.")
 
-	return None
-
 
 @database_sync_to_async
 def get_unread_chat_notification_count(user):
     payload = {}
     if user.is_authenticated:
-        chatmessage_ct = ContentType.objects.get_for_model(UnreadChatRoomMessages)
-        notifications = Notification.objects.filter(target=user, content_type__in=[chatmessage_ct])
-        
-        unread_count = 0
-        if notifications:
-            unread_count = len(notifications.all())
-        payload['count'] = unread_count
-        return json.dumps(payload)
+        payload['chat_msg_type'] = CHAT_MSG_TYPE_GET_UNREAD_NOTIFICATIONS_COUNT
+        payload['count'] = get_unread_notification_counts(user.id)[NOTIFICATION_CATEGORY_CHAT]
+        return encode_frame(payload)
     else:
         raise ClientError("AUTH_ERROR", "User must be authenticated to get notifications.")
     return None
-
-
-
-
-
-
-
-
-
-
-
-
-
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+
+from account.models import Account
+from notification.utils import rebuild_notification_counters
+
+
+class Command(BaseCommand):
+	help = "Recount unread notifications and overwrite every user's NotificationCounter."
+
+	def add_arguments(self, parser):
+		parser.add_argument("--user", type=int, action="append", dest="user_ids", help="Only rebuild the counter of this user id. Can be repeated.")
+
+	def handle(self, *args, **options):
+		user_ids = options["user_ids"]
+		if user_ids != None:
+			# A counter can't be created for a user that does not exist
+			existing = set(Account.objects.filter(id__in=user_ids).values_list("id", flat=True))
+			unknown = [user_id for user_id in user_ids if user_id not in existing]
+			if len(unknown) > 0:
+				self.stderr.write(self.style.WARNING(f"Unknown user id(s), skipped: {', '.join([str(user_id) for user_id in unknown])}"))
+			user_ids = [user_id for user_id in user_ids if user_id in existing]
+		counters = rebuild_notification_counters(user_ids=user_ids)
+		self.stdout.write(self.style.SUCCESS(f"Rebuilt {len(counters)} notification counter(s)."))
@@ -0,0 +1,30 @@
+# Generated by Django 2.2.15 on 2026-10-18 13:28
+
+from django.db import migrations, models
+
+from ChatServerPlayground.operations import AddIndexConcurrently
+
+
+class Migration(migrations.Migration):
+
+    # CREATE INDEX CONCURRENTLY can't run inside a transaction (PostgreSQL)
+    atomic = False
+
+    dependencies = [
+        ('notification', '0002_notificationcounter'),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name='notification',
+            index=models.Index(fields=['target', 'content_type', '-timestamp', '-id'], name='notif_target_ct_ts_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='notification',
+            index=models.Index(fields=['target', 'content_type', 'object_id'], name='notif_target_ct_object_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='notification',
+            index=models.Index(condition=models.Q(read=False), fields=['target', 'content_type', '-timestamp'], name='notif_unread_idx'),
+        ),
+    ]
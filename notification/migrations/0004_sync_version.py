@@ -0,0 +1,46 @@
+# Generated by Django 2.2.15 on 2026-10-18 13:32
+
+from django.db import migrations, models
+
+from ChatServerPlayground.operations import AddIndexConcurrently
+
+
+class Migration(migrations.Migration):
+
+    # CREATE INDEX CONCURRENTLY can't run inside a transaction (PostgreSQL)
+    atomic = False
+
+    dependencies = [
+        ('notification', '0003_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RemovedNotification',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('target_id', models.IntegerField()),
+                ('notification_id', models.IntegerField()),
+                ('category', models.CharField(max_length=20)),
+                ('version', models.BigIntegerField()),
+            ],
+        ),
+        migrations.AddField(
+            model_name='notification',
+            name='version',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='notificationcounter',
+            name='version',
+            field=models.BigIntegerField(default=0),
+        ),
+        AddIndexConcurrently(
+            model_name='notification',
+            index=models.Index(fields=['target', 'version'], name='notif_target_version_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='removednotification',
+            index=models.Index(fields=['target_id', 'version'], name='removed_notif_target_idx'),
+        ),
+    ]
@@ -1,7 +1,9 @@
-from django.db import models
+from django.db import models, transaction
 from django.conf import settings
 from django.contrib.contenttypes.fields import GenericForeignKey
 from django.contrib.contenttypes.models import ContentType
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
 
 
 
@@ -30,11 +32,123 @@ class Notification(models.Model):
 	object_id 					= models.PositiveIntegerField()
 	content_object 				= GenericForeignKey()
 
+	# NotificationCounter.version of the target when this notification was created/updated. See the 'sync' command of NotificationConsumer.
+	version 					= models.BigIntegerField(default=0)
+
+	class Meta:
+		indexes = [
+			# Keyset pagination of a user's general/chat notifications (see NotificationConsumer)
+			models.Index(fields=['target', 'content_type', '-timestamp', '-id'], name='notif_target_ct_ts_idx'),
+			# Finding the notification of a FriendRequest/FriendList/UnreadChatRoomMessages
+			models.Index(fields=['target', 'content_type', 'object_id'], name='notif_target_ct_object_idx'),
+			# New and unread "general" notifications
+			models.Index(fields=['target', 'content_type', '-timestamp'], name='notif_unread_idx', condition=models.Q(read=False)),
+			# Notifications changed since the version a client last synced
+			models.Index(fields=['target', 'version'], name='notif_target_version_idx'),
+		]
+
 	def __str__(self):
 		return self.verb
 
+	@classmethod
+	def from_db(cls, db, field_names, values):
+		instance = super(Notification, cls).from_db(db, field_names, values)
+		# Remember the stored "read" value so the unread counters can tell what a save() changed.
+		instance._loaded_read = instance.__dict__.get("read")
+		return instance
+
+	def save(self, *args, **kwargs):
+		# NotificationCounter is updated by the post_save receiver. Keep both writes in the same transaction.
+		from notification.utils import next_notification_version
+		# No savepoint when called inside a transaction: a failed save aborts the caller's transaction anyway.
+		with transaction.atomic(savepoint=False):
+			self.version = next_notification_version(self.target_id)
+			if kwargs.get("update_fields") != None:
+				kwargs["update_fields"] = set(kwargs["update_fields"]) | {"version"}
+			super(Notification, self).save(*args, **kwargs)
+		self._loaded_read = self.read
+
 	def get_content_object_type(self):
 		return str(self.content_object.get_cname)
 
 
+class NotificationCounter(models.Model):
+	"""
+	Number of unread notifications for a user. Kept up to date whenever a Notification is created, updated or deleted
+	so the red badges in the nav bar are a single row read instead of counting notifications.
+	If the counts ever drift: python manage.py rebuild_notification_counters
+	"""
+	user 						= models.OneToOneField(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name="notification_counter")
+
+	# FriendRequest and FriendList notifications that have not been read
+	unread_general_count 		= models.IntegerField(default=0)
+
+	# UnreadChatRoomMessages notifications that have not been read
+	unread_chat_count 			= models.IntegerField(default=0)
+
+	# Incremented by every change to the user's notifications (created, updated, removed, marked as read).
+	# Clients send the version they last synced and only receive what changed since.
+	version 					= models.BigIntegerField(default=0)
+
+	def __str__(self):
+		return f"Unread notification counts for user #{self.user_id}."
+
+
+class RemovedNotification(models.Model):
+	"""
+	Tombstone of a deleted Notification, so the 'sync' command can tell clients to remove it.
+	Only the last NOTIFICATION_SYNC_MAX_VERSIONS versions of a user are kept. Clients that are further behind start over.
+	"""
+	# Not a ForeignKey: notifications are also deleted while their target is being deleted.
+	target_id 					= models.IntegerField()
+
+	notification_id 			= models.IntegerField()
+
+	# "general" or "chat"
+	category 					= models.CharField(max_length=20)
+
+	# NotificationCounter.version of the target after the removal
+	version 					= models.BigIntegerField()
+
+	class Meta:
+		indexes = [
+			models.Index(fields=['target_id', 'version'], name='removed_notif_target_idx'),
+		]
+
+	def __str__(self):
+		return f"Notification #{self.notification_id} removed at version {self.version}."
+
+
+@receiver(post_save, sender=Notification)
+def on_notification_saved(sender, instance, created, **kwargs):
+	"""
+	1. Update the target's unread counters (same transaction as the save).
+	2. Push the new/updated notification to the target's sockets instead of waiting for the template to poll.
+	"""
+	from notification.utils import update_notification_counter, push_notification_event
+	from notification.constants import NOTIFICATION_ACTION_CREATED, NOTIFICATION_ACTION_UPDATED
+	was_unread = None if created else getattr(instance, "_loaded_read", instance.read) == False
+	update_notification_counter(instance, was_unread=was_unread, is_unread=not instance.read)
+	push_notification_event(instance, NOTIFICATION_ACTION_CREATED if created else NOTIFICATION_ACTION_UPDATED)
+
+
+@receiver(post_delete, sender=Notification)
+def on_notification_deleted(sender, instance, **kwargs):
+	"""
+	Ex: the chat room of an UnreadChatRoomMessages notification was deleted.
+	"""
+	from notification.utils import update_notification_counter, push_notification_event, record_removed_notification
+	from notification.constants import NOTIFICATION_ACTION_REMOVED
+	if not record_removed_notification(instance):
+		# The target (and their counter) is being deleted
+		return
+	update_notification_counter(instance, was_unread=getattr(instance, "_loaded_read", instance.read) == False, is_unread=None)
+	push_notification_event(instance, NOTIFICATION_ACTION_REMOVED)
+
 
+@receiver(post_delete, sender=NotificationCounter)
+def on_notification_counter_deleted(sender, instance, **kwargs):
+	"""
+	The user was deleted. Their RemovedNotification tombstones are of no use anymore.
+	"""
+	RemovedNotification.objects.filter(target_id=instance.user_id).delete()
@@ -1,3 +1,370 @@
-from django.test import TestCase
+import asyncio
+from io import StringIO
+from unittest import mock
 
-# Create your tests here.
+from channels.db import database_sync_to_async
+from channels.testing import WebsocketCommunicator
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.test import TestCase, TransactionTestCase
+
+from ChatServerPlayground.test_utils import create_account, explain
+from chat.base_consumer import decode_frame
+from chat.utils import find_or_create_private_chat, notify_unread_message, mark_room_read
+from friend.models import FriendRequest
+from notification.consumers import NotificationConsumer, get_newer_notifications, get_notifications_page_queryset
+from notification.constants import *
+from notification.models import Notification, NotificationCounter, RemovedNotification
+from notification.utils import (
+	LazyNotificationEncoder,
+	encode_notification_cursor,
+	get_general_notification_content_types,
+	get_chat_notification_content_type,
+	get_notifications_delta,
+	get_unread_notification_counts,
+	mark_general_notifications_read,
+	older_than_cursor,
+)
+
+
+class LazyNotificationEncoderTestCase(TestCase):
+	"""
+	Serializing a page of notifications must cost the same number of queries no matter how big the page is:
+		1. one query for every 'from_user'
+		2. one query per content type on the page (FriendRequest, FriendList, UnreadChatRoomMessages)
+	"""
+
+	def setUp(self):
+		self.user = create_account("receiver")
+		for i in range(20):
+			sender = create_account(f"sender{i}")
+			friend_request = FriendRequest.objects.create(sender=sender, receiver=self.user)
+			if i % 2 == 0:
+				# Creates FriendList notifications
+				friend_request.accept()
+				room = find_or_create_private_chat(self.user, sender)
+				notify_unread_message(room, self.user, f"Hello from {sender.username}")
+
+		# ContentTypes are cached for the lifetime of the process
+		get_general_notification_content_types()
+		get_chat_notification_content_type()
+
+	def serialize_page(self, page_size):
+		notifications = list(Notification.objects.filter(target=self.user).order_by('-timestamp', '-id')[:page_size])
+		with self.assertNumQueries(4):
+			return LazyNotificationEncoder().serialize(notifications)
+
+	def test_query_count_does_not_depend_on_page_size(self):
+		for page_size in [10, 25, 50]:
+			serialized = self.serialize_page(page_size)
+			self.assertEqual(len(serialized), min(page_size, Notification.objects.filter(target=self.user).count()))
+
+	def test_all_notification_types_are_serialized(self):
+		serialized = self.serialize_page(50)
+		notification_types = set([n['notification_type'] for n in serialized])
+		self.assertEqual(notification_types, set(["FriendRequest", "FriendList", "UnreadChatRoomMessages"]))
+		for notification in serialized:
+			if notification['notification_type'] == "UnreadChatRoomMessages":
+				self.assertTrue(notification['verb'].endswith(notification['from']['title']))
+
+
+class NotificationIndexTestCase(TestCase):
+	"""
+	The queries run by NotificationConsumer and the notification receivers must use the composite indexes on Notification.
+	"""
+
+	def setUp(self):
+		self.user = create_account("receiver")
+		self.general_cts = get_general_notification_content_types()
+		self.chat_ct = get_chat_notification_content_type()
+		# Enough notifications that the planner's estimates are those of a live table: on empty tables
+		# PostgreSQL picks any index that starts with target (Ex: notif_target_version_idx).
+		notifications = []
+		for user in [self.user] + [create_account(f"user{i}") for i in range(9)]:
+			for i in range(1500 if user == self.user else 50):
+				notifications.append(Notification(
+					target=user,
+					content_type=(self.general_cts + [self.chat_ct])[i % 3],
+					object_id=i,
+					verb=f"notification {i}",
+					read=i % 4 != 0,
+					version=i,
+				))
+		Notification.objects.bulk_create(notifications)
+		if connection.vendor == "postgresql":
+			with connection.cursor() as cursor:
+				cursor.execute("ANALYZE notification_notification")
+
+	def assertUsesIndex(self, queryset, index_names):
+		plan = explain(queryset)
+		self.assertTrue(any(name in plan for name in index_names), f"None of {index_names} used by:\n{plan}")
+
+	def test_general_notifications_page(self):
+		# First page, then the page after a cursor
+		cursor = encode_notification_cursor(Notification.objects.filter(target=self.user).order_by('-timestamp', '-id')[100])
+		for older_than in [None, older_than_cursor(cursor)]:
+			# Like get_general_notifications
+			branches = [Notification.objects.filter(target=self.user, content_type=content_type) for content_type in self.general_cts]
+			if older_than != None:
+				branches = [branch.filter(older_than) for branch in branches]
+			for branch in branches:
+				self.assertUsesIndex(branch.order_by('-timestamp', '-id')[:11], ["notif_target_ct_ts_idx"])
+			if connection.features.supports_slicing_ordering_in_compound:
+				self.assertUsesIndex(get_notifications_page_queryset(branches, 11), ["notif_target_ct_ts_idx"])
+
+	def test_chat_notifications_page(self):
+		queryset = Notification.objects.filter(target=self.user, content_type=self.chat_ct, read=False).order_by('-timestamp', '-id')[:11]
+		self.assertUsesIndex(queryset, ["notif_target_ct_ts_idx", "notif_unread_idx"])
+
+	def test_new_unread_general_notifications(self):
+		queryset = Notification.objects.filter(target=self.user, content_type__in=self.general_cts, read=False).order_by('-timestamp', '-id')
+		self.assertUsesIndex(queryset, ["notif_unread_idx"])
+
+	def test_notification_of_content_object(self):
+		queryset = Notification.objects.filter(target=self.user, content_type=self.chat_ct, object_id=1)
+		self.assertUsesIndex(queryset, ["notif_target_ct_object_idx"])
+
+
+class NotificationCounterTestCase(TestCase):
+	"""
+	NotificationCounter follows every create, read and delete of a Notification, and the
+	rebuild_notification_counters command can recount it.
+	"""
+
+	def setUp(self):
+		self.user = create_account("receiver")
+		self.senders = [create_account(f"sender{i}") for i in range(3)]
+		for sender in self.senders:
+			FriendRequest.objects.create(sender=sender, receiver=self.user)
+
+	def get_notification(self, sender):
+		return Notification.objects.get(target=self.user, from_user=sender)
+
+	def test_created(self):
+		self.assertEqual(get_unread_notification_counts(self.user.id), {"general": 3, "chat": 0})
+		room = find_or_create_private_chat(self.user, self.senders[0])
+		notify_unread_message(room, self.user, "Hello")
+		self.assertEqual(get_unread_notification_counts(self.user.id), {"general": 3, "chat": 1})
+
+	def test_read(self):
+		notification = self.get_notification(self.senders[0])
+		notification.read = True
+		notification.save()
+		self.assertEqual(get_unread_notification_counts(self.user.id)["general"], 2)
+		# Saving it again changes nothing
+		notification.save()
+		self.assertEqual(get_unread_notification_counts(self.user.id)["general"], 2)
+		self.assertEqual(mark_general_notifications_read(self.user.id), 2)
+		self.assertEqual(get_unread_notification_counts(self.user.id)["general"], 0)
+
+	def test_deleted(self):
+		notification = self.get_notification(self.senders[0])
+		notification_id = notification.id
+		notification.delete()
+		self.assertEqual(get_unread_notification_counts(self.user.id)["general"], 2)
+		self.assertTrue(RemovedNotification.objects.filter(target_id=self.user.id, notification_id=notification_id).exists())
+		# A read notification did not count
+		notification = self.get_notification(self.senders[1])
+		notification.read = True
+		notification.save()
+		notification.delete()
+		self.assertEqual(get_unread_notification_counts(self.user.id)["general"], 1)
+
+	def test_rebuild_command(self):
+		NotificationCounter.objects.filter(user=self.user).update(unread_general_count=7, unread_chat_count=2)
+		NotificationCounter.objects.filter(user=self.senders[0]).update(unread_general_count=4)
+		call_command("rebuild_notification_counters", stdout=StringIO())
+		self.assertEqual(get_unread_notification_counts(self.user.id), {"general": 3, "chat": 0})
+		self.assertEqual(get_unread_notification_counts(self.senders[0].id), {"general": 0, "chat": 0})
+
+	def test_rebuild_command_skips_unknown_users(self):
+		NotificationCounter.objects.filter(user=self.user).update(unread_general_count=7)
+		stderr = StringIO()
+		call_command("rebuild_notification_counters", f"--user={self.user.id}", "--user=999999", stdout=StringIO(), stderr=stderr)
+		self.assertIn("999999", stderr.getvalue())
+		self.assertEqual(get_unread_notification_counts(self.user.id)["general"], 3)
+		self.assertFalse(NotificationCounter.objects.filter(user_id=999999).exists())
+
+
+class NotificationsDeltaTestCase(TestCase):
+	"""
+	get_notifications_delta (the 'sync' command of NotificationConsumer): what changed since the client's version.
+	"""
+
+	def setUp(self):
+		self.user = create_account("receiver")
+		self.senders = [create_account(f"sender{i}") for i in range(3)]
+		FriendRequest.objects.create(sender=self.senders[0], receiver=self.user)
+		FriendRequest.objects.create(sender=self.senders[1], receiver=self.user)
+		self.version = get_notifications_delta(self.user.id, None)["version"]
+
+	def test_unchanged(self):
+		with self.assertNumQueries(1):
+			delta = get_notifications_delta(self.user.id, self.version)
+		self.assertEqual(delta, {"version": self.version, "unchanged": True})
+
+	def test_never_synced(self):
+		delta = get_notifications_delta(self.user.id, None)
+		self.assertTrue(delta["reset"])
+		self.assertEqual(delta["general"]["count"], 2)
+
+	def test_delta(self):
+		FriendRequest.objects.create(sender=self.senders[2], receiver=self.user)
+		removed = Notification.objects.get(target=self.user, from_user=self.senders[0])
+		removed_id = removed.id
+		removed.delete()
+		created = Notification.objects.get(target=self.user, from_user=self.senders[2])
+
+		delta = get_notifications_delta(self.user.id, self.version)
+		self.assertNotIn("reset", delta)
+		self.assertEqual(delta["version"], self.version + 2)
+		self.assertEqual([n["notification_id"] for n in delta["general"]["notifications"]], [str(created.id)])
+		self.assertEqual(delta["general"]["removed"], [str(removed_id)])
+		self.assertIsNotNone(delta["general"]["newest_cursor"])
+		self.assertEqual(delta["general"]["count"], 2)
+		self.assertEqual((delta["chat"]["notifications"], delta["chat"]["removed"]), ([], []))
+
+		# Synced: nothing left
+		self.assertTrue(get_notifications_delta(self.user.id, delta["version"])["unchanged"])
+
+	def test_marked_read(self):
+		self.assertEqual(mark_general_notifications_read(self.user.id), 2)
+		delta = get_notifications_delta(self.user.id, self.version)
+		self.assertNotIn("reset", delta)
+		self.assertEqual(delta["general"]["count"], 0)
+		notifications = delta["general"]["notifications"]
+		self.assertEqual(len(notifications), 2)
+		self.assertEqual([n["is_read"] for n in notifications], ["True", "True"])
+
+	def test_created_changed_and_removed(self):
+		# Every class of change in one delta: new, read (changed), removed
+		room = find_or_create_private_chat(self.user, self.senders[2])
+		notify_unread_message(room, self.user, "Hello")
+		chat_notification = Notification.objects.get(target=self.user, content_type=get_chat_notification_content_type())
+		self.version = get_notifications_delta(self.user.id, None)["version"]
+
+		FriendRequest.objects.create(sender=self.senders[2], receiver=self.user)
+		read = Notification.objects.get(target=self.user, from_user=self.senders[1])
+		read.read = True
+		read.save()
+		mark_room_read(room, self.user)
+		removed = Notification.objects.get(target=self.user, from_user=self.senders[0])
+		removed_id = removed.id
+		removed.delete()
+
+		delta = get_notifications_delta(self.user.id, self.version)
+		self.assertNotIn("reset", delta)
+		general = dict([(n["notification_id"], n["is_read"]) for n in delta["general"]["notifications"]])
+		created = Notification.objects.get(target=self.user, from_user=self.senders[2], content_type__in=get_general_notification_content_types())
+		self.assertEqual(general, {str(created.id): "False", str(read.id): "True"})
+		self.assertEqual(delta["general"]["removed"], [str(removed_id)])
+		self.assertEqual(delta["general"]["count"], 1)
+		self.assertEqual([(n["notification_id"], n["is_read"]) for n in delta["chat"]["notifications"]], [(str(chat_notification.id), "True")])
+		self.assertEqual(delta["chat"]["count"], 0)
+
+	@mock.patch("notification.utils.NOTIFICATION_SYNC_MAX_VERSIONS", 2)
+	def test_reset_when_tombstones_expired(self):
+		FriendRequest.objects.create(sender=self.senders[2], receiver=self.user)
+		for sender in self.senders:
+			Notification.objects.get(target=self.user, from_user=sender).delete()
+		# Only the tombstones of the last 2 versions are kept
+		self.assertEqual(RemovedNotification.objects.filter(target_id=self.user.id).count(), 2)
+		delta = get_notifications_delta(self.user.id, self.version)
+		self.assertTrue(delta["reset"])
+		self.assertEqual(delta["general"]["count"], 0)
+		# A client one version behind still gets a delta
+		delta = get_notifications_delta(self.user.id, self.version + 3)
+		self.assertNotIn("reset", delta)
+		self.assertEqual(len(delta["general"]["removed"]), 1)
+
+
+class NewerNotificationsTestCase(TestCase):
+	"""
+	get_newer_notifications sends at most a page after the client's newest cursor, with a cursor to continue from.
+	"""
+
+	def setUp(self):
+		self.user = create_account("receiver")
+		for i in range(25):
+			FriendRequest.objects.create(sender=create_account(f"sender{i}"), receiver=self.user)
+		self.notifications = Notification.objects.filter(target=self.user)
+		self.ordered = list(self.notifications.order_by('-timestamp', '-id'))
+
+	def get_newer(self, cursor):
+		return decode_frame(get_newer_notifications(self.notifications, cursor, "general_msg_type", 0))
+
+	def test_no_cursor_is_the_first_page(self):
+		frame = self.get_newer(None)
+		self.assertEqual([n["notification_id"] for n in frame["notifications"]], [str(n.id) for n in self.ordered[:DEFAULT_NOTIFICATION_PAGE_SIZE]])
+		self.assertIsNone(frame["next_cursor"])
+
+	def test_pages_after_the_cursor(self):
+		cursor = encode_notification_cursor(self.ordered[-1])
+		received = []
+		while True:
+			frame = self.get_newer(cursor)
+			self.assertLessEqual(len(frame["notifications"]), DEFAULT_NOTIFICATION_PAGE_SIZE)
+			# Newest first, and right after what the client already has
+			received = [n["notification_id"] for n in frame["notifications"]] + received
+			cursor = frame["newest_cursor"]
+			if frame["next_cursor"] == None:
+				break
+			self.assertEqual(frame["next_cursor"], cursor)
+		self.assertEqual(received, [str(n.id) for n in self.ordered[:-1]])
+		self.assertEqual(self.get_newer(cursor)["notifications"], [])
+
+
+class NotificationPushTestCase(TransactionTestCase):
+	"""
+	A notification is pushed to the open sockets of its target (their per-user group) once it is committed.
+	TransactionTestCase: the pushes wait for the commit (transaction.on_commit).
+	"""
+
+	def setUp(self):
+		self.user = create_account("receiver")
+		self.sender = create_account("sender")
+
+	def run_async(self, coroutine):
+		return asyncio.get_event_loop().run_until_complete(coroutine)
+
+	async def connect(self):
+		communicator = WebsocketCommunicator(NotificationConsumer, "/")
+		communicator.scope["user"] = self.user
+		connected, subprotocol = await communicator.connect()
+		self.assertTrue(connected)
+		return communicator
+
+	def test_friend_request_is_pushed(self):
+		async def run():
+			communicator = await self.connect()
+			friend_request = await database_sync_to_async(FriendRequest.objects.create)(sender=self.sender, receiver=self.user)
+			notification_frame = await communicator.receive_json_from(timeout=2)
+			count_frame = await communicator.receive_json_from(timeout=2)
+			await communicator.disconnect()
+			return friend_request, notification_frame, count_frame
+		friend_request, notification_frame, count_frame = self.run_async(run())
+
+		notification = Notification.objects.get(target=self.user)
+		self.assertEqual(notification_frame["general_msg_type"], GENERAL_MSG_TYPE_GET_NEW_GENERAL_NOTIFICATIONS)
+		self.assertEqual([n["notification_id"] for n in notification_frame["notifications"]], [str(notification.id)])
+		self.assertEqual(notification_frame["notifications"][0]["notification_type"], "FriendRequest")
+		self.assertEqual(notification_frame["newest_cursor"], encode_notification_cursor(notification))
+		self.assertEqual(count_frame, {"general_msg_type": GENERAL_MSG_TYPE_GET_UNREAD_NOTIFICATIONS_COUNT, "count": 1})
+
+	def test_rolled_back_notification_is_not_pushed(self):
+		def create_and_roll_back():
+			try:
+				with transaction.atomic():
+					FriendRequest.objects.create(sender=self.sender, receiver=self.user)
+					raise ValueError("roll back")
+			except ValueError:
+				pass
+
+		async def run():
+			communicator = await self.connect()
+			await database_sync_to_async(create_and_roll_back)()
+			nothing = await communicator.receive_nothing(timeout=0.5)
+			await communicator.disconnect()
+			return nothing
+		self.assertTrue(self.run_async(run()))
+		self.assertFalse(Notification.objects.filter(target=self.user).exists())
@@ -1,5 +1,18 @@
+import base64
+from collections import defaultdict
+from datetime import datetime, timedelta
+
 from django.core.serializers.python import Serializer
 from django.contrib.humanize.templatetags.humanize import naturaltime
+from django.contrib.contenttypes.models import ContentType
+from django.db import connection, transaction
+from django.db.models import Q, F, Count, prefetch_related_objects
+from django.utils import timezone
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+
+from notification.models import Notification, NotificationCounter, RemovedNotification
+from notification.constants import *
 
 
 class LazyNotificationEncoder(Serializer):
@@ -9,14 +22,28 @@ class LazyNotificationEncoder(Serializer):
 		1. FriendRequest
 		2. FriendList
 		3. UnreadChatRoomMessage
+	The content objects are resolved in bulk before serializing (one query per content type, plus one for every 'from_user')
+	so the number of queries does not depend on the number of notifications.
 	"""
+	def serialize(self, queryset, *args, **kwargs):
+		notifications = list(queryset)
+		self.content_objects = get_notification_content_objects(notifications)
+		prefetch_related_objects(notifications, "from_user")
+		notifications = [n for n in notifications if self.get_content_object(n) != None]
+		return super(LazyNotificationEncoder, self).serialize(notifications, *args, **kwargs)
+
+	def get_content_object(self, obj):
+		return self.content_objects.get((obj.content_type_id, obj.object_id))
+
 	def get_dump_object(self, obj):
 		dump_object = {}
-		if obj.get_content_object_type() == "FriendRequest":
-			dump_object.update({'notification_type': obj.get_content_object_type()})
+		friend_request_ct, friend_list_ct = get_general_notification_content_types()
+		content_object = self.get_content_object(obj)
+		if obj.content_type_id == friend_request_ct.id:
+			dump_object.update({'notification_type': "FriendRequest"})
 			dump_object.update({'notification_id': str(obj.pk)})
 			dump_object.update({'verb': obj.verb})
-			dump_object.update({'is_active': str(obj.content_object.is_active)})
+			dump_object.update({'is_active': str(content_object.is_active)})
 			dump_object.update({'is_read': str(obj.read)})
 			dump_object.update({'natural_timestamp': str(naturaltime(obj.timestamp))})
 			dump_object.update({'timestamp': str(obj.timestamp)})
@@ -28,8 +55,8 @@ class LazyNotificationEncoder(Serializer):
 					"image_url": str(obj.from_user.profile_image.url)
 				}
 			})
-		if obj.get_content_object_type() == "FriendList":
-			dump_object.update({'notification_type': obj.get_content_object_type()})
+		elif obj.content_type_id == friend_list_ct.id:
+			dump_object.update({'notification_type': "FriendList"})
 			dump_object.update({'notification_id': str(obj.pk)})
 			dump_object.update({'verb': obj.verb})
 			dump_object.update({'natural_timestamp': str(naturaltime(obj.timestamp))})
@@ -43,10 +70,14 @@ class LazyNotificationEncoder(Serializer):
 					"image_url": str(obj.from_user.profile_image.url)
 				}
 			})
-		if obj.get_content_object_type() == "UnreadChatRoomMessages":
-			dump_object.update({'notification_type': obj.get_content_object_type()})
+		elif obj.content_type_id == get_chat_notification_content_type().id:
+			# Same as UnreadChatRoomMessages.get_other_user, without loading UnreadChatRoomMessages.user
+			room = content_object.room
+			other_user = room.user2 if content_object.user_id == room.user1_id else room.user1
+			dump_object.update({'notification_type': "UnreadChatRoomMessages"})
 			dump_object.update({'notification_id': str(obj.pk)})
 			dump_object.update({'verb': obj.verb})
+			dump_object.update({'is_read': str(obj.read)})
 			dump_object.update({'natural_timestamp': str(naturaltime(obj.timestamp))})
 			dump_object.update({'timestamp': str(obj.timestamp)})
 			dump_object.update({
@@ -54,9 +85,411 @@ class LazyNotificationEncoder(Serializer):
 					'redirect_url': str(obj.redirect_url),
 				},
 				"from": {
-					"title": str(obj.content_object.get_other_user.username),
-					"image_url": str(obj.content_object.get_other_user.profile_image.url)
+					"title": str(other_user.username),
+					"image_url": str(other_user.profile_image.url)
 				}
 			})
 
-		return dump_object
\ No newline at end of file
+		return dump_object
+
+
+def get_notification_content_objects(notifications):
+	"""
+	Resolve the GenericForeignKey of many notifications with one query per content type.
+	Returns {(content_type_id, object_id): content_object}. Deleted content objects are missing from the result.
+	"""
+	object_ids = defaultdict(set)
+	for notification in notifications:
+		object_ids[notification.content_type_id].add(notification.object_id)
+
+	content_objects = {}
+	for content_type_id, ids in object_ids.items():
+		model = ContentType.objects.get_for_id(content_type_id).model_class()
+		queryset = model._base_manager.filter(pk__in=ids)
+		if content_type_id == get_chat_notification_content_type().id:
+			# The other user in the chat room is the title and image of the notification
+			queryset = queryset.select_related("room__user1", "room__user2")
+		for content_object in queryset:
+			content_objects[(content_type_id, content_object.pk)] = content_object
+	return content_objects
+
+
+def get_notification_group_name(user_id):
+	"""
+	Returns the Channels Group name that every NotificationConsumer for this user subscribes to.
+	"""
+	return f"Notifications-{user_id}"
+
+
+def get_general_notification_content_types():
+	"""
+	"General" notifications are FriendRequest and FriendList.
+	ContentType.objects caches natural key lookups so this only hits the database once per process.
+	"""
+	return [
+		ContentType.objects.get_by_natural_key("friend", "friendrequest"),
+		ContentType.objects.get_by_natural_key("friend", "friendlist"),
+	]
+
+
+def get_chat_notification_content_type():
+	"""
+	"Chat" notifications are UnreadChatRoomMessages.
+	"""
+	return ContentType.objects.get_by_natural_key("chat", "unreadchatroommessages")
+
+
+def get_notification_category(notification):
+	if notification.content_type_id == get_chat_notification_content_type().id:
+		return NOTIFICATION_CATEGORY_CHAT
+	return NOTIFICATION_CATEGORY_GENERAL
+
+
+def next_notification_version(user_id, create=True):
+	"""
+	Lock the user's NotificationCounter row and return the version of the change about to be written.
+	The lock is held until the transaction ends, so the versions of a user are assigned in commit order.
+	If the user has no counter yet it is built now (unless create is False, then None is returned).
+	"""
+	version = NotificationCounter.objects.select_for_update().filter(user_id=user_id).values_list("version", flat=True).first()
+	if version == None:
+		if not create:
+			return None
+		version = rebuild_notification_counters(user_ids=[user_id])[0].version
+	return version + 1
+
+
+def update_notification_counter(notification, was_unread, is_unread):
+	"""
+	Apply the change of one Notification to its target's NotificationCounter with a single UPDATE.
+	was_unread is None for a new notification and is_unread is None for a deleted one.
+	notification.version must come from next_notification_version, in the same transaction
+	(see Notification.save and the receivers in notification.models).
+	"""
+	category = get_notification_category(notification)
+	delta = 0
+	if was_unread == True:
+		delta -= 1
+	if is_unread == True:
+		delta += 1
+	field = "unread_chat_count" if category == NOTIFICATION_CATEGORY_CHAT else "unread_general_count"
+	NotificationCounter.objects.filter(user_id=notification.target_id).update(**{field: F(field) + delta, "version": notification.version})
+
+
+def record_removed_notification(notification):
+	"""
+	Leave a RemovedNotification tombstone for the 'sync' command and drop the ones that are too old to be useful.
+	Sets notification.version. Returns False if the target has no NotificationCounter (Ex: the user is being deleted).
+	"""
+	version = next_notification_version(notification.target_id, create=False)
+	if version == None:
+		return False
+	notification.version = version
+	RemovedNotification.objects.create(
+		target_id=notification.target_id,
+		notification_id=notification.pk,
+		category=get_notification_category(notification),
+		version=version,
+	)
+	RemovedNotification.objects.filter(target_id=notification.target_id, version__lte=version - NOTIFICATION_SYNC_MAX_VERSIONS).delete()
+	return True
+
+
+def mark_general_notifications_read(user_id, newest_cursor=None):
+	"""
+	Mark the user's unread "general" notifications as read with one UPDATE, and subtract them from the counter.
+	newest_cursor is a "read up to" watermark: notifications newer than it (not seen yet) stay unread.
+	Returns the number of notifications that were marked as read.
+	"""
+	notifications = Notification.objects.filter(target_id=user_id, content_type__in=get_general_notification_content_types(), read=False)
+	if newest_cursor != None:
+		notifications = notifications.filter(at_or_older_than_cursor(newest_cursor))
+	with transaction.atomic():
+		version = next_notification_version(user_id)
+		# The new version makes the 'sync' command send them again, read, to the user's other tabs
+		marked = notifications.update(read=True, version=version)
+		if marked > 0:
+			NotificationCounter.objects.filter(user_id=user_id).update(unread_general_count=F("unread_general_count") - marked, version=version)
+	if marked > 0:
+		push_notification_count(user_id, NOTIFICATION_CATEGORY_GENERAL)
+	return marked
+
+
+def get_unread_notification_counts(user_id):
+	"""
+	Returns {"general": count, "chat": count} from the user's NotificationCounter.
+	"""
+	try:
+		counter = NotificationCounter.objects.get(user_id=user_id)
+	except NotificationCounter.DoesNotExist:
+		counter = rebuild_notification_counters(user_ids=[user_id])[0]
+	return {
+		NOTIFICATION_CATEGORY_GENERAL: counter.unread_general_count,
+		NOTIFICATION_CATEGORY_CHAT: counter.unread_chat_count,
+	}
+
+
+def get_notifications_delta(user_id, version):
+	"""
+	Everything that changed in the user's notifications since `version` (the 'sync' command of NotificationConsumer).
+	Returns one of:
+		1. {"version", "unchanged": True}
+			Nothing changed. Costs a single row read.
+		2. {"version", "reset": True, "general", "chat"}
+			The client never synced or is too far behind. It has to retrieve the first pages again.
+		3. {"version", "general", "chat"}
+	"general" and "chat" contain:
+		"notifications": created or updated since `version`, newest first (only in 3.)
+		"removed": ids of the notifications removed since `version` (only in 3.)
+		"newest_cursor": cursor of the newest notification in "notifications" (only in 3.)
+		"count": unread count
+	"""
+	counter = NotificationCounter.objects.filter(user_id=user_id).first()
+	if counter == None:
+		counter = rebuild_notification_counters(user_ids=[user_id])[0]
+	current_version = counter.version
+	if version == current_version:
+		return {"version": current_version, "unchanged": True}
+
+	payload = {
+		"version": current_version,
+		NOTIFICATION_CATEGORY_GENERAL: {"count": counter.unread_general_count},
+		NOTIFICATION_CATEGORY_CHAT: {"count": counter.unread_chat_count},
+	}
+	if version == None or version > current_version or current_version - version >= NOTIFICATION_SYNC_MAX_VERSIONS:
+		payload["reset"] = True
+		return payload
+
+	changed = list(Notification.objects.filter(target_id=user_id, version__gt=version).order_by('-timestamp', '-id')[:NOTIFICATION_SYNC_MAX_NOTIFICATIONS + 1])
+	if len(changed) > NOTIFICATION_SYNC_MAX_NOTIFICATIONS:
+		payload["reset"] = True
+		return payload
+
+	for category in [NOTIFICATION_CATEGORY_GENERAL, NOTIFICATION_CATEGORY_CHAT]:
+		payload[category].update({"notifications": [], "removed": [], "newest_cursor": None})
+	serialized = dict([(n["notification_id"], n) for n in LazyNotificationEncoder().serialize(changed)])
+	for notification in changed:
+		category = payload[get_notification_category(notification)]
+		if str(notification.pk) in serialized:
+			category["notifications"].append(serialized[str(notification.pk)])
+			if category["newest_cursor"] == None:
+				category["newest_cursor"] = encode_notification_cursor(notification)
+	removed = RemovedNotification.objects.filter(target_id=user_id, version__gt=version).values_list("notification_id", "category")
+	for notification_id, category in removed:
+		payload[category]["removed"].append(str(notification_id))
+	return payload
+
+
+def rebuild_notification_counters(user_ids=None):
+	"""
+	Recount the unread notifications of each user (all users if user_ids is None) and overwrite their NotificationCounter.
+	Returns the rebuilt counters.
+	"""
+	notifications = Notification.objects.all()
+	if user_ids != None:
+		notifications = notifications.filter(target_id__in=user_ids)
+	counts = notifications.values("target_id").annotate(
+		general=Count("id", filter=Q(content_type__in=get_general_notification_content_types(), read=False)),
+		chat=Count("id", filter=Q(content_type=get_chat_notification_content_type(), read=False)),
+	)
+	counts = {row["target_id"]: row for row in counts}
+
+	if user_ids == None:
+		# Users without any notification get zeroed counters as well
+		NotificationCounter.objects.exclude(user_id__in=counts.keys()).update(unread_general_count=0, unread_chat_count=0)
+		user_ids = counts.keys()
+
+	counters = []
+	for user_id in user_ids:
+		row = counts.get(user_id, {})
+		counter, created = NotificationCounter.objects.update_or_create(
+			user_id=user_id,
+			defaults={
+				"unread_general_count": row.get("general", 0),
+				"unread_chat_count": row.get("chat", 0),
+			}
+		)
+		counters.append(counter)
+	return counters
+
+
+def save_notifications(created=[], updated=[]):
+	"""
+	Create and update several notifications at once. Same effects as Notification.save (versions, unread counters,
+	pushes) with a number of queries that only depends on the number of targets:
+		1. lock the NotificationCounters of the targets (one SELECT ... FOR UPDATE, in user order so concurrent
+			calls can't deadlock)
+		2. INSERT the created notifications (one statement). SQLite can't return the ids of a bulk insert:
+			they are read back by (target, version), which is unique.
+		3. UPDATE the updated notifications (one statement)
+		4. UPDATE the counter of each target
+		5. the pushes, once the transaction commits: the content objects of the notifications (one query per content
+			type, see LazyNotificationEncoder)
+	Updated notifications must come from the database (the stored "read" value tells how the counters change).
+	"""
+	created = list(created)
+	updated = list(updated)
+	notifications = created + updated
+	if len(notifications) == 0:
+		return
+	target_ids = sorted(set([notification.target_id for notification in notifications]))
+	with transaction.atomic(savepoint=False):
+		counters = dict([(counter.user_id, counter) for counter in NotificationCounter.objects.select_for_update().filter(user_id__in=target_ids).order_by("user_id")])
+		missing = [user_id for user_id in target_ids if user_id not in counters]
+		if len(missing) > 0:
+			for counter in rebuild_notification_counters(user_ids=missing):
+				counters[counter.user_id] = counter
+
+		# Same bookkeeping as Notification.save and update_notification_counter, on the locked counters
+		for notification in notifications:
+			counter = counters[notification.target_id]
+			counter.version += 1
+			notification.version = counter.version
+			category = get_notification_category(notification)
+			field = "unread_chat_count" if category == NOTIFICATION_CATEGORY_CHAT else "unread_general_count"
+			was_unread = None if notification.pk == None else getattr(notification, "_loaded_read", notification.read) == False
+			if was_unread == True:
+				setattr(counter, field, getattr(counter, field) - 1)
+			if not notification.read:
+				setattr(counter, field, getattr(counter, field) + 1)
+
+		if len(created) > 0:
+			Notification.objects.bulk_create(created)
+			if not connection.features.can_return_ids_from_bulk_insert:
+				ids = Notification.objects.filter(
+					target_id__in=target_ids,
+					version__in=[notification.version for notification in created],
+				).values_list("target_id", "version", "id")
+				ids = dict([((target_id, version), pk) for target_id, version, pk in ids])
+				for notification in created:
+					notification.pk = ids[(notification.target_id, notification.version)]
+		if len(updated) > 0:
+			Notification.objects.bulk_update(updated, [field.name for field in Notification._meta.concrete_fields if not field.primary_key])
+		for notification in notifications:
+			notification._loaded_read = notification.read
+
+		for counter in counters.values():
+			NotificationCounter.objects.filter(user_id=counter.user_id).update(
+				unread_general_count=counter.unread_general_count,
+				unread_chat_count=counter.unread_chat_count,
+				version=counter.version,
+			)
+
+		def push():
+			# After the commit (see push_notification_event), so the counters are already unlocked
+			serialized = dict([(n["notification_id"], n) for n in LazyNotificationEncoder().serialize(notifications)])
+			for notification in created:
+				push_notification_event(notification, NOTIFICATION_ACTION_CREATED, counter=counters[notification.target_id], serialized=serialized)
+			for notification in updated:
+				push_notification_event(notification, NOTIFICATION_ACTION_UPDATED, counter=counters[notification.target_id], serialized=serialized)
+		transaction.on_commit(push)
+
+
+def push_notification_event(notification, action, counter=None, serialized=None):
+	"""
+	Push a created/updated/removed Notification (and the new unread count) to the target's open sockets.
+	Nothing is done until the transaction commits: a rolled back save is never pushed, and the NotificationCounter
+	lock of the save is not held while the notification is serialized and the count read.
+	counter: the target's NotificationCounter, if it is already up to date in memory (saves a query).
+	serialized: {notification_id: serialized notification}, if already serialized in bulk (see save_notifications).
+	"""
+	category = get_notification_category(notification)
+	field = "unread_chat_count" if category == NOTIFICATION_CATEGORY_CHAT else "unread_general_count"
+	# Read now: the pk of a deleted notification is cleared when delete() returns
+	event = {
+		"type": "notification.push",
+		"category": category,
+		"action": action,
+		"notification_id": str(notification.pk),
+		"count": getattr(counter, field) if counter != None else None,
+	}
+	if action != NOTIFICATION_ACTION_REMOVED:
+		event["cursor"] = encode_notification_cursor(notification)
+	target_id = notification.target_id
+
+	def send():
+		try:
+			if counter == None:
+				event["count"] = NotificationCounter.objects.filter(user_id=target_id).values_list(field, flat=True).first()
+			if action != NOTIFICATION_ACTION_REMOVED:
+				if serialized != None:
+					event["notification"] = serialized.get(event["notification_id"])
+				else:
+					event["notification"] = LazyNotificationEncoder().serialize([notification])[0]
+		except Exception as e:
+			# The notification is stored: a failed push must not fail the request that made it
+			print("EXCEPTION: push_notification_event: " + str(e))
+			return
+		send_to_notification_group(get_notification_group_name(target_id), event)
+	transaction.on_commit(send)
+
+
+def push_notification_count(user_id, category):
+	"""
+	Push only the unread count (Ex: after notifications were marked as read in bulk).
+	"""
+	event = {
+		"type": "notification.count",
+		"category": category,
+		"count": get_unread_notification_counts(user_id)[category],
+	}
+	group_name = get_notification_group_name(user_id)
+	transaction.on_commit(lambda: send_to_notification_group(group_name, event))
+
+
+def send_to_notification_group(group_name, event):
+	channel_layer = get_channel_layer()
+	if channel_layer is None:
+		return
+	try:
+		async_to_sync(channel_layer.group_send)(group_name, event)
+	except Exception as e:
+		# A missing/unavailable channel layer must never break the write that triggered the push.
+		print("EXCEPTION: send_to_notification_group: " + str(e))
+
+
+"""
+Keyset pagination.
+A cursor is an opaque string for a (timestamp, id) position in the '-timestamp', '-id' ordering of a user's notifications.
+The id breaks ties between notifications created/updated in the same microsecond.
+"""
+CURSOR_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def encode_notification_cursor(notification):
+	microseconds = (notification.timestamp - CURSOR_EPOCH) // timedelta(microseconds=1)
+	raw = f"{microseconds}:{notification.pk}"
+	return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_notification_cursor(cursor):
+	"""
+	Returns (timestamp, id). Raises ValueError if the cursor was not made by encode_notification_cursor.
+	"""
+	try:
+		raw = base64.urlsafe_b64decode(str(cursor).encode()).decode()
+		microseconds, pk = raw.split(":")
+		return CURSOR_EPOCH + timedelta(microseconds=int(microseconds)), int(pk)
+	except Exception:
+		raise ValueError(f"Invalid notification cursor: {cursor}")
+
+
+def older_than_cursor(cursor):
+	timestamp, pk = decode_notification_cursor(cursor)
+	# Not "timestamp < x OR (timestamp = x AND id < pk)": timestamp <= x is a range of notif_target_ct_ts_idx
+	return Q(timestamp__lte=timestamp) & ~Q(timestamp=timestamp, id__gte=pk)
+
+
+def newer_than_cursor(cursor):
+	timestamp, pk = decode_notification_cursor(cursor)
+	return Q(timestamp__gt=timestamp) | Q(timestamp=timestamp, id__gt=pk)
+
+
+def at_or_newer_than_cursor(cursor):
+	timestamp, pk = decode_notification_cursor(cursor)
+	return Q(timestamp__gt=timestamp) | Q(timestamp=timestamp, id__gte=pk)
+
+
+def at_or_older_than_cursor(cursor):
+	timestamp, pk = decode_notification_cursor(cursor)
+	return Q(timestamp__lt=timestamp) | Q(timestamp=timestamp, id__lte=pk)
@@ -1,26 +1,30 @@
 from django.core.serializers.python import Serializer
-from django.core.paginator import Paginator
 from django.core.serializers import serialize
-from channels.generic.websocket import AsyncJsonWebsocketConsumer
 from channels.db import database_sync_to_async
-import json
 from django.utils import timezone
 
 from public_chat.constants import *
 from public_chat.models import PublicChatRoom, PublicRoomChatMessage
-from chat.exceptions import ClientError
-from chat.utils import calculate_timestamp
+from chat.exceptions import ClientError, RateLimitError
+from chat.utils import calculate_timestamp, get_epoch_timestamp
+from chat.base_consumer import BaseJsonConsumer, encode_frame
+from chat.write_behind import MessageWriteBuffer
+from chat.history_cache import HistoryPageCache
+from chat.presence import get_presence
+from public_chat.recent_messages import RecentMessagesCache
 
 
 # Example taken from:
 # https://github.com/andrewgodwin/channels-examples/blob/master/multichat/chat/consumers.py
-class PublicChatConsumer(AsyncJsonWebsocketConsumer):
+class PublicChatConsumer(BaseJsonConsumer):
 
 	async def connect(self):
 		"""
 		Called when the websocket is handshaking as part of initial connection.
 		"""
 		print("PublicChatConsumer: connect: " + str(self.scope["user"]))
+		self.negotiate_coalescing()
+		self.negotiate_flow_control()
 		# let everyone connect. But limit read/write to authenticated users
 		await self.accept()
 		self.room_id = None
@@ -37,6 +41,7 @@ class PublicChatConsumer(AsyncJsonWebsocketConsumer):
 				await self.leave_room(self.room_id)
 		except Exception:
 			pass
+		await self.leave_presence()
 
 
 	async def receive_json(self, content):
@@ -61,10 +66,19 @@ class PublicChatConsumer(AsyncJsonWebsocketConsumer):
 			elif command == "get_room_chat_messages":
 				await self.display_progress_bar(True)
 				room = await get_room_or_error(content['room_id'])
-				payload = await get_room_chat_messages(room, content['page_number'])
-				if payload != None:
-					payload = json.loads(payload)
-					await self.send_messages_payload(payload['messages'], payload['new_page_number'])
+				if "page_number" in content and "before_msg_id" not in content:
+					# Clients loaded before the before_msg_id protocol
+					if str(content['page_number']) == "1":
+						frame = await recent_messages.get_first_page(room.id, get_first_page_frame_by_page_number)
+					else:
+						frame = await get_room_chat_messages_by_page_number(room, content['page_number'])
+				elif content.get('before_msg_id', None) == None:
+					# The newest messages are in memory (see public_chat.recent_messages)
+					frame = await recent_messages.get_first_page(room.id, get_first_page_frame)
+				else:
+					frame = await get_room_chat_messages(room, content['before_msg_id'])
+				if frame != None:
+					await self.send_frame(frame)
 				else:
 					raise ClientError(204,"Something went wrong retrieving the chatroom messages.")
 				await self.display_progress_bar(False)
@@ -87,9 +101,12 @@ class PublicChatConsumer(AsyncJsonWebsocketConsumer):
 		else:
 			raise ClientError("ROOM_ACCESS_DENIED", "Room access denied")
 
+		# room.group_name. Limits are checked before querying the room.
+		await self.check_send_rate("PublicChatRoom-%s" % self.room_id)
+
 		# Get the room and send to the group about it
 		room = await get_room_or_error(room_id)
-		await create_public_room_chat_message(room, self.scope["user"], message)
+		chat_message = await create_public_room_chat_message(room, self.scope["user"], message)
 
 		await self.channel_layer.group_send(
 			room.group_name,
@@ -99,6 +116,9 @@ class PublicChatConsumer(AsyncJsonWebsocketConsumer):
 				"username": self.scope["user"].username,
 				"user_id": self.scope["user"].id,
 				"message": message,
+				"msg_id": str(chat_message.id) if chat_message.id != None else None,
+				"timestamp": get_epoch_timestamp(chat_message.timestamp),
+				"natural_timestamp": calculate_timestamp(chat_message.timestamp),
 			}
 		)
 
@@ -108,15 +128,25 @@ class PublicChatConsumer(AsyncJsonWebsocketConsumer):
 		"""
 		# Send a message down to the client
 		print("PublicChatConsumer: chat_message from user #" + str(event["user_id"]))
-		timestamp = calculate_timestamp(timezone.now())
-		await self.send_json(
+		recent_messages.append(self.room_id, {
+			"msg_type": MSG_TYPE_MESSAGE,
+			"msg_id": event["msg_id"],
+			"user_id": str(event["user_id"]),
+			"username": event["username"],
+			"message": event["message"],
+			"profile_image": event["profile_image"],
+			"timestamp": event["timestamp"],
+		})
+		await self.send_event(
 			{
 				"msg_type": MSG_TYPE_MESSAGE,
 				"profile_image": event["profile_image"],
 				"username": event["username"],
 				"user_id": event["user_id"],
 				"message": event["message"],
-				"natural_timestamp": timestamp,
+				"msg_id": event["msg_id"],
+				"natural_timestamp": event["natural_timestamp"],
+				"timestamp": event["timestamp"],
 			},
 		)
 
@@ -131,11 +161,16 @@ class PublicChatConsumer(AsyncJsonWebsocketConsumer):
 		except ClientError as e:
 			await self.handle_client_error(e)
 
-		# Add user to "users" list for room
+		# Switching rooms: leave the previous one, or its messages would keep coming
+		if self.room_id != None and self.room_id != room.id:
+			await self.leave_room(self.room_id)
+
+		# Count the user as connected to the room
 		if is_auth:
-			await connect_user(room, self.scope["user"])
+			await self.enter_presence(room.group_name)
 
 		# Store that we're in the room
+		is_joined = self.room_id == room.id
 		self.room_id = room.id
 
 		# Add them to the group so they get room messages
@@ -143,6 +178,8 @@ class PublicChatConsumer(AsyncJsonWebsocketConsumer):
 			room.group_name,
 			self.channel_name,
 		)
+		if not is_joined:
+			recent_messages.subscribe(room.id)
 
 		# Instruct their client to finish opening the room
 		await self.send_json({
@@ -150,7 +187,7 @@ class PublicChatConsumer(AsyncJsonWebsocketConsumer):
 		})
 
 		# send the new user count to the room
-		num_connected_users = get_num_connected_users(room)
+		num_connected_users = await get_presence().count(room.group_name)
 		await self.channel_layer.group_send(
 			room.group_name,
 			{
@@ -165,15 +202,14 @@ class PublicChatConsumer(AsyncJsonWebsocketConsumer):
 		Called by receive_json when someone sent a leave command.
 		"""
 		print("PublicChatConsumer: leave_room")
-		is_auth = is_authenticated(self.scope["user"])
-		room = await get_room_or_error(room_id)
+		# Stop counting the user as connected to the room
+		await self.leave_presence()
+		if self.room_id != None:
+			recent_messages.unsubscribe(self.room_id)
+			self.room_id = None
 
-		# Remove user from "users" list
-		if is_auth:
-			await disconnect_user(room, self.scope["user"])
+		room = await get_room_or_error(room_id)
 
-		# Remove that we're in the room
-		self.room_id = None
 		# Remove them from the group so they no longer get room messages
 		await self.channel_layer.group_discard(
 			room.group_name,
@@ -181,7 +217,7 @@ class PublicChatConsumer(AsyncJsonWebsocketConsumer):
 		)
 
 		# send the new user count to the room
-		num_connected_users = get_num_connected_users(room)
+		num_connected_users = await get_presence().count(room.group_name)
 		await self.channel_layer.group_send(
 		room.group_name,
 			{
@@ -190,6 +226,12 @@ class PublicChatConsumer(AsyncJsonWebsocketConsumer):
 			}
 		)
 
+	def get_resume_hint(self):
+		"""
+		The room to join again. Messages missed meanwhile are in the first page of the room.
+		"""
+		return {"room_id": self.room_id}
+
 	async def handle_client_error(self, e):
 		"""
 		Called when a ClientError is raised.
@@ -197,25 +239,13 @@ class PublicChatConsumer(AsyncJsonWebsocketConsumer):
 		"""
 		errorData = {}
 		errorData['error'] = e.code
+		if isinstance(e, RateLimitError):
+			errorData['retry_after'] = e.retry_after
 		if e.message:
 			errorData['message'] = e.message
 			await self.send_json(errorData)
 		return
 
-	async def send_messages_payload(self, messages, new_page_number):
-		"""
-		Send a payload of messages to the ui
-		"""
-		print("PublicChatConsumer: send_messages_payload. ")
-
-		await self.send_json(
-			{
-				"messages_payload": "messages_payload",
-				"messages": messages,
-				"new_page_number": new_page_number,
-			},
-		)
-
 	async def connected_user_count(self, event):
 		"""
 		Called to send the number of connected users to the room.
@@ -223,11 +253,14 @@ class PublicChatConsumer(AsyncJsonWebsocketConsumer):
 		"""
 		# Send a message down to the client
 		print("PublicChatConsumer: connected_user_count: count: " + str(event["connected_user_count"]))
-		await self.send_json(
+		# Only the latest count matters
+		await self.send_event(
 			{
 				"msg_type": MSG_TYPE_CONNECTED_USER_COUNT,
 				"connected_user_count": event["connected_user_count"]
 			},
+			collapse_key="connected_user_count",
+			droppable=True,
 		)
 
 	async def display_progress_bar(self, is_displayed):
@@ -250,22 +283,55 @@ def is_authenticated(user):
 		return True
 	return False
 
-def get_num_connected_users(room):
-	if room.users:
-		return len(room.users.all())
-	return 0
+# Stores the messages according to settings.CHAT_MESSAGE_PERSISTENCE
+public_room_chat_message_buffer = MessageWriteBuffer(PublicRoomChatMessage, "public_chat.messages")
 
-@database_sync_to_async
-def create_public_room_chat_message(room, user, message):
-    return PublicRoomChatMessage.objects.create(user=user, room=room, content=message)
+async def create_public_room_chat_message(room, user, message):
+	chat_message = PublicRoomChatMessage(user=user, room=room, content=message, timestamp=timezone.now())
+	try:
+		await public_room_chat_message_buffer.save(chat_message)
+	except Exception as e:
+		print("EXCEPTION: create_public_room_chat_message: " + str(e))
+		raise ClientError("MESSAGE_NOT_SAVED", "Your message could not be sent. Try again.")
+	return chat_message
 
-@database_sync_to_async
-def connect_user(room, user):
-    return room.connect_user(user)
+def load_recent_messages(room_id, count):
+	"""
+	The newest messages of a room, for recent_messages.
+	"""
+	page = list(PublicRoomChatMessage.objects.filter(room_id=room_id).select_related("user").order_by("-timestamp", "-id")[:count])
+	s = LazyRoomChatMessageEncoder()
+	messages = s.serialize(page)
+	for message in messages:
+		del message["natural_timestamp"]
+	return messages
+
+def get_first_page_frame(messages):
+	"""
+	Same frame as get_room_chat_messages(room, None).
+	"""
+	payload = {}
+	payload['messages_payload'] = "messages_payload"
+	payload['messages'] = messages
+	is_full = len(messages) == DEFAULT_ROOM_CHAT_MESSAGE_PAGE_SIZE
+	payload['next_before_msg_id'] = messages[-1]['msg_id'] if is_full else None
+	return encode_frame(payload)
+
+def get_first_page_frame_by_page_number(messages):
+	"""
+	Same frame as get_room_chat_messages_by_page_number(room, 1).
+	"""
+	payload = {}
+	payload['messages_payload'] = "messages_payload"
+	payload['messages'] = messages
+	payload['new_page_number'] = 2
+	return encode_frame(payload)
 
-@database_sync_to_async
-def disconnect_user(room, user):
-    return room.disconnect_user(user)
+# The first page of messages of the rooms this process has sockets in
+recent_messages = RecentMessagesCache(DEFAULT_ROOM_CHAT_MESSAGE_PAGE_SIZE, load_recent_messages)
+
+# Older pages of messages of the rooms
+public_room_history_cache = HistoryPageCache("public_chat.history")
 
 @database_sync_to_async
 def get_room_or_error(room_id):
@@ -280,22 +346,59 @@ def get_room_or_error(room_id):
 
 
 @database_sync_to_async
-def get_room_chat_messages(room, page_number):
+def get_room_chat_messages(room, before_msg_id):
+	"""
+	Returns the encoded frame of the page of messages sent before the message `before_msg_id` for the ui.
+	Keyset pagination, like chat.consumers.get_room_chat_messages. The newest page is served by recent_messages.
+	Older pages never change: they are cached (see chat.history_cache).
+	"""
+	try:
+		if before_msg_id != None:
+			before_msg_id = int(before_msg_id)
+	except ValueError:
+		raise ClientError("INVALID_CURSOR", "Unable to retrieve the messages. Try refreshing the browser.")
+	frame = public_room_history_cache.get(room.id, before_msg_id)
+	if frame != None:
+		return frame
+	try:
+		page = list(PublicRoomChatMessage.objects.before(room, before_msg_id)[:DEFAULT_ROOM_CHAT_MESSAGE_PAGE_SIZE + 1])
+		has_next_page = len(page) > DEFAULT_ROOM_CHAT_MESSAGE_PAGE_SIZE
+		page = page[:DEFAULT_ROOM_CHAT_MESSAGE_PAGE_SIZE]
+
+		payload = {}
+		payload['messages_payload'] = "messages_payload"
+		s = LazyRoomChatMessageEncoder()
+		payload['messages'] = s.serialize(page)
+		payload['next_before_msg_id'] = str(page[-1].id) if has_next_page else None
+		frame = encode_frame(payload)
+		public_room_history_cache.set(room.id, before_msg_id, frame, page[0].timestamp if len(page) > 0 else None)
+		return frame
+	except Exception as e:
+		print("EXCEPTION: " + str(e))
+		return None
+
+
+@database_sync_to_async
+def get_room_chat_messages_by_page_number(room, page_number):
+	"""
+	The page_number protocol, for clients loaded before before_msg_id existed. Same frame as before.
+	Pages shift when new messages arrive, so messages can be repeated. Does not COUNT(*) the room.
+	"""
 	try:
-		qs = PublicRoomChatMessage.objects.by_room(room)
-		p = Paginator(qs, DEFAULT_ROOM_CHAT_MESSAGE_PAGE_SIZE)
+		new_page_number = int(page_number)
+		start = (new_page_number - 1) * DEFAULT_ROOM_CHAT_MESSAGE_PAGE_SIZE
+		page = list(PublicRoomChatMessage.objects.before(room)[start:start + DEFAULT_ROOM_CHAT_MESSAGE_PAGE_SIZE])
 
 		payload = {}
-		messages_data = None
-		new_page_number = int(page_number)  
-		if new_page_number <= p.num_pages:
+		payload['messages_payload'] = "messages_payload"
+		if len(page) > 0:
 			new_page_number = new_page_number + 1
 			s = LazyRoomChatMessageEncoder()
-			payload['messages'] = s.serialize(p.page(page_number).object_list)
+			payload['messages'] = s.serialize(page)
 		else:
 			payload['messages'] = "None"
 		payload['new_page_number'] = new_page_number
-		return json.dumps(payload)
+		return encode_frame(payload)
 	except Exception as e:
 		print("EXCEPTION: " + str(e))
 		return None
@@ -314,6 +417,7 @@ class LazyRoomChatMessageEncoder(Serializer):
 		dump_object.update({'message': str(obj.content)})
 		dump_object.update({'profile_image': str(obj.user.profile_image.url)})
 		dump_object.update({'natural_timestamp': calculate_timestamp(obj.timestamp)})
+		dump_object.update({'timestamp': get_epoch_timestamp(obj.timestamp)})
 		return dump_object
 
 
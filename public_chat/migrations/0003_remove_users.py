@@ -0,0 +1,17 @@
+# Generated by Django 2.2.15 on 2026-10-18 13:41
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('public_chat', '0002_indexes'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='publicchatroom',
+            name='users',
+        ),
+    ]
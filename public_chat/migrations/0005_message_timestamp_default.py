@@ -0,0 +1,19 @@
+# Generated by Django 2.2.15 on 2026-10-18 13:48
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('public_chat', '0004_keyset_index'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='publicroomchatmessage',
+            name='timestamp',
+            field=models.DateTimeField(default=django.utils.timezone.now, editable=False),
+        ),
+    ]
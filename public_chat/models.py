@@ -1,4 +1,6 @@
 from django.db import models
+from django.utils import timezone
+from django.db.models import Q, Subquery
 from django.conf import settings
 
 
@@ -7,39 +9,12 @@ class PublicChatRoom(models.Model):
 	# Room title
 	title 				= models.CharField(max_length=255, unique=True, blank=False,)
 
-	# all users who are authenticated and viewing the chat
-	users 				= models.ManyToManyField(settings.AUTH_USER_MODEL, help_text="users who are connected to chat room.", blank=True, null=True)
+	# The authenticated users who are viewing the chat are tracked by chat.presence
 
 	def __str__(self):
 		return self.title
 
 
-	def connect_user(self, user):
-		"""
-		return true if user is added to the users list
-		"""
-		is_user_added = False
-		if not user in self.users.all():
-			self.users.add(user)
-			self.save()
-			is_user_added = True
-		elif user in self.users.all():
-			is_user_added = True
-		return is_user_added 
-
-
-	def disconnect_user(self, user):
-		"""
-		return true if user is removed from the users list
-		"""
-		is_user_removed = False
-		if user in self.users.all():
-			self.users.remove(user)
-			self.save()
-			is_user_removed = True
-		return is_user_removed 
-
-
 	@property
 	def group_name(self):
 		"""
@@ -51,7 +26,18 @@ class PublicChatRoom(models.Model):
 
 class PublicRoomChatMessageManager(models.Manager):
     def by_room(self, room):
-        qs = PublicRoomChatMessage.objects.filter(room=room).order_by("-timestamp")
+        qs = PublicRoomChatMessage.objects.filter(room=room).order_by("-timestamp", "-id")
+        return qs
+
+    def before(self, room, before_msg_id=None):
+        """
+        Messages of the room sent before the message `before_msg_id` (all of them if it is None), newest first.
+        Keyset pagination, like RoomChatMessage.objects.before.
+        """
+        qs = self.by_room(room).select_related("user")
+        if before_msg_id != None:
+            cursor = Subquery(PublicRoomChatMessage.objects.filter(room=room, pk=before_msg_id).values("timestamp")[:1])
+            qs = qs.filter(timestamp__lte=cursor).filter(Q(timestamp__lt=cursor) | Q(id__lt=before_msg_id))
         return qs
 
 class PublicRoomChatMessage(models.Model):
@@ -60,11 +46,18 @@ class PublicRoomChatMessage(models.Model):
     """
     user                = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
     room                = models.ForeignKey(PublicChatRoom, on_delete=models.CASCADE)
-    timestamp           = models.DateTimeField(auto_now_add=True)
+    # Set when the message is sent (not when it is inserted, see chat.write_behind)
+    timestamp           = models.DateTimeField(default=timezone.now, editable=False)
     content             = models.TextField(unique=False, blank=False,)
 
     objects = PublicRoomChatMessageManager()
 
+    class Meta:
+        indexes = [
+            # PublicRoomChatMessage.objects.by_room(room) and .before(room, before_msg_id)
+            models.Index(fields=['room', '-timestamp', '-id'], name='public_msg_room_ts_id_idx'),
+        ]
+
     def __str__(self):
         return self.content
 
@@ -0,0 +1,166 @@
+"""
+In-memory ring buffer of the newest messages of each public room.
+
+Every visitor of the home page asks PublicChatConsumer for the first page of messages of the room.
+That page is served from here instead of the database: no query, no serialization, and the encoded frames
+are reused until a new message arrives.
+
+A room's buffer is only kept while a socket of this process is in the room group. Those sockets receive
+every message of the room (from any process), so the buffer can't miss one. When the last one leaves,
+the buffer is dropped and it is loaded from the database again by the next visitor (cold start).
+
+Metrics (see ChatServerPlayground.metrics):
+	public_chat.recent_messages.hits, public_chat.recent_messages.misses: counters
+	public_chat.recent_messages.hit_rate, .rooms, .messages, .bytes: gauges
+"""
+import asyncio
+from collections import deque
+
+from django.utils import timezone
+from channels.db import database_sync_to_async
+
+from ChatServerPlayground import metrics
+from chat.utils import calculate_timestamp, from_epoch_timestamp
+
+
+def get_message_size(message):
+	"""
+	Approximate memory used by a buffered message: the length of its values.
+	"""
+	return sum([len(str(value)) for value in message.values()])
+
+
+class RoomRingBuffer:
+	"""
+	The newest `size` messages of a room, newest first.
+	A message is a dict like the ones LazyRoomChatMessageEncoder returns, without "natural_timestamp".
+	"""
+
+	def __init__(self, size, messages):
+		self.messages = deque(messages[:size], maxlen=size)
+		self.msg_ids = set([message["msg_id"] for message in self.messages])
+		self.num_bytes = sum([get_message_size(message) for message in self.messages])
+		# build_frame -> encoded first page, and the day they were encoded ("today at..." becomes "yesterday at...")
+		self.frames = {}
+		self.frames_date = None
+
+	def append(self, message):
+		"""
+		Returns False if the message is already in the buffer.
+		"""
+		if message["msg_id"] in self.msg_ids:
+			return False
+		if len(self.messages) == self.messages.maxlen:
+			oldest = self.messages.pop()
+			self.msg_ids.discard(oldest["msg_id"])
+			self.num_bytes -= get_message_size(oldest)
+		self.messages.appendleft(message)
+		self.msg_ids.add(message["msg_id"])
+		self.num_bytes += get_message_size(message)
+		self.frames = {}
+		return True
+
+	def get_frame(self, build_frame):
+		"""
+		build_frame(messages): the encoded first page of messages.
+		"""
+		today = timezone.localdate()
+		if self.frames_date != today:
+			self.frames = {}
+			self.frames_date = today
+		if build_frame not in self.frames:
+			messages = []
+			for message in self.messages:
+				message = dict(message)
+				message["natural_timestamp"] = calculate_timestamp(from_epoch_timestamp(message["timestamp"]))
+				messages.append(message)
+			self.frames[build_frame] = build_frame(messages)
+		return self.frames[build_frame]
+
+
+class RecentMessagesCache:
+	"""
+	load_messages(room_id, count): the newest `count` messages of the room (newest first), from the database.
+	"""
+
+	def __init__(self, size, load_messages):
+		self.size = size
+		self.load_messages = load_messages
+		# room_id -> RoomRingBuffer
+		self.rooms = {}
+		# room_id -> number of sockets of this process in the room group
+		self.subscribers = {}
+		# room_id -> Task loading the buffer, and the messages received while it runs
+		self.loading = {}
+		self.received_while_loading = {}
+		self.hits = 0
+		self.misses = 0
+
+	def subscribe(self, room_id):
+		"""
+		A socket of this process joined the room group.
+		"""
+		self.subscribers[room_id] = self.subscribers.get(room_id, 0) + 1
+
+	def unsubscribe(self, room_id):
+		"""
+		A socket of this process left the room group. Without sockets in the group the buffer would miss messages.
+		"""
+		self.subscribers[room_id] = self.subscribers.get(room_id, 0) - 1
+		if self.subscribers[room_id] <= 0:
+			del self.subscribers[room_id]
+			self.rooms.pop(room_id, None)
+			self.update_metrics()
+
+	def append(self, room_id, message):
+		"""
+		Called for every message received by a socket in the room group.
+		Every socket of the room receives the same message: it is only added once.
+		"""
+		if message["msg_id"] == None:
+			return
+		if room_id in self.loading:
+			# The query may have run before the message was stored
+			self.received_while_loading[room_id].append(message)
+		buffer = self.rooms.get(room_id)
+		if buffer != None and buffer.append(message):
+			self.update_metrics()
+
+	async def get_first_page(self, room_id, build_frame):
+		"""
+		The encoded first page of messages of the room (see RoomRingBuffer.get_frame).
+		"""
+		buffer = self.rooms.get(room_id)
+		if buffer != None:
+			self.hits += 1
+			metrics.increment("public_chat.recent_messages.hits")
+		else:
+			self.misses += 1
+			metrics.increment("public_chat.recent_messages.misses")
+			# Cold start. Concurrent visitors wait for the same query.
+			if room_id not in self.loading:
+				self.received_while_loading[room_id] = []
+				self.loading[room_id] = asyncio.ensure_future(self.load(room_id))
+			buffer = await asyncio.shield(self.loading[room_id])
+		metrics.gauge("public_chat.recent_messages.hit_rate", self.hits / (self.hits + self.misses))
+		return buffer.get_frame(build_frame)
+
+	async def load(self, room_id):
+		try:
+			messages = await database_sync_to_async(self.load_messages)(room_id, self.size)
+			buffer = RoomRingBuffer(self.size, messages)
+			for message in self.received_while_loading[room_id]:
+				buffer.append(message)
+			# Only keep it if it will be kept up to date (see unsubscribe)
+			if room_id in self.subscribers:
+				self.rooms[room_id] = buffer
+				self.update_metrics()
+			return buffer
+		finally:
+			del self.loading[room_id]
+			del self.received_while_loading[room_id]
+
+	def update_metrics(self):
+		metrics.gauge("public_chat.recent_messages.rooms", len(self.rooms))
+		metrics.gauge("public_chat.recent_messages.messages", sum([len(buffer.messages) for buffer in self.rooms.values()]))
+		metrics.gauge("public_chat.recent_messages.bytes", sum([buffer.num_bytes for buffer in self.rooms.values()]))
@@ -1,3 +1,84 @@
-from django.test import TestCase
+import asyncio
 
-# Create your tests here.
+from django.test import TestCase, TransactionTestCase
+
+from ChatServerPlayground.test_utils import explain
+from account.models import Account
+from chat.base_consumer import decode_frame
+from chat.utils import get_epoch_timestamp
+from public_chat.consumers import recent_messages, get_first_page_frame, load_recent_messages
+from public_chat.models import PublicChatRoom, PublicRoomChatMessage
+
+
+class PublicChatIndexTestCase(TestCase):
+	"""
+	The queries run by PublicChatConsumer must use the composite index on PublicRoomChatMessage.
+	"""
+
+	def test_room_chat_messages(self):
+		room = PublicChatRoom.objects.create(title="General")
+		plan = explain(PublicRoomChatMessage.objects.by_room(room)[:20])
+		self.assertIn("public_msg_room_ts_id_idx", plan)
+
+	def test_room_chat_messages_before(self):
+		room = PublicChatRoom.objects.create(title="General")
+		plan = explain(PublicRoomChatMessage.objects.before(room, 100)[:21])
+		self.assertIn("public_msg_room_ts_id_idx", plan)
+
+
+class RecentMessagesTestCase(TransactionTestCase):
+	"""
+	The first page of a public room is loaded from the database once, then kept up to date in memory.
+	TransactionTestCase: the buffer is loaded from another thread (database_sync_to_async).
+	"""
+
+	def setUp(self):
+		self.user = Account.objects.create_user("user@example.com", "user", "password")
+		self.room = PublicChatRoom.objects.create(title="General")
+		for i in range(25):
+			PublicRoomChatMessage.objects.create(user=self.user, room=self.room, content=f"message {i}")
+		recent_messages.subscribe(self.room.id)
+
+	def tearDown(self):
+		recent_messages.unsubscribe(self.room.id)
+
+	def get_first_page(self):
+		frame = asyncio.get_event_loop().run_until_complete(recent_messages.get_first_page(self.room.id, get_first_page_frame))
+		return [message["message"] for message in decode_frame(frame)["messages"]]
+
+	def append(self, msg_id, content):
+		recent_messages.append(self.room.id, {
+			"msg_type": 0,
+			"msg_id": msg_id,
+			"user_id": str(self.user.id),
+			"username": self.user.username,
+			"message": content,
+			"profile_image": self.user.profile_image.url,
+			"timestamp": get_epoch_timestamp(PublicRoomChatMessage.objects.first().timestamp),
+		})
+
+	def test_first_page_is_cached(self):
+		expected = [f"message {i}" for i in reversed(range(5, 25))]
+		self.assertEqual(self.get_first_page(), expected)
+		with self.assertNumQueries(0):
+			self.assertEqual(self.get_first_page(), expected)
+
+	def test_messages_sent_in_the_same_instant(self):
+		PublicRoomChatMessage.objects.update(timestamp=PublicRoomChatMessage.objects.first().timestamp)
+		messages = load_recent_messages(self.room.id, 20)
+		self.assertEqual([message["message"] for message in messages], [f"message {i}" for i in reversed(range(5, 25))])
+
+	def test_new_messages_are_appended_once(self):
+		self.get_first_page()
+		# Every socket of the room receives the message
+		self.append("1000", "new message")
+		self.append("1000", "new message")
+		page = self.get_first_page()
+		self.assertEqual(page[:2], ["new message", "message 24"])
+		self.assertEqual(len(page), 20)
+
+	def test_buffer_is_dropped_without_subscribers(self):
+		self.get_first_page()
+		recent_messages.unsubscribe(self.room.id)
+		self.assertNotIn(self.room.id, recent_messages.rooms)
+		recent_messages.subscribe(self.room.id)